@@ -3,6 +3,9 @@ import { getBaseURL } from "./utils";
 export type FileStatus =
   | "uploading"
   | "uploaded"
+  | "indexing"
+  | "indexed"
+  | "indexing_failed"
   | "failed"
   | "removing"
   | "removed";
@@ -12,12 +15,42 @@ export type File = {
   status: FileStatus;
 };
 
-export async function fetchFiles(): Promise<File[]> {
-  const res = await fetch(`${getBaseURL()}/api/management/files`);
+export type FileSort = "name" | "size" | "mtime" | "status" | "chunks";
+
+export type FetchFilesOptions = {
+  limit?: number;
+  // The nextCursor of the previous page
+  cursor?: string | null;
+  sort?: FileSort;
+  order?: "asc" | "desc";
+  status?: FileStatus;
+  search?: string;
+};
+
+export type FilesPage = {
+  files: File[];
+  // The cursor of the next page, null for the last page
+  nextCursor: string | null;
+};
+
+export async function fetchFiles(
+  options: FetchFilesOptions = {},
+): Promise<FilesPage> {
+  const params = new URLSearchParams();
+  for (const [key, value] of Object.entries(options)) {
+    if (value !== undefined && value !== null && value !== "") {
+      params.set(key, String(value));
+    }
+  }
+  const query = params.toString() ? `?${params.toString()}` : "";
+  const res = await fetch(`${getBaseURL()}/api/management/files${query}`);
   if (!res.ok) {
     throw new Error("Failed to fetch files");
   }
-  return res.json();
+  return {
+    files: await res.json(),
+    nextCursor: res.headers.get("X-Next-Cursor"),
+  };
 }
 
 export async function uploadFile(formData: any) {
@@ -5,6 +5,7 @@ import {
   removeFile,
   uploadFile,
 } from "@/client/files";
+import { Button } from "@/components/ui/button";
 import { ExpandableSection } from "@/components/ui/custom/expandableSection";
 import { Input } from "@/components/ui/input";
 import { Label } from "@/components/ui/label";
@@ -16,10 +17,16 @@ import {
 } from "@/components/ui/tooltip";
 import { useToast } from "@/components/ui/use-toast";
 import { cn } from "@/lib/utils";
-import { useEffect, useState } from "react";
+import { useCallback, useEffect, useState } from "react";
+
+// The number of files loaded per page
+const PAGE_SIZE = 100;
 
 export const Knowledge = () => {
   const [files, setFiles] = useState<File[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [search, setSearch] = useState("");
+  const [loading, setLoading] = useState(false);
   const { toast } = useToast();
 
   const updateStatus = (name: string, status: FileStatus) => (f: File) => {
@@ -84,11 +91,20 @@ export const Knowledge = () => {
     }
   }
 
-  useEffect(() => {
-    async function handleFetchFiles() {
+  const handleFetchFiles = useCallback(
+    async (cursor: string | null) => {
+      setLoading(true);
       try {
-        const files = await fetchFiles();
-        setFiles(files);
+        const page = await fetchFiles({
+          limit: PAGE_SIZE,
+          cursor,
+          search: search.trim(),
+        });
+        // The first page replaces the list, the next pages are appended
+        setFiles((prevFiles) =>
+          cursor ? [...prevFiles, ...page.files] : page.files,
+        );
+        setNextCursor(page.nextCursor);
       } catch (error) {
         console.error(error);
         // Show a error toast
@@ -98,11 +114,18 @@ export const Knowledge = () => {
           ),
           title: "Failed to load uploaded files!",
         });
+      } finally {
+        setLoading(false);
       }
-    }
+    },
+    [search, toast],
+  );
 
-    handleFetchFiles();
-  }, [toast]);
+  useEffect(() => {
+    // Wait for the user to stop typing before searching
+    const timeout = setTimeout(() => handleFetchFiles(null), 300);
+    return () => clearTimeout(timeout);
+  }, [handleFetchFiles]);
 
   return (
     <ExpandableSection
@@ -110,7 +133,23 @@ export const Knowledge = () => {
       description="Upload your own data to chat with"
       open
     >
+      <Input
+        className="mb-4 max-w-sm"
+        placeholder="Search files"
+        value={search}
+        onChange={(e) => setSearch(e.target.value)}
+      />
       <ListFiles files={files} handleRemoveFile={handleRemoveFile} />
+      {nextCursor && (
+        <Button
+          className="mt-4"
+          variant="outline"
+          disabled={loading}
+          onClick={() => handleFetchFiles(nextCursor)}
+        >
+          {loading ? "Loading..." : "Load more"}
+        </Button>
+      )}
       <UploadFile handleAddFiles={handleAddFiles} />
     </ExpandableSection>
   );
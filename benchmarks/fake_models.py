@@ -0,0 +1,129 @@
+import re
+import time
+import asyncio
+import hashlib
+from typing import Any, List, Sequence
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.llms import (
+    ChatMessage,
+    ChatResponse,
+    CompletionResponse,
+    CustomLLM,
+    LLMMetadata,
+)
+
+
+class FakeEmbedding(BaseEmbedding):
+    """
+    A deterministic embedding model based on feature hashing of the tokens,
+    similar texts get similar embeddings so the retrieval stays meaningful.
+    """
+
+    dim: int = Field(default=64, description="The vector size.")
+    delay: float = Field(default=0.0, description="Seconds to wait per call.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeEmbedding"
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(token.encode()).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dim
+            vector[bucket] += 1.0 if digest[4] % 2 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        time.sleep(self.delay)
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        await asyncio.sleep(self.delay)
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        time.sleep(self.delay)
+        return self._embed(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        # One call per batch like a real embedding API
+        time.sleep(self.delay)
+        return [self._embed(text) for text in texts]
+
+
+class FakeLLM(CustomLLM):
+    """
+    A deterministic LLM that streams a fixed number of tokens with a fixed delay per token.
+    """
+
+    num_tokens: int = Field(default=64, description="The number of tokens to answer.")
+    token_delay: float = Field(default=0.005, description="Seconds per token.")
+    first_token_delay: float = Field(
+        default=0.05, description="Seconds before the first token."
+    )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(model_name="fake-llm", context_window=8192)
+
+    def _tokens(self, prompt: str) -> List[str]:
+        words = re.findall(r"\w+", prompt)[-self.num_tokens :] or ["ok"]
+        return [f"{words[i % len(words)]} " for i in range(self.num_tokens)]
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        time.sleep(self.first_token_delay + self.token_delay * self.num_tokens)
+        return CompletionResponse(text="".join(self._tokens(prompt)))
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        def gen():
+            text = ""
+            time.sleep(self.first_token_delay)
+            for token in self._tokens(prompt):
+                time.sleep(self.token_delay)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        await asyncio.sleep(self.first_token_delay + self.token_delay * self.num_tokens)
+        return CompletionResponse(text="".join(self._tokens(prompt)))
+
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ):
+        async def gen():
+            text = ""
+            await asyncio.sleep(self.first_token_delay)
+            for token in self._tokens(prompt):
+                await asyncio.sleep(self.token_delay)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any):
+        response = await self.acomplete(self.messages_to_prompt(messages))
+        return ChatResponse(
+            message=ChatMessage(role="assistant", content=response.text)
+        )
+
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any):
+        completion = await self.astream_complete(self.messages_to_prompt(messages))
+
+        async def gen():
+            async for response in completion:
+                yield ChatResponse(
+                    message=ChatMessage(role="assistant", content=response.text),
+                    delta=response.delta,
+                )
+
+        return gen()
@@ -0,0 +1,351 @@
+"""
+End-to-end benchmark of the ingestion and the chat with deterministic fake models.
+
+Usage: make benchmark ARGS="--num-docs 200 --clients 8 --output result.json"
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import statistics
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = (
+    "pump valve sensor motor filter pressure flow error code manual reset "
+    "install warranty cable voltage current torque speed bearing seal gasket "
+    "coolant temperature alarm firmware update calibration interval service "
+    "inspection safety shutdown startup sequence controller panel display "
+    "battery charger fuse relay switch connector housing bracket screw"
+).split()
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": statistics.fmean(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_sentence(rng: random.Random) -> str:
+    words = rng.choices(WORDS, k=rng.randint(8, 20))
+    code = f"E-{rng.randint(100, 999)}"
+    return f"{' '.join(words).capitalize()} {code}."
+
+
+def generate_corpus(data_dir: str, num_docs: int, doc_sentences: int, seed: int):
+    """
+    Write a synthetic corpus of text and csv files, the same seed gives the same corpus.
+    """
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    for i in range(num_docs):
+        if i % 5 == 4:
+            rows = ["part,description,price"]
+            for j in range(doc_sentences):
+                rows.append(
+                    f"P{i}-{j},{' '.join(rng.choices(WORDS, k=6))},{rng.randint(1, 999)}"
+                )
+            content = "\n".join(rows)
+            file_name = f"doc_{i:05d}.csv"
+        else:
+            content = "\n\n".join(
+                " ".join(make_sentence(rng) for _ in range(5))
+                for _ in range(max(doc_sentences // 5, 1))
+            )
+            file_name = f"doc_{i:05d}.txt"
+        with open(os.path.join(data_dir, file_name), "w") as f:
+            f.write(content)
+
+
+def setup_workspace(args) -> str:
+    """
+    Create a workspace with the config of the repo and point the app to it.
+    """
+    workspace = tempfile.mkdtemp(prefix="ragbox-benchmark-")
+    shutil.copytree(os.path.join(REPO_DIR, "config"), os.path.join(workspace, "config"))
+    os.makedirs(os.path.join(workspace, "data"))
+    os.makedirs(os.path.join(workspace, "static"))
+    os.chdir(workspace)
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, os.path.join(REPO_DIR, "create_llama", "backend"))
+
+    # The env variables take precedence over config/.env
+    os.environ.update(
+        {
+            "MODEL_PROVIDER": "ollama",
+            "MODEL": "fake-llm",
+            "EMBEDDING_MODEL": "fake-embedding",
+            "OLLAMA_BASE_URL": "http://127.0.0.1:9",
+            "VECTOR_STORE_PROVIDER": "chroma",
+            "CHROMA_COLLECTION": "benchmark",
+            "CHROMA_PATH": os.path.join(workspace, "storage", "chromadb"),
+            "STORAGE_DIR": os.path.join(workspace, "storage", "context"),
+            "EMBEDDING_CACHE": "true" if args.embedding_cache else "false",
+            "EMBEDDING_CACHE_DIR": os.path.join(workspace, "storage", "embeddings"),
+            "INDEXING_DEBOUNCE_SECONDS": "0",
+            "TOP_K": str(args.top_k),
+        }
+    )
+    return workspace
+
+
+def set_fake_models(args):
+    from llama_index.core.settings import Settings
+    from benchmarks.fake_models import FakeEmbedding, FakeLLM
+
+    Settings.llm = FakeLLM(
+        num_tokens=args.answer_tokens,
+        token_delay=args.token_delay,
+        first_token_delay=args.first_token_delay,
+    )
+    Settings.embed_model = FakeEmbedding(delay=args.embed_delay)
+
+
+def benchmark_indexing(num_docs: int) -> dict:
+    from src.models.file import IndexingJob
+    from src.tasks.indexing import index_all, rebuild_index
+
+    job = IndexingJob()
+    start = time.perf_counter()
+    index_all(job)
+    index_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rebuild_index()
+    reset_seconds = time.perf_counter() - start
+
+    # Nothing changed, so this only measures the change detection
+    start = time.perf_counter()
+    index_all()
+    noop_seconds = time.perf_counter() - start
+
+    return {
+        "documents": num_docs,
+        "nodes": job.embedded_nodes,
+        "index_seconds": index_seconds,
+        "docs_per_second": num_docs / index_seconds,
+        "nodes_per_second": job.embedded_nodes / index_seconds,
+        "reset_seconds": reset_seconds,
+        "reset_docs_per_second": num_docs / reset_seconds,
+        "noop_index_seconds": noop_seconds,
+    }
+
+
+def start_server(port: int):
+    import uvicorn
+    from main import app
+
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def upload_file(port: int, file_name: str, content: bytes) -> float:
+    boundary = "ragboxbenchmark"
+    body = (
+        (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+            "Content-Type: text/plain\r\n\r\n"
+        ).encode()
+        + content
+        + f"\r\n--{boundary}--\r\n".encode()
+    )
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    start = time.perf_counter()
+    conn.request(
+        "POST",
+        "/api/management/files",
+        body=body,
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+    )
+    response = conn.getresponse()
+    response.read()
+    latency = time.perf_counter() - start
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"Upload of {file_name} failed: {response.status}")
+    return latency
+
+
+def benchmark_uploads(port: int, num_uploads: int, seed: int) -> dict:
+    from src.tasks.jobs import indexing_queue
+
+    rng = random.Random(seed + 1)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(num_uploads):
+        content = " ".join(make_sentence(rng) for _ in range(50)).encode()
+        latencies.append(upload_file(port, f"upload_{i:05d}.txt", content))
+
+    # Wait for the uploaded files to be indexed
+    while True:
+        jobs = indexing_queue.get_jobs()
+        if all(job.finished for job in jobs):
+            break
+        time.sleep(0.05)
+    return {
+        "latency_seconds": summarize(latencies),
+        "upload_to_indexed_seconds": time.perf_counter() - start,
+    }
+
+
+def chat(port: int, question: str) -> dict:
+    """
+    Send a chat request and read the streamed answer, the text tokens are the
+    lines prefixed with "0:" in the Vercel AI data stream.
+    """
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    start = time.perf_counter()
+    conn.request(
+        "POST",
+        "/api/chat",
+        body=json.dumps({"messages": [{"role": "user", "content": question}]}),
+        headers={"Content-Type": "application/json"},
+    )
+    response = conn.getresponse()
+    if response.status != 200:
+        raise RuntimeError(f"Chat request failed: {response.status}")
+    first_token = None
+    tokens = 0
+    for line in response:
+        if line.startswith(b"0:"):
+            if first_token is None:
+                first_token = time.perf_counter()
+            tokens += 1
+    end = time.perf_counter()
+    conn.close()
+    first_token = first_token or end
+    return {
+        "ttft": first_token - start,
+        "total": end - start,
+        "tokens": tokens,
+        "tokens_per_second": tokens / (end - first_token) if end > first_token else 0,
+    }
+
+
+def benchmark_chat(port: int, num_requests: int, clients: int, seed: int) -> dict:
+    rng = random.Random(seed + 2)
+    questions = [
+        f"How do I fix {' '.join(rng.choices(WORDS, k=4))}?"
+        for _ in range(num_requests)
+    ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(lambda q: chat(port, q), questions))
+    elapsed = time.perf_counter() - start
+    return {
+        "clients": clients,
+        "requests": num_requests,
+        "requests_per_second": num_requests / elapsed,
+        "ttft_seconds": summarize([r["ttft"] for r in results]),
+        "total_seconds": summarize([r["total"] for r in results]),
+        "tokens_per_second": summarize([r["tokens_per_second"] for r in results]),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-docs", type=int, default=100)
+    parser.add_argument("--doc-sentences", type=int, default=40)
+    parser.add_argument("--uploads", type=int, default=20)
+    parser.add_argument("--chat-requests", type=int, default=50)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--answer-tokens", type=int, default=64)
+    parser.add_argument("--token-delay", type=float, default=0.005)
+    parser.add_argument("--first-token-delay", type=float, default=0.05)
+    parser.add_argument("--embed-delay", type=float, default=0.0)
+    parser.add_argument("--embedding-cache", action="store_true")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_result.json")
+    parser.add_argument(
+        "--keep-workspace", action="store_true", help="Don't remove the workspace"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output)
+    workspace = setup_workspace(args)
+    try:
+        generate_corpus("data", args.num_docs, args.doc_sentences, args.seed)
+
+        # Starting the app initializes the settings, so the fake models are set after it
+        import main as app_main
+
+        app_main.startup()
+
+        set_fake_models(args)
+        result = {
+            "commit": get_git_commit(),
+            "timestamp": time.time(),
+            "params": vars(args),
+            "indexing": benchmark_indexing(args.num_docs),
+        }
+
+        port = get_free_port()
+        server, thread = start_server(port)
+        try:
+            result["upload"] = benchmark_uploads(port, args.uploads, args.seed)
+            result["chat"] = benchmark_chat(
+                port, args.chat_requests, args.clients, args.seed
+            )
+        finally:
+            server.should_exit = True
+            thread.join()
+    finally:
+        os.chdir(REPO_DIR)
+        if not args.keep_workspace:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Cold start of the API process: the import time per package and module, the duration
+of the startup phases and a check of the total against a budget.
+
+Usage: make startup-check ARGS="--runs 3 --budget-seconds 8"
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+import statistics
+from benchmarks.run import REPO_DIR, get_git_commit, setup_workspace
+
+# Prints the startup report of the app as the last line of stdout
+STARTUP_SCRIPT = (
+    "import json, main; "
+    "main.startup(); "
+    "from src.startup import startup_report; "
+    "print(json.dumps(startup_report.to_dict()))"
+)
+
+
+def parse_importtime(stderr: str):
+    """
+    Parse the output of python -X importtime into the self time of every module.
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = int(self_us) / 1e6
+    return modules
+
+
+def cold_start() -> dict:
+    """
+    Import main and start the app in a new interpreter, as uvicorn does when it
+    starts a worker.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [REPO_DIR, os.path.join(REPO_DIR, "create_llama", "backend")]
+    )
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"The app failed to start:\n{process.stderr[-4000:]}")
+    report = json.loads(process.stdout.strip().splitlines()[-1])
+    report["modules"] = parse_importtime(process.stderr)
+    return report
+
+
+def summarize_imports(modules: dict, top: int) -> dict:
+    packages = {}
+    for name, seconds in modules.items():
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0.0) + seconds
+
+    def largest(times: dict):
+        items = sorted(times.items(), key=lambda item: item[1], reverse=True)[:top]
+        return {name: round(seconds, 4) for name, seconds in items}
+
+    return {"packages": largest(packages), "modules": largest(modules)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--budget-seconds",
+        type=float,
+        default=float(os.getenv("STARTUP_BUDGET_SECONDS", "8")),
+        help="Fail if the median cold start is slower",
+    )
+    parser.add_argument("--output", default="startup_result.json")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output)
+    workspace = setup_workspace(argparse.Namespace(embedding_cache=False, top_k=3))
+    try:
+        # The first run fills the bytecode cache, it is not a cold start
+        cold_start()
+        reports = [cold_start() for _ in range(args.runs)]
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    totals = [report["total_seconds"] for report in reports]
+    phases = {
+        name: statistics.median(report["phases"][name] for report in reports)
+        for name in reports[0]["phases"]
+    }
+    median = statistics.median(totals)
+    result = {
+        "commit": get_git_commit(),
+        "runs": args.runs,
+        "budget_seconds": args.budget_seconds,
+        "total_seconds": {"median": median, "max": max(totals)},
+        "phases": phases,
+        "imports": summarize_imports(reports[-1]["modules"], args.top),
+    }
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+
+    if median > args.budget_seconds:
+        print(
+            f"The cold start of {median:.2f}s exceeds the budget of "
+            f"{args.budget_seconds:.2f}s",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
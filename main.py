@@ -1,3 +1,6 @@
+# Imported first to time the whole startup
+from src.startup import startup_report
+
 from dotenv import load_dotenv
 from src.constants import ENV_FILE_PATH
 
@@ -5,21 +8,74 @@ load_dotenv(
     dotenv_path=ENV_FILE_PATH,
 )
 
-import os
-import logging
-import uvicorn
-from fastapi import FastAPI
-from fastapi.responses import RedirectResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
-from create_llama.backend.app.settings import init_settings
-from create_llama.backend.app.api.routers.chat import chat_router
-from src.routers.management.config import config_router
-from src.routers.management.files import files_router
-from src.routers.management.tools import tools_router
-from fastapi.middleware.cors import CORSMiddleware
-
-app = FastAPI()
-init_settings()
+from src.shared_state import SharedStateMiddleware, init_shared_state
+from src.chat_scheduler import ChatSchedulerMiddleware
+
+init_shared_state()
+
+# The provider, vector store and tool modules are only imported on first use
+with startup_report.phase("imports"):
+    import os
+    import shutil
+    import logging
+    from contextlib import asynccontextmanager
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.responses import RedirectResponse, FileResponse
+    from create_llama.backend.app.settings import init_settings
+    from create_llama.backend.app.api.routers.chat import chat_router
+    from src.routers.management.config import config_router
+    from src.routers.management.files import files_router
+    from src.routers.management.tools import tools_router
+    from src.routers.management.cache import cache_router
+    from src.routers.management.snapshots import snapshots_router
+    from src.routers.metrics import metrics_router
+    from src.tasks.warmup import model_warmup
+    from src.chat_filters import ChatFiltersMiddleware
+    from src.chat_sessions import ChatSessionMiddleware
+    from src.routers.sessions import sessions_router
+    from src.static_files import CachedStaticFiles
+    from app.metrics import TracingMiddleware, start_metrics_writer
+    from fastapi.middleware.cors import CORSMiddleware
+
+_started = False
+
+
+def startup():
+    """
+    Initialize the models of the worker once. Not done on import, as the parse worker
+    processes of the indexing import main.py again.
+    """
+    global _started
+    if _started:
+        return
+    _started = True
+    with startup_report.phase("init_settings"):
+        init_settings()
+    # Load the models in the background so the first chat request doesn't wait for it
+    model_warmup.start()
+    start_metrics_writer()
+    startup_report.finish()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Limit the concurrent chat requests per model backend, the others are queued
+app.add_middleware(ChatSchedulerMiddleware)
+# Scope the retrieval of the chat requests to the documents matching their filters
+app.add_middleware(ChatFiltersMiddleware)
+# Continue the conversations kept on the server for the requests with a session id
+app.add_middleware(ChatSessionMiddleware)
+# Reload the config and the index when they were changed by another worker
+app.add_middleware(SharedStateMiddleware)
+# Assign a trace id to every request and record the request durations
+app.add_middleware(TracingMiddleware)
 
 environment = os.getenv("ENVIRONMENT")
 if environment == "dev":
@@ -29,6 +85,7 @@ if environment == "dev":
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Next-Cursor"],
     )
 
 # Add chat router from create_llama/backend
@@ -36,6 +93,10 @@ app.include_router(chat_router, prefix="/api/chat")
 app.include_router(config_router, prefix="/api/management/config")
 app.include_router(files_router, prefix="/api/management/files")
 app.include_router(tools_router, prefix="/api/management/tools")
+app.include_router(cache_router, prefix="/api/management/cache")
+app.include_router(snapshots_router, prefix="/api/management/snapshots")
+app.include_router(metrics_router, prefix="/metrics")
+app.include_router(sessions_router, prefix="/api/sessions")
 
 
 @app.get("/")
@@ -51,12 +112,29 @@ async def redirect():
         return RedirectResponse(url="/admin/#new")
 
 
-app.mount("/api/data", StaticFiles(directory="data"), name="static")
-app.mount("", StaticFiles(directory="static", html=True), name="static")
+app.mount("/api/data", CachedStaticFiles(directory="data"), name="static")
+app.mount(
+    "",
+    CachedStaticFiles(directory="static", html=True, precompressed=True),
+    name="static",
+)
 
 if __name__ == "__main__":
     app_host = os.getenv("APP_HOST", "0.0.0.0")
     app_port = int(os.getenv("APP_PORT", "8000"))
+    app_workers = int(os.getenv("APP_WORKERS", "1"))
     reload = environment == "dev"
+    if app_workers > 1 and not reload:
+        # Every worker writes its metrics to this folder and /metrics reports their sum,
+        # the metrics of the previous run are removed
+        metrics_dir = os.environ.setdefault("METRICS_DIR", "storage/metrics")
+        shutil.rmtree(metrics_dir, ignore_errors=True)
 
-    uvicorn.run(app="main:app", host=app_host, port=app_port, reload=reload)
+    uvicorn.run(
+        app="main:app",
+        host=app_host,
+        port=app_port,
+        reload=reload,
+        # Reload in dev mode only supports a single worker
+        workers=1 if reload else app_workers,
+    )
@@ -1,42 +1,138 @@
 import os
+import threading
 from llama_index.core.settings import Settings
-from llama_index.core.agent import AgentRunner
 from app.engine.tools import ToolFactory
 from app.engine.index import get_index
+from app.engine.index_version import get_query_embed_model
+from app.engine.retriever import get_retriever
+from app.engine.filters import get_chat_filters
+from app.engine.session import SessionChatEngine, get_keep_messages, session_store
+from app.engine.instrumentation import (
+    InstrumentedCondensePlusContextChatEngine,
+    TracedChatEngine,
+)
+from app.engine.tool_cache import ManagedTool, get_tool_timeout, tool_cache
+from app.engine.context import (
+    ContextCompressor,
+    TokenBudgetChatEngine,
+    get_context_budget,
+    get_history_budget,
+)
+from app.engine.semantic_cache import (
+    SemanticCacheChatEngine,
+    is_semantic_cache_enabled,
+    semantic_cache,
+)
+
+TOOL_CONFIG_FILE = "config/tools.yaml"
+
+# The environment variables the index and the tools are built from
+CACHE_KEY_ENV_VARS = [
+    "MODEL_PROVIDER",
+    "MODEL",
+    "EMBEDDING_MODEL",
+    "EMBEDDING_DIM",
+    "OLLAMA_BASE_URL",
+    "VECTOR_STORE_PROVIDER",
+    "CHROMA_PATH",
+    "CHROMA_HOST",
+    "CHROMA_PORT",
+    "CHROMA_COLLECTION",
+    "QDRANT_URL",
+    "QDRANT_COLLECTION",
+    "QDRANT_PATH",
+]
+
+_cache_lock = threading.Lock()
+# Maps the cache key to the (index, tools) built for it
+_cache = {}
+
+
+def _get_cache_key():
+    try:
+        tool_config_mtime = os.stat(TOOL_CONFIG_FILE).st_mtime_ns
+    except FileNotFoundError:
+        tool_config_mtime = None
+    return tuple(os.getenv(name) for name in CACHE_KEY_ENV_VARS) + (tool_config_mtime,)
+
+
+def invalidate_chat_engine_cache():
+    """
+    Drop the cached index, tools and answers, they are rebuilt on the next chat requests.
+    Call it after changing the config, the tools or the indexed data.
+    """
+    with _cache_lock:
+        _cache.clear()
+    semantic_cache.clear()
+
+
+def _get_index_and_tools():
+    cache_key = _get_cache_key()
+    with _cache_lock:
+        if cache_key not in _cache:
+            index = get_index()
+            if index is None:
+                raise RuntimeError("Index is not found")
+            # The index of a new embedding model may still be being built
+            query_embed_model = get_query_embed_model()
+            if query_embed_model is not None:
+                index._embed_model = query_embed_model
+            # Only keep the components of the current config
+            _cache.clear()
+            _cache[cache_key] = (index, ToolFactory.from_env())
+        return _cache[cache_key]
 
 
 def get_chat_engine():
+    chat_engine = _create_chat_engine()
+    history_budget = get_history_budget()
+    if history_budget is not None:
+        chat_engine = TokenBudgetChatEngine(chat_engine, history_budget)
+    # The cached answers are not scoped to the filters of the request
+    if is_semantic_cache_enabled() and get_chat_filters() is None:
+        chat_engine = SemanticCacheChatEngine(chat_engine, semantic_cache)
+    # Replaces the history of the requests with a session id by the session history
+    chat_engine = SessionChatEngine(chat_engine, session_store, get_keep_messages())
+    return TracedChatEngine(chat_engine)
+
+
+def _create_chat_engine():
     top_k = int(os.getenv("TOP_K", "3"))
     system_prompt = os.getenv("SYSTEM_PROMPT")
 
-    index = get_index()
-    if index is None:
-        raise RuntimeError("Index is not found")
-
-    tools = ToolFactory.from_env()
+    # The chat engines keep the chat history of a request, so only the expensive
+    # components (vector store connection and tool specs) are shared between requests
+    index, cached_tools = _get_index_and_tools()
+    tool_timeout = get_tool_timeout()
+    tools = [ManagedTool(tool, tool_cache, tool_timeout) for tool in cached_tools]
+    context_budget = get_context_budget()
+    node_postprocessors = (
+        [ContextCompressor(token_budget=context_budget)] if context_budget else []
+    )
 
     # Use the context chat engine if no tools are provided
     if len(tools) == 0:
-        from llama_index.core.chat_engine import CondensePlusContextChatEngine
-
-        return CondensePlusContextChatEngine.from_defaults(
-            retriever=index.as_retriever(
-                system_prompt=system_prompt,
-            ),
+        return InstrumentedCondensePlusContextChatEngine.from_defaults(
+            retriever=get_retriever(index, top_k),
+            node_postprocessors=node_postprocessors,
+            system_prompt=system_prompt,
             llm=Settings.llm,
         )
     else:
-        from llama_index.core.agent import AgentRunner
+        from app.engine.agent import create_agent
+        from llama_index.core.query_engine import RetrieverQueryEngine
         from llama_index.core.tools.query_engine import QueryEngineTool
 
         # Add the query engine tool to the list of tools
         query_engine_tool = QueryEngineTool.from_defaults(
-            query_engine=index.as_query_engine(similarity_top_k=top_k)
+            query_engine=RetrieverQueryEngine.from_args(
+                retriever=get_retriever(index, top_k),
+                node_postprocessors=node_postprocessors,
+                llm=Settings.llm,
+            )
         )
-        tools.append(query_engine_tool)
-        return AgentRunner.from_llm(
-            llm=Settings.llm,
-            tools=tools,
-            system_prompt=system_prompt,
-            verbose=True,  # Show agent logs to console
+        # The answers of the query engine depend on the index, so they are not cached
+        tools.append(
+            ManagedTool(query_engine_tool, tool_cache, tool_timeout, cacheable=False)
         )
+        return create_agent(Settings.llm, tools, system_prompt)
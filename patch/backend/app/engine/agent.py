@@ -0,0 +1,116 @@
+import asyncio
+from typing import Dict, List, Optional
+from llama_index.agent.openai import OpenAIAgentWorker
+from llama_index.agent.openai.step import acall_function, get_function_by_name
+from llama_index.core.agent import AgentRunner
+from llama_index.core.callbacks import CBEventType, EventPayload
+from llama_index.core.llms import LLM
+from llama_index.core.memory import BaseMemory, ChatMemoryBuffer
+from llama_index.core.tools import BaseTool, ToolOutput
+
+
+class ConcurrentToolsOpenAIAgentWorker(OpenAIAgentWorker):
+    """
+    The OpenAI agent worker awaits the tool calls of a step one after the other.
+    This worker starts all the tool calls of the step on the first one, so they run
+    concurrently and the step only waits for the slowest call. Their outputs are
+    still added to the memory in the order of the calls.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The running tool calls of the current step by tool call id
+        self._pending: Dict[str, asyncio.Task] = {}
+
+    def _start_tool_calls(self, tools: List[BaseTool], tool_call, memory: BaseMemory):
+        tool_calls = [tool_call]
+        # The last assistant message has all the tool calls of the step
+        for message in reversed(memory.get_all()):
+            calls = message.additional_kwargs.get("tool_calls") or []
+            if any(call.id == tool_call.id for call in calls):
+                tool_calls = calls
+                break
+        for call in tool_calls:
+            if call.type == "function" and call.id not in self._pending:
+                # The task keeps the context, e.g. the trace of the request
+                self._pending[call.id] = asyncio.create_task(
+                    acall_function(
+                        tools,
+                        call,
+                        verbose=self._verbose,
+                        tool_call_parser=self.tool_call_parser,
+                    )
+                )
+
+    def _cancel_tool_calls(self):
+        for task in self._pending.values():
+            task.cancel()
+        self._pending.clear()
+
+    async def _acall_function(
+        self,
+        tools: List[BaseTool],
+        tool_call,
+        memory: BaseMemory,
+        sources: List[ToolOutput],
+    ) -> bool:
+        function_call = tool_call.function
+        tool = get_function_by_name(tools, function_call.name)
+        if tool_call.id not in self._pending:
+            self._start_tool_calls(tools, tool_call, memory)
+
+        with self.callback_manager.event(
+            CBEventType.FUNCTION_CALL,
+            payload={
+                EventPayload.FUNCTION_CALL: function_call.arguments,
+                EventPayload.TOOL: tool.metadata,
+            },
+        ) as event:
+            try:
+                function_message, tool_output = await self._pending.pop(tool_call.id)
+            except BaseException:
+                # The step fails, its other calls are not awaited anymore
+                self._cancel_tool_calls()
+                raise
+            event.on_end(payload={EventPayload.FUNCTION_OUTPUT: str(tool_output)})
+        sources.append(tool_output)
+        memory.put(function_message)
+
+        return tool.metadata.return_direct and not tool_output.is_error
+
+
+def _is_openai_function_calling_model(llm: LLM) -> bool:
+    try:
+        from llama_index.llms.openai import OpenAI
+        from llama_index.llms.openai.utils import is_function_calling_model
+    except ImportError:
+        return False
+    return isinstance(llm, OpenAI) and is_function_calling_model(llm.model)
+
+
+def create_agent(
+    llm: LLM, tools: List[BaseTool], system_prompt: Optional[str] = None
+) -> AgentRunner:
+    """
+    Create the agent like AgentRunner.from_llm, the OpenAI agent runs the tool calls
+    of a step concurrently. The ReAct agents call one tool per step.
+    """
+    if not _is_openai_function_calling_model(llm):
+        return AgentRunner.from_llm(
+            llm=llm,
+            tools=tools,
+            system_prompt=system_prompt,
+            verbose=True,  # Show agent logs to console
+        )
+    agent_worker = ConcurrentToolsOpenAIAgentWorker.from_tools(
+        tools=tools,
+        llm=llm,
+        system_prompt=system_prompt,
+        verbose=True,  # Show agent logs to console
+    )
+    return AgentRunner(
+        agent_worker,
+        memory=ChatMemoryBuffer.from_defaults(llm=llm),
+        llm=llm,
+        callback_manager=llm.callback_manager,
+    )
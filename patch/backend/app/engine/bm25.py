@@ -0,0 +1,355 @@
+import os
+import re
+import json
+import math
+import sqlite3
+import logging
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Dict, List
+import numpy as np
+from llama_index.core.schema import BaseNode, MetadataMode, NodeWithScore
+from llama_index.core.vector_stores.types import MetadataFilters
+from llama_index.core.vector_stores.utils import (
+    metadata_dict_to_node,
+    node_to_metadata_dict,
+)
+from app.engine.filters import filters_to_sql
+from app.engine.index_version import versioned_name
+
+logger = logging.getLogger("uvicorn")
+
+# Keep identifiers like part numbers (AB-123.4) or error codes (E_42) as one term
+TOKEN_PATTERN = re.compile(r"\w+(?:[-.]\w+)*")
+# Merge the postings segments once there are this many of a similar number of nodes,
+# so every node is rewritten once per size tier instead of on every merge
+MERGE_FACTOR = 8
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    An on-disk inverted index to score nodes with BM25.
+    Every add writes a new segment of postings (term -> int32 array of row, tf, length)
+    so updates never rewrite the existing postings. Segments of a similar size are merged
+    (size-tiered, like the LSM trees) to keep the number of segments logarithmic.
+    Deleted nodes are marked and dropped from the postings when the segments are merged.
+    """
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+
+    @contextmanager
+    def _connect(self):
+        """
+        Open a connection for one transaction, no connection is kept open
+        as the file is removed when the index is reset.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        db = sqlite3.connect(self.path)
+        db.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS nodes (
+                row INTEGER PRIMARY KEY,
+                doc_id TEXT,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                length INTEGER NOT NULL,
+                metadata TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS nodes_doc_id ON nodes (doc_id);
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                segment INTEGER NOT NULL,
+                postings BLOB NOT NULL,
+                PRIMARY KEY (term, segment)
+            );
+            CREATE TABLE IF NOT EXISTS segments (
+                segment INTEGER PRIMARY KEY,
+                num_nodes INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS stats (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            """
+        )
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def _read_postings(db: sqlite3.Connection, terms=None) -> Dict[str, np.ndarray]:
+        """
+        Read the postings of the given terms (all terms if None) with their segments merged.
+        """
+        if terms is None:
+            result = db.execute("SELECT term, postings FROM postings")
+        else:
+            placeholders = ",".join("?" * len(terms))
+            result = db.execute(
+                f"SELECT term, postings FROM postings WHERE term IN ({placeholders})",
+                list(terms),
+            )
+        segments = defaultdict(list)
+        for term, blob in result:
+            segments[term].append(np.frombuffer(blob, dtype=np.int32))
+        return {
+            term: np.concatenate(blobs).reshape(-1, 3)
+            for term, blobs in segments.items()
+        }
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def remove(self):
+        """
+        Remove the index, e.g. so it is built again from all the files when needed.
+        """
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    @staticmethod
+    def _get_stat(db: sqlite3.Connection, key: str) -> int:
+        value = db.execute("SELECT value FROM stats WHERE key = ?", (key,)).fetchone()
+        return value[0] if value else 0
+
+    @staticmethod
+    def _add_stat(db: sqlite3.Connection, key: str, delta: int):
+        db.execute(
+            "INSERT INTO stats VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = value + excluded.value",
+            (key, delta),
+        )
+
+    def add(self, nodes: List[BaseNode]):
+        if len(nodes) == 0:
+            return
+        with self._connect() as db:
+            if db.execute("SELECT 1 FROM segments LIMIT 1").fetchone() is None:
+                # Written before the segment sizes were kept, merge into one segment
+                if db.execute("SELECT 1 FROM postings LIMIT 1").fetchone() is not None:
+                    self._merge(db)
+            first_row = db.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM nodes")
+            first_row = first_row.fetchone()[0]
+            segment = self._next_segment(db)
+            term_postings: Dict[str, List] = defaultdict(list)
+            rows = []
+            total_length = 0
+            for i, node in enumerate(nodes):
+                terms = tokenize(node.get_content(metadata_mode=MetadataMode.NONE))
+                total_length += len(terms)
+                for term, tf in Counter(terms).items():
+                    term_postings[term].append((first_row + i, tf, len(terms)))
+                rows.append(
+                    (
+                        first_row + i,
+                        node.ref_doc_id,
+                        len(terms),
+                        json.dumps(
+                            node_to_metadata_dict(
+                                node, remove_text=False, flat_metadata=False
+                            )
+                        ),
+                    )
+                )
+            db.executemany(
+                "INSERT INTO nodes (row, doc_id, length, metadata) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            db.executemany(
+                "INSERT INTO postings VALUES (?, ?, ?)",
+                [
+                    (term, segment, np.asarray(postings, dtype=np.int32).tobytes())
+                    for term, postings in term_postings.items()
+                ],
+            )
+            db.execute("INSERT INTO segments VALUES (?, ?)", (segment, len(nodes)))
+            self._add_stat(db, "num_nodes", len(nodes))
+            self._add_stat(db, "total_length", total_length)
+            self._merge_tiers(db)
+
+    def delete_documents(self, doc_ids: List[str]):
+        if len(doc_ids) == 0 or not self.exists():
+            return
+        with self._connect() as db:
+            placeholders = ",".join("?" * len(doc_ids))
+            num_nodes, total_length = db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM nodes "
+                f"WHERE deleted = 0 AND doc_id IN ({placeholders})",
+                doc_ids,
+            ).fetchone()
+            db.execute(
+                f"UPDATE nodes SET deleted = 1 WHERE doc_id IN ({placeholders})",
+                doc_ids,
+            )
+            self._add_stat(db, "num_nodes", -num_nodes)
+            self._add_stat(db, "total_length", -total_length)
+            num_deleted = db.execute("SELECT COUNT(*) FROM nodes WHERE deleted = 1")
+            if num_deleted.fetchone()[0] > self._get_stat(db, "num_nodes"):
+                self._merge(db)
+
+    @staticmethod
+    def _next_segment(db: sqlite3.Connection) -> int:
+        return db.execute(
+            "SELECT COALESCE(MAX(segment) + 1, 0) FROM segments"
+        ).fetchone()[0]
+
+    @staticmethod
+    def _get_deleted_rows(db: sqlite3.Connection) -> np.ndarray:
+        return np.asarray(
+            [row for (row,) in db.execute("SELECT row FROM nodes WHERE deleted = 1")],
+            dtype=np.int32,
+        )
+
+    def _merge_tiers(self, db: sqlite3.Connection):
+        """
+        Merge the segments of a tier (their number of nodes rounded down to a power
+        of MERGE_FACTOR) once it has MERGE_FACTOR segments, the merged segment
+        moves up to the next tier.
+        """
+        while True:
+            tiers = defaultdict(list)
+            for segment, num_nodes in db.execute("SELECT * FROM segments"):
+                tier = int(math.log(max(num_nodes, 1), MERGE_FACTOR))
+                tiers[tier].append((segment, num_nodes))
+            full_tier = next(
+                (s for _, s in sorted(tiers.items()) if len(s) >= MERGE_FACTOR), None
+            )
+            if full_tier is None:
+                return
+            self._merge_segments(db, full_tier)
+
+    def _merge_segments(self, db: sqlite3.Connection, segments: List):
+        """
+        Merge the given (segment, num_nodes) into a new segment.
+        The postings of the deleted nodes are dropped but the nodes are kept
+        as other segments can still have their postings.
+        """
+        segment_ids = [segment for segment, _ in segments]
+        placeholders = ",".join("?" * len(segment_ids))
+        deleted = self._get_deleted_rows(db)
+        term_segments = defaultdict(list)
+        for term, blob in db.execute(
+            "SELECT term, postings FROM postings "
+            f"WHERE segment IN ({placeholders}) ORDER BY segment",
+            segment_ids,
+        ):
+            term_segments[term].append(np.frombuffer(blob, dtype=np.int32))
+        merged_segment = self._next_segment(db)
+        merged = []
+        for term, blobs in term_segments.items():
+            postings = np.concatenate(blobs).reshape(-1, 3)
+            postings = postings[~np.isin(postings[:, 0], deleted)]
+            if len(postings) > 0:
+                merged.append((term, merged_segment, postings.tobytes()))
+        db.execute(
+            f"DELETE FROM postings WHERE segment IN ({placeholders})", segment_ids
+        )
+        db.execute(
+            f"DELETE FROM segments WHERE segment IN ({placeholders})", segment_ids
+        )
+        db.executemany("INSERT INTO postings VALUES (?, ?, ?)", merged)
+        db.execute(
+            "INSERT INTO segments VALUES (?, ?)",
+            (merged_segment, sum(num_nodes for _, num_nodes in segments)),
+        )
+
+    def _merge(self, db: sqlite3.Connection):
+        """
+        Merge the segments of every term into one and drop the deleted nodes.
+        """
+        logger.info("Merging the BM25 index segments")
+        deleted = self._get_deleted_rows(db)
+        merged = []
+        for term, postings in self._read_postings(db).items():
+            postings = postings[~np.isin(postings[:, 0], deleted)]
+            if len(postings) > 0:
+                merged.append((term, 0, postings.tobytes()))
+        db.execute("DELETE FROM postings")
+        db.executemany("INSERT INTO postings VALUES (?, ?, ?)", merged)
+        db.execute("DELETE FROM nodes WHERE deleted = 1")
+        db.execute("DELETE FROM segments")
+        db.execute(
+            "INSERT INTO segments VALUES (0, ?)", (self._get_stat(db, "num_nodes"),)
+        )
+        db.execute("DELETE FROM stats WHERE key = 'segments'")
+
+    def query(
+        self, query_str: str, top_k: int, filters: MetadataFilters | None = None
+    ) -> List[NodeWithScore]:
+        """
+        Get the top_k nodes for the query, only the nodes matching the filters are scored.
+        """
+        if not self.exists():
+            return []
+        terms = set(tokenize(query_str))
+        if len(terms) == 0:
+            return []
+        with self._connect() as db:
+            num_nodes = self._get_stat(db, "num_nodes")
+            if num_nodes == 0:
+                return []
+            avg_length = self._get_stat(db, "total_length") / num_nodes
+            deleted = self._get_deleted_rows(db)
+            allowed = None
+            if filters is not None:
+                clause, params = filters_to_sql(filters)
+                allowed = np.asarray(
+                    [
+                        r
+                        for (r,) in db.execute(
+                            f"SELECT row FROM nodes WHERE deleted = 0 AND ({clause})",
+                            params,
+                        )
+                    ],
+                    dtype=np.int32,
+                )
+            term_rows, term_scores = [], []
+            for postings in self._read_postings(db, terms).values():
+                postings = postings[~np.isin(postings[:, 0], deleted)]
+                if allowed is not None:
+                    postings = postings[np.isin(postings[:, 0], allowed)]
+                if len(postings) == 0:
+                    continue
+                idf = math.log(
+                    1 + (num_nodes - len(postings) + 0.5) / (len(postings) + 0.5)
+                )
+                tf = postings[:, 1].astype(np.float32)
+                norm = self.k1 * (1 - self.b + self.b * postings[:, 2] / avg_length)
+                term_rows.append(postings[:, 0])
+                term_scores.append(idf * tf * (self.k1 + 1) / (tf + norm))
+            if len(term_rows) == 0:
+                return []
+
+            # Sum the scores of the terms per node and keep the top k
+            rows, inverse = np.unique(np.concatenate(term_rows), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(term_scores))
+            top = np.argsort(-scores)[:top_k]
+            best = [(int(rows[i]), float(scores[i])) for i in top]
+            metadata = dict(
+                db.execute(
+                    "SELECT row, metadata FROM nodes "
+                    f"WHERE row IN ({','.join('?' * len(best))})",
+                    [row for row, _ in best],
+                ).fetchall()
+            )
+        return [
+            NodeWithScore(
+                node=metadata_dict_to_node(json.loads(metadata[row])), score=score
+            )
+            for row, score in best
+        ]
+
+
+def get_bm25_index() -> BM25Index:
+    storage_dir = versioned_name(os.getenv("STORAGE_DIR", "storage/context"))
+    return BM25Index(path=os.path.join(storage_dir, "bm25.sqlite"))
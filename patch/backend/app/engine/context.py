@@ -0,0 +1,170 @@
+import os
+import re
+import logging
+from typing import List, Optional, Tuple
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle, TextNode
+from llama_index.core.settings import Settings
+from app.engine.bm25 import tokenize
+from app.metrics import CONTEXT_TOKENS_SAVED, set_trace_attribute
+
+logger = logging.getLogger("uvicorn")
+
+# Split the texts into sentences, or lines for tabular texts like CSV rows
+SENTENCE_PATTERN = re.compile(r"[^\n.!?]+(?:[.!?]+(?=\s|$)|\n|$)")
+
+
+def count_tokens(text: str) -> int:
+    return len(Settings.tokenizer(text))
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in SENTENCE_PATTERN.findall(text) if s.strip()]
+
+
+class ContextCompressor(BaseNodePostprocessor):
+    """
+    Fit the retrieved nodes into a token budget: the sentences repeated by overlapping
+    chunks are removed, then the sentences sharing the most terms with the query are kept
+    first, in the order of the nodes. The other sentences fill the remaining budget.
+    """
+
+    token_budget: int = Field(description="The maximum number of context tokens.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextCompressor"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if len(nodes) == 0:
+            return nodes
+        query_terms = set(tokenize(query_bundle.query_str)) if query_bundle else set()
+
+        # (priority, node index, sentence index, sentence, tokens)
+        candidates: List[Tuple[int, int, int, str, int]] = []
+        seen = set()
+        separators = []
+        original_tokens = 0
+        for node_index, node in enumerate(nodes):
+            text = node.node.get_content(metadata_mode=MetadataMode.NONE)
+            original_tokens += count_tokens(text)
+            # Keep the rows of tabular texts on separate lines
+            separators.append("\n" if text.count("\n") > text.count(". ") else " ")
+            for sentence_index, sentence in enumerate(split_sentences(text)):
+                key = " ".join(tokenize(sentence))
+                if key in seen:
+                    continue
+                seen.add(key)
+                overlap = len(query_terms.intersection(tokenize(sentence)))
+                candidates.append(
+                    (
+                        -overlap,
+                        node_index,
+                        sentence_index,
+                        sentence,
+                        count_tokens(sentence),
+                    )
+                )
+
+        kept: List[List[Tuple[int, str]]] = [[] for _ in nodes]
+        used_tokens = 0
+        for _, node_index, sentence_index, sentence, tokens in sorted(candidates):
+            if used_tokens + tokens > self.token_budget:
+                continue
+            kept[node_index].append((sentence_index, sentence))
+            used_tokens += tokens
+
+        result = []
+        for node, sentences, separator in zip(nodes, kept, separators):
+            if len(sentences) == 0:
+                continue
+            text = separator.join(sentence for _, sentence in sorted(sentences))
+            compressed = TextNode(
+                id_=node.node.node_id,
+                text=text,
+                metadata=node.node.metadata,
+                excluded_llm_metadata_keys=node.node.excluded_llm_metadata_keys,
+                excluded_embed_metadata_keys=node.node.excluded_embed_metadata_keys,
+                relationships=node.node.relationships,
+            )
+            result.append(NodeWithScore(node=compressed, score=node.score))
+
+        saved = max(original_tokens - used_tokens, 0)
+        CONTEXT_TOKENS_SAVED.inc(saved, part="context")
+        set_trace_attribute("context_tokens_saved", saved)
+        return result
+
+
+def trim_chat_history(
+    messages: List[ChatMessage], token_budget: int
+) -> Tuple[List[ChatMessage], int]:
+    """
+    Keep the most recent messages that fit into the token budget, starting with
+    a user message. The leading system messages, e.g. the summary of a chat session,
+    are always kept. Returns the kept messages and the number of tokens saved.
+    """
+    tokens = [count_tokens(str(message.content or "")) for message in messages]
+    prefix = 0
+    while prefix < len(messages) and messages[prefix].role == MessageRole.SYSTEM:
+        prefix += 1
+    start = len(messages)
+    used_tokens = sum(tokens[:prefix])
+    while start > prefix and used_tokens + tokens[start - 1] <= token_budget:
+        start -= 1
+        used_tokens += tokens[start]
+    while start < len(messages) and messages[start].role != MessageRole.USER:
+        used_tokens -= tokens[start]
+        start += 1
+    return messages[:prefix] + messages[start:], sum(tokens) - used_tokens
+
+
+class TokenBudgetChatEngine:
+    """
+    Wrap a chat engine to trim the chat history to the HISTORY_TOKEN_BUDGET
+    before it is condensed or sent to the LLM.
+    """
+
+    def __init__(self, chat_engine, history_token_budget: int):
+        self._chat_engine = chat_engine
+        self._history_token_budget = history_token_budget
+
+    def __getattr__(self, name):
+        return getattr(self._chat_engine, name)
+
+    def _trim(self, chat_history: Optional[List[ChatMessage]]):
+        if not chat_history:
+            return chat_history
+        chat_history, saved = trim_chat_history(
+            chat_history, self._history_token_budget
+        )
+        CONTEXT_TOKENS_SAVED.inc(saved, part="history")
+        set_trace_attribute("history_tokens_saved", saved)
+        return chat_history
+
+    def chat(self, message: str, chat_history=None):
+        return self._chat_engine.chat(message, self._trim(chat_history))
+
+    def stream_chat(self, message: str, chat_history=None):
+        return self._chat_engine.stream_chat(message, self._trim(chat_history))
+
+    async def achat(self, message: str, chat_history=None):
+        return await self._chat_engine.achat(message, self._trim(chat_history))
+
+    async def astream_chat(self, message: str, chat_history=None):
+        return await self._chat_engine.astream_chat(message, self._trim(chat_history))
+
+
+def get_context_budget() -> int | None:
+    budget = os.getenv("CONTEXT_TOKEN_BUDGET")
+    return int(budget) if budget else None
+
+
+def get_history_budget() -> int | None:
+    budget = os.getenv("HISTORY_TOKEN_BUDGET")
+    return int(budget) if budget else None
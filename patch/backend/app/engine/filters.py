@@ -0,0 +1,185 @@
+import os
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Optional
+from pydantic import BaseModel, field_validator
+from llama_index.core.vector_stores.types import (
+    FilterCondition,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+)
+
+# The metadata of the nodes the chat requests can be filtered on
+FILE_NAME_KEY = "file_name"
+FILE_EXTENSION_KEY = "file_extension"
+UPLOADED_AT_KEY = "uploaded_at"
+FILTER_METADATA_KEYS = [FILE_EXTENSION_KEY, UPLOADED_AT_KEY]
+
+SQL_OPERATORS = {
+    FilterOperator.EQ: "=",
+    FilterOperator.NE: "!=",
+    FilterOperator.GT: ">",
+    FilterOperator.LT: "<",
+    FilterOperator.GTE: ">=",
+    FilterOperator.LTE: "<=",
+    FilterOperator.IN: "IN",
+    FilterOperator.NIN: "NOT IN",
+}
+
+CHROMA_OPERATORS = {
+    FilterOperator.EQ: "$eq",
+    FilterOperator.NE: "$ne",
+    FilterOperator.GT: "$gt",
+    FilterOperator.LT: "$lt",
+    FilterOperator.GTE: "$gte",
+    FilterOperator.LTE: "$lte",
+    FilterOperator.IN: "$in",
+    FilterOperator.NIN: "$nin",
+}
+
+# The filters of the chat request handled in the current context
+_chat_filters: contextvars.ContextVar[MetadataFilters | None] = contextvars.ContextVar(
+    "chat_filters", default=None
+)
+
+
+class ChatFilters(BaseModel):
+    """
+    Scope the question of a chat request to a subset of the documents.
+    The conditions are combined with AND, a file matches a list if it is in it.
+    """
+
+    file_names: Optional[List[str]] = None
+    extensions: Optional[List[str]] = None
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+
+    @field_validator("extensions")
+    @classmethod
+    def normalize_extensions(cls, extensions):
+        if extensions is None:
+            return None
+        return [extension.lstrip(".").lower() for extension in extensions]
+
+    def to_metadata_filters(self) -> MetadataFilters | None:
+        filters = []
+        if self.file_names is not None:
+            filters.append(
+                MetadataFilter(
+                    key=FILE_NAME_KEY, value=self.file_names, operator=FilterOperator.IN
+                )
+            )
+        if self.extensions is not None:
+            filters.append(
+                MetadataFilter(
+                    key=FILE_EXTENSION_KEY,
+                    value=self.extensions,
+                    operator=FilterOperator.IN,
+                )
+            )
+        if self.uploaded_after is not None:
+            filters.append(
+                MetadataFilter(
+                    key=UPLOADED_AT_KEY,
+                    value=self.uploaded_after.timestamp(),
+                    operator=FilterOperator.GTE,
+                )
+            )
+        if self.uploaded_before is not None:
+            filters.append(
+                MetadataFilter(
+                    key=UPLOADED_AT_KEY,
+                    value=self.uploaded_before.timestamp(),
+                    operator=FilterOperator.LTE,
+                )
+            )
+        if len(filters) == 0:
+            return None
+        return MetadataFilters(filters=filters, condition=FilterCondition.AND)
+
+
+@contextmanager
+def use_chat_filters(filters: MetadataFilters | None):
+    """
+    Apply the filters to the retrievers created in the current context.
+    """
+    token = _chat_filters.set(filters)
+    try:
+        yield
+    finally:
+        _chat_filters.reset(token)
+
+
+def get_chat_filters() -> MetadataFilters | None:
+    return _chat_filters.get()
+
+
+def add_filter_metadata(documents, file_path: str):
+    """
+    Add the metadata the chat requests can be filtered on to the documents of a file.
+    It is left out of the embedded and the LLM text, so it doesn't change the embeddings.
+    """
+    extension = file_path.split(".")[-1].lower()
+    uploaded_at = os.path.getmtime(file_path)
+    for document in documents:
+        document.metadata[FILE_EXTENSION_KEY] = extension
+        document.metadata[UPLOADED_AT_KEY] = uploaded_at
+        for excluded_keys in (
+            document.excluded_embed_metadata_keys,
+            document.excluded_llm_metadata_keys,
+        ):
+            excluded_keys.extend(
+                key for key in FILTER_METADATA_KEYS if key not in excluded_keys
+            )
+
+
+def filters_to_sql(filters: MetadataFilters, column: str = "metadata"):
+    """
+    Translate the filters to a SQLite condition on the JSON metadata column.
+    """
+    clauses, params = [], []
+    for metadata_filter in filters.filters:
+        if isinstance(metadata_filter, MetadataFilters):
+            clause, filter_params = filters_to_sql(metadata_filter, column)
+            clauses.append(f"({clause})")
+            params.extend(filter_params)
+            continue
+        operator = SQL_OPERATORS.get(metadata_filter.operator)
+        if operator is None:
+            raise ValueError(f"Unsupported filter operator: {metadata_filter.operator}")
+        value = f"json_extract({column}, ?)"
+        params.append(f'$."{metadata_filter.key}"')
+        if metadata_filter.operator in (FilterOperator.IN, FilterOperator.NIN):
+            values = list(metadata_filter.value)
+            clauses.append(f"{value} {operator} ({','.join('?' * len(values))})")
+            params.extend(values)
+        else:
+            clauses.append(f"{value} {operator} ?")
+            params.append(metadata_filter.value)
+    condition = " OR " if filters.condition == FilterCondition.OR else " AND "
+    return condition.join(clauses), params
+
+
+def filters_to_chroma_where(filters: MetadataFilters) -> dict:
+    """
+    Translate the filters to a Chroma where clause, including the IN operators
+    and nested filters that the Chroma vector store of llama-index doesn't support.
+    """
+    clauses = []
+    for metadata_filter in filters.filters:
+        if isinstance(metadata_filter, MetadataFilters):
+            clauses.append(filters_to_chroma_where(metadata_filter))
+            continue
+        operator = CHROMA_OPERATORS.get(metadata_filter.operator)
+        if operator is None:
+            raise ValueError(f"Unsupported filter operator: {metadata_filter.operator}")
+        value = metadata_filter.value
+        if metadata_filter.operator in (FilterOperator.IN, FilterOperator.NIN):
+            value = list(value)
+        clauses.append({metadata_filter.key: {operator: value}})
+    if len(clauses) == 1:
+        return clauses[0]
+    condition = "$or" if filters.condition == FilterCondition.OR else "$and"
+    return {condition: clauses}
@@ -0,0 +1,134 @@
+import os
+import json
+import logging
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger("uvicorn")
+
+# The environment variables that change the embeddings stored in the index
+EMBEDDING_ENV_VARS = [
+    "MODEL_PROVIDER",
+    "EMBEDDING_MODEL",
+    "EMBEDDING_DIM",
+    "OLLAMA_BASE_URL",
+]
+
+# The version built by the indexing running in the current context
+_building_version: contextvars.ContextVar[int | None] = contextvars.ContextVar(
+    "building_index_version", default=None
+)
+# The embedding models of the previous configs, to query an index built with them
+_embed_models: Dict[Tuple, object] = {}
+
+
+def get_active_index_file() -> str:
+    return os.getenv("ACTIVE_INDEX_FILE", "storage/active_index.json")
+
+
+def read_active_index() -> Dict:
+    """
+    Read the pointer to the index served to the chat:
+    {"version": int, "embedding": list | None, "retired": list}
+    Version 0 is the index stored under the unversioned names.
+    """
+    try:
+        with open(get_active_index_file(), "r") as f:
+            active_index = json.load(f)
+    except FileNotFoundError:
+        active_index = {}
+    active_index.setdefault("version", 0)
+    active_index.setdefault("embedding", None)
+    active_index.setdefault("retired", [])
+    return active_index
+
+
+def write_active_index(active_index: Dict):
+    """
+    Replace the pointer atomically, the caller must hold the indexing lock.
+    """
+    path = get_active_index_file()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(active_index, f)
+    os.replace(tmp_path, path)
+
+
+def get_embedding_key() -> List[str | None]:
+    return [os.getenv(name) for name in EMBEDDING_ENV_VARS]
+
+
+def get_index_version() -> int:
+    """
+    The version being built by the current indexing run, otherwise the active version.
+    """
+    version = _building_version.get()
+    return read_active_index()["version"] if version is None else version
+
+
+def versioned_name(name: str, version: int | None = None) -> str:
+    """
+    The name of a collection or storage path for an index version.
+    """
+    version = get_index_version() if version is None else version
+    return name if version == 0 else f"{name}_v{version}"
+
+
+@contextmanager
+def building_version(version: int):
+    """
+    Make the vector store and storage functions use the given version
+    in the current context only, the chat keeps using the active version.
+    """
+    token = _building_version.set(version)
+    try:
+        yield
+    finally:
+        _building_version.reset(token)
+
+
+def activate_version(version: int, retired: List[int]):
+    """
+    Switch the chat to the given version, the retired versions are removed later.
+    """
+    write_active_index(
+        {"version": version, "embedding": get_embedding_key(), "retired": retired}
+    )
+    logger.info(f"Activated index version {version}")
+
+
+def remember_embed_model():
+    """
+    Keep the current embedding model before the config is changed, so the active index
+    can still be queried with it while the index of the new config is being built.
+    """
+    from llama_index.core.settings import Settings
+
+    # Don't resolve the default model if none is configured
+    if Settings._embed_model is None:
+        return
+    _embed_models[tuple(get_embedding_key())] = Settings._embed_model
+    active_index = read_active_index()
+    if active_index["embedding"] is None:
+        # The index was built before the versions were recorded
+        active_index["embedding"] = get_embedding_key()
+        write_active_index(active_index)
+
+
+def get_query_embed_model():
+    """
+    The embedding model the active index was built with,
+    or None if it is the one of the current config.
+    """
+    embedding = read_active_index()["embedding"]
+    if embedding is None or embedding == get_embedding_key():
+        return None
+    embed_model = _embed_models.get(tuple(embedding))
+    if embed_model is None:
+        logger.warning(
+            "The active index was built with another embedding model, "
+            "using the current one until the index is rebuilt"
+        )
+    return embed_model
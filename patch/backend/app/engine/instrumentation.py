@@ -0,0 +1,184 @@
+import os
+import time
+import asyncio
+from typing import Any, List
+from llama_index.core.chat_engine import CondensePlusContextChatEngine
+from llama_index.core.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.core.llms import ChatMessage
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.tools.types import AsyncBaseTool, BaseTool, ToolMetadata
+from llama_index.core.vector_stores.types import BasePydanticVectorStore
+from app.metrics import (
+    TOOL_CALL_SECONDS,
+    VECTOR_STORE_QUERY_SECONDS,
+    add_to_trace,
+    record_stage,
+    timed_stage,
+)
+
+
+class InstrumentedCondensePlusContextChatEngine(CondensePlusContextChatEngine):
+    """
+    Context chat engine recording the time spent to condense the question
+    and to retrieve the context.
+    """
+
+    def _condense_question(
+        self, chat_history: List[ChatMessage], latest_message: str
+    ) -> str:
+        from app.engine.session import get_session_turn
+
+        turn = get_session_turn()
+        if turn is not None and turn.condensed_query is not None:
+            # Already condensed by the semantic cache
+            return turn.condensed_query
+        if turn is not None and turn.condense_history is not None:
+            chat_history = turn.condense_history
+        with timed_stage("condense"):
+            condensed_query = super()._condense_question(chat_history, latest_message)
+        if turn is not None:
+            turn.condensed_query = condensed_query
+        return condensed_query
+
+    async def _acondense_question(
+        self, chat_history: List[ChatMessage], latest_message: str
+    ) -> str:
+        from app.engine.session import get_session_turn
+
+        turn = get_session_turn()
+        if turn is not None and turn.condensed_query is not None:
+            # Already condensed by the semantic cache
+            return turn.condensed_query
+        if turn is not None and turn.condense_history is not None:
+            # Condense from the previous question of the chat session
+            chat_history = turn.condense_history
+        with timed_stage("condense"):
+            condensed_query = await super()._acondense_question(
+                chat_history, latest_message
+            )
+        if turn is not None:
+            turn.condensed_query = condensed_query
+        return condensed_query
+
+    def _retrieve_context(self, message: str):
+        with timed_stage("retrieve"):
+            return super()._retrieve_context(message)
+
+    async def _aretrieve_context(self, message: str):
+        with timed_stage("retrieve"):
+            return await super()._aretrieve_context(message)
+
+
+class InstrumentedVectorIndexRetriever(VectorIndexRetriever):
+    """
+    Vector retriever recording the time to embed the query and the round-trip
+    to the vector store separately.
+    """
+
+    def _observe_query(self, seconds: float):
+        provider = os.getenv("VECTOR_STORE_PROVIDER", "chroma")
+        VECTOR_STORE_QUERY_SECONDS.observe(seconds, provider=provider)
+        add_to_trace("vector_store", seconds)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with timed_stage("vector_retrieve"):
+            return super()._retrieve(query_bundle)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with timed_stage("vector_retrieve"):
+            return await super()._aretrieve(query_bundle)
+
+    def _get_nodes_with_embeddings(
+        self, query_bundle_with_embeddings: QueryBundle
+    ) -> List[NodeWithScore]:
+        start = time.perf_counter()
+        try:
+            return super()._get_nodes_with_embeddings(query_bundle_with_embeddings)
+        finally:
+            self._observe_query(time.perf_counter() - start)
+
+    async def _aget_nodes_with_embeddings(
+        self, query_bundle_with_embeddings: QueryBundle
+    ) -> List[NodeWithScore]:
+        start = time.perf_counter()
+        try:
+            if type(self._vector_store).aquery is BasePydanticVectorStore.aquery:
+                # The store has no async client, don't block the event loop with it
+                return await asyncio.to_thread(
+                    super()._get_nodes_with_embeddings, query_bundle_with_embeddings
+                )
+            return await super()._aget_nodes_with_embeddings(
+                query_bundle_with_embeddings
+            )
+        finally:
+            self._observe_query(time.perf_counter() - start)
+
+
+class InstrumentedTool(AsyncBaseTool):
+    """
+    Wrap a tool of the agent to record the duration of its calls.
+    """
+
+    def __init__(self, tool: BaseTool):
+        self._tool = tool
+
+    @property
+    def metadata(self) -> ToolMetadata:
+        return self._tool.metadata
+
+    def _observe(self, seconds: float):
+        name = self._tool.metadata.name or "unknown"
+        TOOL_CALL_SECONDS.observe(seconds, tool=name)
+        add_to_trace(f"tool:{name}", seconds)
+
+    def call(self, *args: Any, **kwargs: Any):
+        start = time.perf_counter()
+        try:
+            return self._tool(*args, **kwargs)
+        finally:
+            self._observe(time.perf_counter() - start)
+
+    async def acall(self, *args: Any, **kwargs: Any):
+        start = time.perf_counter()
+        try:
+            if isinstance(self._tool, AsyncBaseTool):
+                return await self._tool.acall(*args, **kwargs)
+            return self._tool(*args, **kwargs)
+        finally:
+            self._observe(time.perf_counter() - start)
+
+
+class TracedChatEngine:
+    """
+    Wrap a chat engine to record the time to the first token of the answer
+    and the time to generate the rest of it.
+    """
+
+    def __init__(self, chat_engine):
+        self._chat_engine = chat_engine
+
+    def __getattr__(self, name):
+        return getattr(self._chat_engine, name)
+
+    async def astream_chat(self, message: str, chat_history=None):
+        start = time.perf_counter()
+        response = await self._chat_engine.astream_chat(message, chat_history)
+        prepared = time.perf_counter()
+        record_stage("prepare", prepared - start)
+        response_gen = response.async_response_gen
+
+        async def timed_response_gen():
+            first_token = None
+            async for token in response_gen():
+                if first_token is None:
+                    first_token = time.perf_counter()
+                    record_stage("first_token", first_token - start)
+                yield token
+            record_stage("generate", time.perf_counter() - prepared)
+
+        response.async_response_gen = timed_response_gen
+        return response
+
+    async def achat(self, message: str, chat_history=None):
+        with timed_stage("chat"):
+            return await self._chat_engine.achat(message, chat_history)
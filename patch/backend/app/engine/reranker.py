@@ -0,0 +1,156 @@
+import os
+import math
+import asyncio
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Callable, Dict, List
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from app.engine.bm25 import tokenize
+from app.metrics import record_stage, timed_stage
+
+logger = logging.getLogger("uvicorn")
+
+# Scores the texts for a query, a higher score is more relevant
+ScoreFn = Callable[[str, List[str]], List[float]]
+
+# Bounds the CPU used for reranking, the requests over it fall back to the retrieval order
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("RERANK_WORKERS", "2")), thread_name_prefix="reranker"
+)
+_cross_encoders: Dict[str, object] = {}
+_cross_encoders_lock = threading.Lock()
+
+
+def lexical_scores(query: str, texts: List[str], k1=1.2, b=0.75) -> List[float]:
+    """
+    BM25 scores of the texts with the statistics of the candidates only.
+    """
+    query_terms = set(tokenize(query))
+    docs = [Counter(tokenize(text)) for text in texts]
+    lengths = [sum(doc.values()) for doc in docs]
+    avg_length = (sum(lengths) / len(lengths)) or 1
+    idf = {}
+    for term in query_terms:
+        df = sum(1 for doc in docs if term in doc)
+        idf[term] = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+    scores = []
+    for doc, length in zip(docs, lengths):
+        norm = k1 * (1 - b + b * length / avg_length)
+        scores.append(
+            sum(
+                idf[term] * doc[term] * (k1 + 1) / (doc[term] + norm)
+                for term in query_terms
+                if term in doc
+            )
+        )
+    return scores
+
+
+def get_cross_encoder_scores(model_name: str) -> ScoreFn:
+    """
+    Score with a local cross-encoder model, requires sentence-transformers.
+    """
+    from sentence_transformers import CrossEncoder
+
+    with _cross_encoders_lock:
+        if model_name not in _cross_encoders:
+            _cross_encoders[model_name] = CrossEncoder(model_name)
+        model = _cross_encoders[model_name]
+    batch_size = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+
+    def cross_encoder_scores(query: str, texts: List[str]) -> List[float]:
+        pairs = [(query, text) for text in texts]
+        return model.predict(pairs, batch_size=batch_size).tolist()
+
+    return cross_encoder_scores
+
+
+class RerankingRetriever(BaseRetriever):
+    """
+    Over-retrieve candidates, rescore them on the reranker thread pool and keep the top_n.
+    If the rescoring takes longer than the timeout, the top_n candidates
+    are kept in retrieval order, so reranking never adds more than the timeout.
+    """
+
+    def __init__(
+        self,
+        retriever: BaseRetriever,
+        score_fn: ScoreFn,
+        top_n: int,
+        timeout: float,
+        fuse_with_retrieval_order: bool = False,
+        rrf_k: int = 60,
+    ):
+        super().__init__()
+        self._retriever = retriever
+        self._score_fn = score_fn
+        self._top_n = top_n
+        self._timeout = timeout
+        self._fuse = fuse_with_retrieval_order
+        self._rrf_k = rrf_k
+
+    def _rerank(self, query: str, nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        texts = [
+            node.node.get_content(metadata_mode=MetadataMode.NONE) for node in nodes
+        ]
+        scores = self._score_fn(query, texts)
+        if self._fuse:
+            # The lexical scores don't capture the semantic similarity,
+            # so combine the lexical ranking with the retrieval ranking
+            lexical_order = sorted(range(len(nodes)), key=lambda i: -scores[i])
+            fused = [1 / (self._rrf_k + rank + 1) for rank in range(len(nodes))]
+            for rank, i in enumerate(lexical_order):
+                fused[i] += 1 / (self._rrf_k + rank + 1)
+            scores = fused
+        best = sorted(range(len(nodes)), key=lambda i: -scores[i])[: self._top_n]
+        return [NodeWithScore(node=nodes[i].node, score=scores[i]) for i in best]
+
+    def _fallback(self, nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        logger.warning(
+            f"Reranking exceeded {self._timeout:.3f}s, using the retrieval order"
+        )
+        record_stage("rerank_timeout", self._timeout)
+        return nodes[: self._top_n]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = self._retriever.retrieve(query_bundle)
+        if len(nodes) <= self._top_n:
+            return nodes
+        future = _executor.submit(self._rerank, query_bundle.query_str, nodes)
+        try:
+            with timed_stage("rerank"):
+                return future.result(timeout=self._timeout)
+        except TimeoutError:
+            future.cancel()
+            return self._fallback(nodes)
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = await self._retriever.aretrieve(query_bundle)
+        if len(nodes) <= self._top_n:
+            return nodes
+        future = asyncio.get_running_loop().run_in_executor(
+            _executor, self._rerank, query_bundle.query_str, nodes
+        )
+        try:
+            with timed_stage("rerank"):
+                return await asyncio.wait_for(future, timeout=self._timeout)
+        except asyncio.TimeoutError:
+            return self._fallback(nodes)
+
+
+def get_reranker_config():
+    """
+    Get the configured reranker as (score function, fuse with retrieval order),
+    or None if reranking is disabled.
+    """
+    reranker = os.getenv("RERANKER") or "none"
+    if reranker == "none":
+        return None
+    if reranker == "lexical":
+        return lexical_scores, True
+    if reranker.startswith("cross-encoder:"):
+        return get_cross_encoder_scores(reranker.split(":", 1)[1]), False
+    raise ValueError(f"Unsupported reranker: {reranker}")
@@ -0,0 +1,117 @@
+import os
+import asyncio
+from typing import Dict, List
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import MetadataFilters
+from app.engine.bm25 import BM25Index, get_bm25_index
+from app.engine.filters import get_chat_filters
+from app.engine.instrumentation import InstrumentedVectorIndexRetriever
+from app.engine.reranker import RerankingRetriever, get_reranker_config
+from app.metrics import timed_stage
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retrieve nodes by vector similarity and by BM25 and fuse both rankings
+    with reciprocal rank fusion, so exact identifiers are found as well.
+    """
+
+    def __init__(
+        self,
+        vector_retriever: BaseRetriever,
+        bm25_index: BM25Index,
+        top_k: int,
+        rrf_k: int = 60,
+        filters: MetadataFilters | None = None,
+    ):
+        super().__init__()
+        self._vector_retriever = vector_retriever
+        self._bm25_index = bm25_index
+        self._top_k = top_k
+        self._rrf_k = rrf_k
+        self._filters = filters
+
+    def _fuse(self, rankings: List[List[NodeWithScore]]) -> List[NodeWithScore]:
+        scores: Dict[str, float] = {}
+        nodes: Dict[str, NodeWithScore] = {}
+        for ranking in rankings:
+            for rank, node in enumerate(ranking):
+                node_id = node.node.node_id
+                scores[node_id] = scores.get(node_id, 0.0) + 1 / (
+                    self._rrf_k + rank + 1
+                )
+                nodes.setdefault(node_id, node)
+        best = sorted(scores, key=lambda node_id: -scores[node_id])[: self._top_k]
+        return [NodeWithScore(node=nodes[i].node, score=scores[i]) for i in best]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        vector_nodes = self._vector_retriever.retrieve(query_bundle)
+        bm25_nodes = self._query_bm25(query_bundle)
+        return self._fuse([vector_nodes, bm25_nodes])
+
+    def _query_bm25(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        with timed_stage("bm25"):
+            return self._bm25_index.query(
+                query_bundle.query_str, self._top_k, self._filters
+            )
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        # Query both indexes concurrently, the BM25 index is read off the event loop
+        vector_nodes, bm25_nodes = await asyncio.gather(
+            self._vector_retriever.aretrieve(query_bundle),
+            asyncio.to_thread(self._query_bm25, query_bundle),
+        )
+        return self._fuse([vector_nodes, bm25_nodes])
+
+
+def get_vector_retriever(
+    index, top_k: int, filters: MetadataFilters | None = None
+) -> BaseRetriever:
+    """
+    Same as index.as_retriever() but records the latency of the vector store queries.
+    """
+    return InstrumentedVectorIndexRetriever(
+        index,
+        node_ids=list(index.index_struct.nodes_dict.values()),
+        callback_manager=index._callback_manager,
+        object_map=index._object_map,
+        similarity_top_k=top_k,
+        filters=filters,
+    )
+
+
+def _get_base_retriever(index, top_k: int) -> BaseRetriever:
+    retrieval_mode = os.getenv("RETRIEVAL_MODE", "vector")
+    # The filters of the chat request, applied by the vector store and the BM25 index
+    filters = get_chat_filters()
+    if retrieval_mode == "hybrid":
+        return HybridRetriever(
+            vector_retriever=get_vector_retriever(index, top_k, filters),
+            bm25_index=get_bm25_index(),
+            top_k=top_k,
+            filters=filters,
+        )
+    if retrieval_mode != "vector":
+        raise ValueError(f"Unsupported retrieval mode: {retrieval_mode}")
+    return get_vector_retriever(index, top_k, filters)
+
+
+def get_retriever(index, top_k: int) -> BaseRetriever:
+    """
+    Get the retriever for the configured RETRIEVAL_MODE ("vector" or "hybrid").
+    If a RERANKER is configured, RERANK_CANDIDATES nodes are retrieved
+    and reranked to keep the best top_k.
+    """
+    reranker_config = get_reranker_config()
+    if reranker_config is None:
+        return _get_base_retriever(index, top_k)
+    score_fn, fuse = reranker_config
+    candidates = max(int(os.getenv("RERANK_CANDIDATES", "30")), top_k)
+    return RerankingRetriever(
+        retriever=_get_base_retriever(index, candidates),
+        score_fn=score_fn,
+        top_n=top_k,
+        timeout=float(os.getenv("RERANK_TIMEOUT_MS", "200")) / 1000,
+        fuse_with_retrieval_order=fuse,
+    )
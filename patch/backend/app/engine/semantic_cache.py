@@ -0,0 +1,299 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, Generator, List, Optional
+import numpy as np
+from llama_index.core.settings import Settings
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.chat_engine.types import AgentChatResponse
+from llama_index.core.schema import NodeWithScore
+from app.metrics import timed_stage
+
+logger = logging.getLogger("uvicorn")
+
+CONDENSE_PROMPT = """
+Given the following conversation between a user and an AI assistant and a follow up question from user,
+rephrase the follow up question to be a standalone question.
+
+Chat History:
+{chat_history}
+Follow Up Input: {question}
+Standalone question:"""
+
+
+@dataclass
+class CacheEntry:
+    question: str
+    embedding: np.ndarray
+    answer: str
+    source_nodes: List[NodeWithScore]
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class SemanticCache:
+    """
+    An in-process cache of chat answers looked up by the similarity of the questions.
+    The normalized question embeddings are kept in a matrix, so a lookup is a single
+    matrix-vector product, exact and faster than an ANN structure at this size.
+    Entries are evicted by LRU order and by TTL.
+    """
+
+    def __init__(
+        self, max_size: int = 1000, ttl: float = 3600, threshold: float = 0.95
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries: OrderedDict[int, CacheEntry] = OrderedDict()
+        self._next_id = 0
+        self._matrix: np.ndarray | None = None
+        self._matrix_ids: List[int] = []
+        self._lock = threading.Lock()
+        # Incremented on every clear so answers of a stale index are never added
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_latency = 0.0
+        self.miss_latency = 0.0
+
+    def lookup(self, embedding: np.ndarray) -> Optional[CacheEntry]:
+        with self._lock:
+            self._evict_expired()
+            if len(self._entries) == 0:
+                return None
+            if self._matrix is None:
+                self._matrix_ids = list(self._entries.keys())
+                self._matrix = np.stack(
+                    [entry.embedding for entry in self._entries.values()]
+                )
+            scores = self._matrix @ embedding
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            entry_id = self._matrix_ids[best]
+            self._entries.move_to_end(entry_id)
+            return self._entries[entry_id]
+
+    def add(self, entry: CacheEntry, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[self._next_id] = entry
+            self._next_id += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [
+            entry_id
+            for entry_id, entry in self._entries.items()
+            if now - entry.created_at > self.ttl
+        ]
+        for entry_id in expired:
+            self._entries.pop(entry_id)
+        if len(expired) > 0:
+            self._matrix = None
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._matrix = None
+
+    def record(self, hit: bool, latency: float):
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.hit_latency += latency
+            else:
+                self.misses += 1
+                self.miss_latency += latency
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            avg_hit_latency = self.hit_latency / self.hits if self.hits else 0.0
+            avg_miss_latency = self.miss_latency / self.misses if self.misses else 0.0
+            return {
+                "enabled": is_semantic_cache_enabled(),
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "avg_hit_latency": avg_hit_latency,
+                "avg_miss_latency": avg_miss_latency,
+                "saved_seconds": max(avg_miss_latency - avg_hit_latency, 0.0)
+                * self.hits,
+            }
+
+
+class CachedStreamingResponse:
+    """
+    Replay a cached answer with the interface of a streaming chat response.
+    """
+
+    def __init__(self, answer: str, source_nodes: List[NodeWithScore]):
+        self.response = answer
+        self.source_nodes = source_nodes
+        self.sources = []
+
+    def _tokens(self) -> List[str]:
+        # Stream word by word, keeping the whitespace so the tokens join to the answer
+        return re.findall(r"\s*\S+\s*", self.response)
+
+    def response_gen(self) -> Generator[str, None, None]:
+        yield from self._tokens()
+
+    async def async_response_gen(self) -> AsyncGenerator[str, None]:
+        for token in self._tokens():
+            yield token
+
+
+class SemanticCacheChatEngine:
+    """
+    Serve the answers of similar questions from the semantic cache and otherwise
+    delegate to the wrapped chat engine and cache its answer.
+    """
+
+    def __init__(self, chat_engine, cache: SemanticCache):
+        self._chat_engine = chat_engine
+        self._cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._chat_engine, name)
+
+    async def _condense_question(
+        self, message: str, chat_history: Optional[List[ChatMessage]]
+    ) -> str:
+        from app.engine.session import get_session_turn
+
+        turn = get_session_turn()
+        if turn is not None and turn.condense_history is not None:
+            # Condense from the summary and the previous question of the chat session,
+            # as the chat engine does
+            chat_history = turn.condense_history
+        if not chat_history:
+            return message
+        # The system messages hold the summary of a chat session
+        history = "\n".join(
+            f"{m.role.value}: {m.content}"
+            for m in chat_history
+            if m.role in (MessageRole.SYSTEM, MessageRole.USER, MessageRole.ASSISTANT)
+        )
+        completion = await Settings.llm.acomplete(
+            CONDENSE_PROMPT.format(chat_history=history, question=message)
+        )
+        return completion.text.strip()
+
+    @staticmethod
+    async def _embed_question(question: str) -> np.ndarray:
+        embedding = np.asarray(
+            await Settings.embed_model.aget_query_embedding(question),
+            dtype=np.float32,
+        )
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+
+    async def _lookup(self, message: str, chat_history: Optional[List[ChatMessage]]):
+        """
+        Condense the question and look it up. Returns the condensed question,
+        its embedding and the cached entry if any.
+        """
+        from app.engine.session import get_session_turn
+
+        with timed_stage("semantic_cache"):
+            question = await self._condense_question(message, chat_history)
+            embedding = await self._embed_question(question)
+            entry = self._cache.lookup(embedding)
+        turn = get_session_turn()
+        if turn is not None:
+            # The chat engine and the chat session use the same condensed question
+            turn.condensed_query = question
+        return question, embedding, entry
+
+    @contextmanager
+    def _use_condensed_question(self, question: str):
+        """
+        Pass the condensed question to the chat engine, so it is not condensed again.
+        """
+        from app.engine.session import SessionTurn, get_session_turn, use_session_turn
+
+        if get_session_turn() is not None:
+            yield
+            return
+        with use_session_turn(SessionTurn(condensed_query=question)):
+            yield
+
+    async def astream_chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ):
+        start = time.perf_counter()
+        generation = self._cache.generation
+        question, embedding, entry = await self._lookup(message, chat_history)
+        if entry is not None:
+            self._cache.record(hit=True, latency=time.perf_counter() - start)
+            return CachedStreamingResponse(entry.answer, entry.source_nodes)
+
+        with self._use_condensed_question(question):
+            response = await self._chat_engine.astream_chat(message, chat_history)
+        response_gen = response.async_response_gen
+
+        async def caching_response_gen():
+            tokens = []
+            async for token in response_gen():
+                tokens.append(token)
+                yield token
+            answer = "".join(tokens)
+            self._cache.record(hit=False, latency=time.perf_counter() - start)
+            if answer.strip():
+                self._cache.add(
+                    CacheEntry(message, embedding, answer, response.source_nodes),
+                    generation,
+                )
+
+        response.async_response_gen = caching_response_gen
+        return response
+
+    async def achat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ):
+        start = time.perf_counter()
+        generation = self._cache.generation
+        question, embedding, entry = await self._lookup(message, chat_history)
+        if entry is not None:
+            self._cache.record(hit=True, latency=time.perf_counter() - start)
+            return AgentChatResponse(
+                response=entry.answer, source_nodes=entry.source_nodes
+            )
+
+        with self._use_condensed_question(question):
+            response = await self._chat_engine.achat(message, chat_history)
+        self._cache.record(hit=False, latency=time.perf_counter() - start)
+        if response.response:
+            self._cache.add(
+                CacheEntry(
+                    message, embedding, response.response, response.source_nodes
+                ),
+                generation,
+            )
+        return response
+
+
+def is_semantic_cache_enabled() -> bool:
+    return os.getenv("SEMANTIC_CACHE", "false").lower() == "true"
+
+
+semantic_cache = SemanticCache(
+    max_size=int(os.getenv("SEMANTIC_CACHE_SIZE", "1000")),
+    ttl=float(os.getenv("SEMANTIC_CACHE_TTL", "3600")),
+    threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+)
@@ -0,0 +1,448 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import sqlite3
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from llama_index.core.settings import Settings
+from llama_index.core.llms import ChatMessage, MessageRole
+from app.metrics import timed_stage
+
+logger = logging.getLogger("uvicorn")
+
+SUMMARY_PROMPT = """
+Progressively summarize the conversation between a user and an AI assistant,
+adding onto the previous summary and returning a new summary.
+Keep the names, numbers and facts needed to answer follow up questions.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:"""
+
+# The session of the chat request handled in the current context
+_session_id: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "chat_session_id", default=None
+)
+_session_turn: contextvars.ContextVar["SessionTurn | None"] = contextvars.ContextVar(
+    "chat_session_turn", default=None
+)
+
+
+@dataclass
+class ChatSession:
+    session_id: str
+    # The summary of the messages that are no longer kept
+    summary: str = ""
+    # The most recent messages, older ones are folded into the summary
+    messages: List[ChatMessage] = field(default_factory=list)
+    # The standalone question of the last turn
+    condensed_query: Optional[str] = None
+    turns: int = 0
+    updated_at: float = field(default_factory=time.time)
+    # Incremented by every save, detects the changes made by the other workers
+    version: int = 0
+    # The summarization running in the background, not persisted
+    summarizing: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    def _get_summary_messages(self) -> List[ChatMessage]:
+        if not self.summary:
+            return []
+        return [
+            ChatMessage(
+                role=MessageRole.SYSTEM,
+                content=f"Summary of the earlier conversation:\n{self.summary}",
+            )
+        ]
+
+    def get_chat_history(self) -> List[ChatMessage]:
+        return self._get_summary_messages() + self.messages
+
+    def get_condense_history(self) -> List[ChatMessage] | None:
+        """
+        The summary, the previous standalone question and its answer are enough to
+        condense the next question, instead of the whole conversation.
+        """
+        if self.condensed_query is None or len(self.messages) == 0:
+            return None
+        last_answer = self.messages[-1]
+        if last_answer.role != MessageRole.ASSISTANT:
+            return None
+        return self._get_summary_messages() + [
+            ChatMessage(role=MessageRole.USER, content=self.condensed_query),
+            last_answer,
+        ]
+
+    def add_turn(self, message: str, answer: str, condensed_query: str | None):
+        self.messages.append(ChatMessage(role=MessageRole.USER, content=message))
+        self.messages.append(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+        self.condensed_query = condensed_query
+        self.turns += 1
+        self.updated_at = time.time()
+
+    def to_dict(self) -> dict:
+        return {
+            "session_id": self.session_id,
+            "summary": self.summary,
+            "messages": [
+                {"role": message.role.value, "content": message.content}
+                for message in self.messages
+            ],
+            "condensed_query": self.condensed_query,
+            "turns": self.turns,
+            "updated_at": self.updated_at,
+            "version": self.version,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ChatSession":
+        return cls(
+            session_id=data["session_id"],
+            summary=data["summary"],
+            messages=[
+                ChatMessage(
+                    role=MessageRole(message["role"]), content=message["content"]
+                )
+                for message in data["messages"]
+            ],
+            condensed_query=data["condensed_query"],
+            turns=data["turns"],
+            updated_at=data["updated_at"],
+            version=data.get("version", 0),
+        )
+
+
+@dataclass
+class SessionTurn:
+    """
+    Passes the condense history of a session to the chat engine
+    and gets the condensed question back. A question already condensed,
+    e.g. by the semantic cache, is used by the chat engine as it is.
+    """
+
+    condense_history: Optional[List[ChatMessage]] = None
+    condensed_query: Optional[str] = None
+
+
+class SessionStore:
+    """
+    The chat sessions, at most max_size of them cached in memory by each worker.
+    If path is set, the sessions are written through to that SQLite file, so every
+    worker continues the conversations of the other workers and the sessions survive
+    a restart. Otherwise they only live in the memory of the worker that created them,
+    and the least recently used sessions are dropped.
+    Sessions unused for ttl seconds are removed.
+    """
+
+    def __init__(self, max_size: int, ttl: float, path: str | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self._sessions: OrderedDict[str, ChatSession] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _connect(self):
+        """
+        Open a connection for one transaction, the worker processes share the file.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=30)
+        db.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);
+            """
+        )
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _is_expired(self, session: ChatSession) -> bool:
+        return time.time() - session.updated_at > self.ttl
+
+    def _cache(self, session: ChatSession):
+        with self._lock:
+            self._sessions[session.session_id] = session
+            self._sessions.move_to_end(session.session_id)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+
+    def _load(self, session_id: str) -> ChatSession | None:
+        """
+        Get the saved session, the cached one is only used if it is the latest version
+        so the summarization task of this worker is kept.
+        """
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT data, version FROM sessions WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+        with self._lock:
+            cached = self._sessions.pop(session_id, None)
+        if row is None:
+            return None
+        if cached is not None and cached.version == row[1]:
+            return cached
+        return ChatSession.from_dict(json.loads(row[0]))
+
+    def create(self) -> ChatSession:
+        session = ChatSession(session_id=uuid.uuid4().hex)
+        self.save(session)
+        return session
+
+    def get(self, session_id: str) -> ChatSession | None:
+        if self.path is not None:
+            session = self._load(session_id)
+        else:
+            with self._lock:
+                session = self._sessions.pop(session_id, None)
+        if session is None:
+            return None
+        if self._is_expired(session):
+            self.delete(session_id)
+            return None
+        self._cache(session)
+        return session
+
+    def save(self, session: ChatSession) -> bool:
+        """
+        Save the changes of the session. Returns False without saving if another
+        worker saved the session since it was loaded, the caller must load it again.
+        """
+        if self.path is not None:
+            data = dict(session.to_dict(), version=session.version + 1)
+            with self._connect() as db:
+                if session.version == 0:
+                    saved = db.execute(
+                        "INSERT OR IGNORE INTO sessions VALUES (?, ?, 1, ?)",
+                        (session.session_id, json.dumps(data), session.updated_at),
+                    )
+                else:
+                    saved = db.execute(
+                        "UPDATE sessions SET data = ?, version = version + 1,"
+                        " updated_at = ? WHERE session_id = ? AND version = ?",
+                        (
+                            json.dumps(data),
+                            session.updated_at,
+                            session.session_id,
+                            session.version,
+                        ),
+                    )
+                if saved.rowcount == 0:
+                    return False
+                db.execute(
+                    "DELETE FROM sessions WHERE updated_at < ?",
+                    (time.time() - self.ttl,),
+                )
+        session.version += 1
+        self._cache(session)
+        return True
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if self.path is None:
+            return session is not None
+        with self._connect() as db:
+            deleted = db.execute(
+                "DELETE FROM sessions WHERE session_id = ?", (session_id,)
+            )
+        return deleted.rowcount > 0
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "shared": self.path is not None,
+            }
+
+
+@contextmanager
+def use_session_id(session_id: str | None):
+    token = _session_id.set(session_id)
+    try:
+        yield
+    finally:
+        _session_id.reset(token)
+
+
+def get_session_id() -> str | None:
+    return _session_id.get()
+
+
+def get_session_turn() -> SessionTurn | None:
+    return _session_turn.get()
+
+
+@contextmanager
+def use_session_turn(turn: SessionTurn):
+    token = _session_turn.set(turn)
+    try:
+        yield
+    finally:
+        _session_turn.reset(token)
+
+
+async def summarize_session(session: ChatSession, keep_messages: int) -> bool:
+    """
+    Fold the messages exceeding keep_messages into the summary of the session,
+    so every turn only sends the summary and the recent messages to the LLM.
+    Returns whether the session changed.
+    """
+    fold = len(session.messages) - keep_messages
+    # Keep the recent messages starting with a question
+    while 0 < fold < len(session.messages) and (
+        session.messages[fold].role != MessageRole.USER
+    ):
+        fold += 1
+    if fold <= 0:
+        return False
+    new_lines = "\n".join(
+        f"{message.role.value}: {message.content}"
+        for message in session.messages[:fold]
+    )
+    try:
+        with timed_stage("summarize"):
+            completion = await Settings.llm.acomplete(
+                SUMMARY_PROMPT.format(
+                    summary=session.summary or "(empty)", new_lines=new_lines
+                )
+            )
+    except Exception:
+        # The messages are kept and folded with the next turn
+        logger.exception(f"Failed to summarize the chat session {session.session_id}")
+        return False
+    session.summary = completion.text.strip()
+    # The messages added meanwhile are kept
+    session.messages = session.messages[fold:]
+    return True
+
+
+class SessionChatEngine:
+    """
+    Wrap a chat engine to keep the conversation of the requests with a session id
+    on the server. The client only sends its new message. The chat engine gets the
+    rolling summary and the recent messages of the session as the chat history,
+    and condenses the question from the previous condensed question and answer,
+    so the cost of a turn doesn't grow with the length of the conversation.
+    The summary is updated in the background after the answer is sent.
+    The store is read and written in a thread, as waiting for the lock of the shared
+    SQLite file would block the other requests of the worker.
+    """
+
+    def __init__(self, chat_engine, store: SessionStore, keep_messages: int):
+        self._chat_engine = chat_engine
+        self._store = store
+        self._keep_messages = keep_messages
+
+    def __getattr__(self, name):
+        return getattr(self._chat_engine, name)
+
+    async def _start_turn(
+        self, session_id: str, chat_history: Optional[List[ChatMessage]]
+    ) -> ChatSession:
+        session = await asyncio.to_thread(self._store.get, session_id)
+        if session is None:
+            # Unknown or expired session, continue from the history of the client
+            session = ChatSession(
+                session_id=session_id, messages=list(chat_history or [])
+            )
+        if session.summarizing is not None:
+            with timed_stage("summarize_wait"):
+                await session.summarizing
+            session.summarizing = None
+        return session
+
+    async def _end_turn(self, session: ChatSession, message: str, answer: str, turn):
+        session.add_turn(message, answer, turn.condensed_query)
+        while not await asyncio.to_thread(self._store.save, session):
+            # Another worker saved a turn of the session meanwhile, add this turn to it
+            session = await asyncio.to_thread(
+                self._store.get, session.session_id
+            ) or ChatSession(session_id=session.session_id)
+            session.add_turn(message, answer, turn.condensed_query)
+        # A single summarization per session at a time, the next one folds the rest
+        if len(session.messages) > self._keep_messages and (
+            session.summarizing is None or session.summarizing.done()
+        ):
+            session.summarizing = asyncio.create_task(self._summarize(session))
+
+    async def _summarize(self, session: ChatSession):
+        if await summarize_session(session, self._keep_messages):
+            # Dropped if another worker saved a newer turn, it summarizes it itself
+            await asyncio.to_thread(self._store.save, session)
+
+    async def astream_chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ):
+        session_id = get_session_id()
+        if session_id is None:
+            return await self._chat_engine.astream_chat(message, chat_history)
+        session = await self._start_turn(session_id, chat_history)
+        turn = SessionTurn(condense_history=session.get_condense_history())
+        with use_session_turn(turn):
+            response = await self._chat_engine.astream_chat(
+                message, session.get_chat_history()
+            )
+        response_gen = response.async_response_gen
+
+        async def session_response_gen():
+            tokens = []
+            async for token in response_gen():
+                tokens.append(token)
+                yield token
+            await self._end_turn(session, message, "".join(tokens), turn)
+
+        response.async_response_gen = session_response_gen
+        return response
+
+    async def achat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ):
+        session_id = get_session_id()
+        if session_id is None:
+            return await self._chat_engine.achat(message, chat_history)
+        session = await self._start_turn(session_id, chat_history)
+        turn = SessionTurn(condense_history=session.get_condense_history())
+        with use_session_turn(turn):
+            response = await self._chat_engine.achat(
+                message, session.get_chat_history()
+            )
+        await self._end_turn(session, message, str(response.response or ""), turn)
+        return response
+
+
+def get_keep_messages() -> int:
+    return 2 * int(os.getenv("SESSION_RECENT_TURNS", "3"))
+
+
+session_store = SessionStore(
+    max_size=int(os.getenv("SESSION_MAX_SESSIONS", "1000")),
+    ttl=float(os.getenv("SESSION_TTL", "3600")),
+    path=os.getenv("SESSION_STORE_PATH") or None,
+)
@@ -0,0 +1,269 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from dataclasses import dataclass, field
+from typing import Any, Dict, Tuple
+from llama_index.core.tools.types import AsyncBaseTool, BaseTool, ToolOutput
+from app.engine.instrumentation import InstrumentedTool
+
+logger = logging.getLogger("uvicorn")
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+# Runs the sync tools off the event loop, a timed out call keeps its thread until it returns
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TOOL_WORKERS", "8")), thread_name_prefix="tool"
+)
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, str):
+        return WHITESPACE_PATTERN.sub(" ", value).strip().lower()
+    if isinstance(value, dict):
+        return {str(key): _normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    return value
+
+
+def get_cache_key(tool_name: str, args: Tuple, kwargs: Dict) -> Tuple[str, str]:
+    """
+    The arguments are compared case and whitespace insensitively, so the agent
+    repeating a search with a different spelling of the same query hits the cache.
+    """
+    arguments = json.dumps(
+        {"args": _normalize(args), "kwargs": _normalize(kwargs)},
+        sort_keys=True,
+        default=str,
+    )
+    return tool_name, arguments
+
+
+@dataclass
+class ToolStats:
+    calls: int = 0
+    cache_hits: int = 0
+    timeouts: int = 0
+    errors: int = 0
+    # Of the calls executed by the tool, the cache hits are not included
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+    def to_dict(self) -> dict:
+        executed = self.calls - self.cache_hits
+        return {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "avg_latency": self.total_seconds / executed if executed else 0.0,
+            "max_latency": self.max_seconds,
+        }
+
+
+@dataclass
+class CachedToolOutput:
+    output: ToolOutput
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class ToolResultCache:
+    """
+    An in-process cache of the tool outputs keyed by (tool name, normalized arguments).
+    Entries are evicted by LRU order and by TTL, the outputs larger than
+    max_result_size characters and the failed calls are not cached.
+    Also keeps the call statistics of every tool.
+    """
+
+    def __init__(
+        self, max_size: int = 1000, ttl: float = 3600, max_result_size: int = 100000
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_result_size = max_result_size
+        self._entries: OrderedDict[Tuple[str, str], CachedToolOutput] = OrderedDict()
+        self._stats: Dict[str, ToolStats] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[str, str]) -> ToolOutput | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry.created_at > self.ttl:
+                self._entries.pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry.output
+
+    def put(self, key: Tuple[str, str], output: ToolOutput):
+        if output.is_error or len(output.content) > self.max_result_size:
+            return
+        with self._lock:
+            self._entries[key] = CachedToolOutput(output)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def record(
+        self,
+        tool_name: str,
+        seconds: float = 0.0,
+        cache_hit: bool = False,
+        timeout: bool = False,
+        error: bool = False,
+    ):
+        with self._lock:
+            stats = self._stats.setdefault(tool_name, ToolStats())
+            stats.calls += 1
+            if cache_hit:
+                stats.cache_hits += 1
+                return
+            stats.timeouts += int(timeout)
+            stats.errors += int(error)
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "cache": {
+                    "enabled": is_tool_cache_enabled(),
+                    "size": len(self._entries),
+                    "max_size": self.max_size,
+                    "ttl": self.ttl,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / requests if requests else 0.0,
+                },
+                "tools": {name: stats.to_dict() for name, stats in self._stats.items()},
+            }
+
+
+class ManagedTool(InstrumentedTool):
+    """
+    Wrap a tool of the agent to run it off the event loop with a timeout and to reuse
+    its recent outputs. A timed out call returns an error output, so the agent can
+    answer without it. The tool calls of a step run concurrently with the OpenAI
+    agent (see app.engine.agent), so a slow tool delays the step by at most the timeout.
+    """
+
+    def __init__(
+        self,
+        tool: BaseTool,
+        cache: ToolResultCache,
+        timeout: float,
+        cacheable: bool = True,
+    ):
+        super().__init__(tool)
+        self._cache = cache
+        self._timeout = timeout
+        self._cacheable = cacheable and is_tool_cache_enabled()
+
+    @property
+    def _name(self) -> str:
+        return self._tool.metadata.name or "unknown"
+
+    def _timeout_output(self, args: Tuple, kwargs: Dict) -> ToolOutput:
+        logger.warning(f"Tool {self._name} timed out after {self._timeout:.1f}s")
+        return ToolOutput(
+            content=f"The tool {self._name} did not answer in time.",
+            tool_name=self._name,
+            raw_input={"args": args, "kwargs": kwargs},
+            raw_output=None,
+            is_error=True,
+        )
+
+    def _lookup(self, args: Tuple, kwargs: Dict):
+        if not self._cacheable:
+            return None, None
+        key = get_cache_key(self._name, args, kwargs)
+        output = self._cache.get(key)
+        if output is not None:
+            self._cache.record(self._name, cache_hit=True)
+        return key, output
+
+    def _store(self, key, output: ToolOutput, seconds: float, timeout: bool = False):
+        self._cache.record(
+            self._name, seconds, timeout=timeout, error=output.is_error and not timeout
+        )
+        if key is not None:
+            self._cache.put(key, output)
+
+    def _run_sync(self, *args: Any, **kwargs: Any) -> ToolOutput:
+        return super().call(*args, **kwargs)
+
+    def call(self, *args: Any, **kwargs: Any) -> ToolOutput:
+        key, output = self._lookup(args, kwargs)
+        if output is not None:
+            return output
+        start = time.perf_counter()
+        # Keep the trace of the request in the tool thread
+        context = contextvars.copy_context()
+        future = _executor.submit(context.run, self._run_sync, *args, **kwargs)
+        try:
+            output = future.result(timeout=self._timeout)
+        except TimeoutError:
+            output = self._timeout_output(args, kwargs)
+            self._store(None, output, time.perf_counter() - start, timeout=True)
+            return output
+        except Exception:
+            self._cache.record(self._name, time.perf_counter() - start, error=True)
+            raise
+        self._store(key, output, time.perf_counter() - start)
+        return output
+
+    async def acall(self, *args: Any, **kwargs: Any) -> ToolOutput:
+        key, output = self._lookup(args, kwargs)
+        if output is not None:
+            return output
+        start = time.perf_counter()
+        if isinstance(self._tool, AsyncBaseTool):
+            call = super().acall(*args, **kwargs)
+        else:
+            context = contextvars.copy_context()
+            call = asyncio.get_running_loop().run_in_executor(
+                _executor, lambda: context.run(self._run_sync, *args, **kwargs)
+            )
+        try:
+            output = await asyncio.wait_for(call, timeout=self._timeout)
+        except asyncio.TimeoutError:
+            output = self._timeout_output(args, kwargs)
+            self._store(None, output, time.perf_counter() - start, timeout=True)
+            return output
+        except Exception:
+            self._cache.record(self._name, time.perf_counter() - start, error=True)
+            raise
+        self._store(key, output, time.perf_counter() - start)
+        return output
+
+
+def is_tool_cache_enabled() -> bool:
+    return os.getenv("TOOL_CACHE", "true").lower() == "true"
+
+
+def get_tool_timeout() -> float:
+    return float(os.getenv("TOOL_TIMEOUT_SECONDS", "30"))
+
+
+tool_cache = ToolResultCache(
+    max_size=int(os.getenv("TOOL_CACHE_SIZE", "1000")),
+    ttl=float(os.getenv("TOOL_CACHE_TTL", "3600")),
+    max_result_size=int(os.getenv("TOOL_CACHE_MAX_RESULT_SIZE", "100000")),
+)
@@ -1,15 +1,36 @@
 import os
 import importlib
 import logging
+from typing import Iterator, List
 
 logger = logging.getLogger(__name__)
 
 
-def get_vector_store():
+def _get_provider_module():
     provider = os.getenv("VECTOR_STORE_PROVIDER", "chroma")
     try:
         module = importlib.import_module(f"app.engine.vectordbs.{provider}")
-        logger.info(f"Using vector provider: {provider}")
-        return module.get_vector_store()
     except ImportError:
         raise ValueError(f"Unsupported vector provider: {provider}")
+    logger.info(f"Using vector provider: {provider}")
+    return module
+
+
+def get_vector_store():
+    return _get_provider_module().get_vector_store()
+
+
+def delete_documents(store, doc_ids: List[str]):
+    """
+    Delete all nodes belonging to the given document ids from the vector store.
+    """
+    if len(doc_ids) == 0:
+        return
+    _get_provider_module().delete_documents(store, doc_ids)
+
+
+def export_nodes(store, batch_size: int = 1000) -> Iterator[List]:
+    """
+    Read all nodes of the vector store with their embeddings, in batches.
+    """
+    return _get_provider_module().export_nodes(store, batch_size)
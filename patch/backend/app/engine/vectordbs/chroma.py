@@ -1,14 +1,37 @@
 import os
+import dataclasses
+from typing import Any, Iterator, List
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
 from llama_index.vector_stores.chroma import ChromaVectorStore
+from app.engine.filters import filters_to_chroma_where
+from app.engine.index_version import versioned_name
+
+
+class FilteredChromaVectorStore(ChromaVectorStore):
+    """
+    Chroma vector store that applies the filters of the chat as a native where clause,
+    the filter translation of llama-index doesn't support the IN operator of the
+    file name and extension filters.
+    """
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any):
+        if query.filters is None:
+            return super().query(query, **kwargs)
+        where = filters_to_chroma_where(query.filters)
+        return super().query(
+            dataclasses.replace(query, filters=None), **{**kwargs, "where": where}
+        )
 
 
 def get_vector_store():
-    collection_name = os.getenv("CHROMA_COLLECTION", "default")
+    collection_name = versioned_name(os.getenv("CHROMA_COLLECTION", "default"))
     chroma_path = os.getenv("CHROMA_PATH")
     # if CHROMA_PATH is set, use a local ChromaVectorStore from the path
     # otherwise, use a remote ChromaVectorStore (ChromaDB Cloud is not supported yet)
     if chroma_path:
-        store = ChromaVectorStore.from_params(
+        store = FilteredChromaVectorStore.from_params(
             persist_dir=chroma_path, collection_name=collection_name
         )
     else:
@@ -16,9 +39,36 @@ def get_vector_store():
             raise ValueError(
                 "Please provide either CHROMA_PATH or CHROMA_HOST and CHROMA_PORT"
             )
-        store = ChromaVectorStore.from_params(
+        store = FilteredChromaVectorStore.from_params(
             host=os.getenv("CHROMA_HOST"),
             port=int(os.getenv("CHROMA_PORT")),
             collection_name=collection_name,
         )
     return store
+
+
+def delete_documents(store: ChromaVectorStore, doc_ids: List[str]):
+    # Delete the nodes of all documents in one call instead of one call per document
+    store._collection.delete(where={"document_id": {"$in": doc_ids}})
+
+
+def export_nodes(store: ChromaVectorStore, batch_size: int) -> Iterator[List[BaseNode]]:
+    offset = 0
+    while True:
+        result = store._collection.get(
+            include=["embeddings", "metadatas", "documents"],
+            limit=batch_size,
+            offset=offset,
+        )
+        if len(result["ids"]) == 0:
+            return
+        nodes = []
+        for embedding, metadata, text in zip(
+            result["embeddings"], result["metadatas"], result["documents"]
+        ):
+            # The text is stored as the document of the node, not in its metadata
+            node = metadata_dict_to_node(metadata, text=text)
+            node.embedding = [float(value) for value in embedding]
+            nodes.append(node)
+        yield nodes
+        offset += len(nodes)
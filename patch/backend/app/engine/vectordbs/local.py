@@ -0,0 +1,488 @@
+import os
+import json
+import shutil
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
+from llama_index.core.vector_stores.utils import (
+    metadata_dict_to_node,
+    node_to_metadata_dict,
+)
+from app.engine.filters import filters_to_sql
+from app.engine.index_version import versioned_name
+
+logger = logging.getLogger("uvicorn")
+
+# The number of rows scored at once, bounds the memory used by a query
+SCAN_BLOCK_ROWS = 65536
+# Below this number of rows an exact scan is fast enough, no IVF index is built
+IVF_MIN_ROWS = 10000
+
+
+class LocalVectorStore(BasePydanticVectorStore):
+    """
+    An embedded vector store for single node deployments.
+    The normalized embeddings are stored in an append-only float32 matrix that is
+    memory-mapped, so opening the store does not load it into memory.
+    The nodes and their metadata are stored in a SQLite table, one row per matrix row.
+    Deleted rows are only marked and are compacted once they are the majority.
+    A compaction writes the vectors to a file of a new generation and switches the rows
+    and the generation in one transaction, so a reader never maps new rows onto the
+    vectors of the previous generation. Only the writer, which holds the indexing lock,
+    changes the files; readers only map the rows that are committed.
+    With the "ivf" index type, the rows are clustered around k-means centroids and a
+    query only scans the rows of the nprobe closest clusters.
+    """
+
+    stores_text: bool = True
+    path: str
+    index_type: str = "flat"
+    nprobe: int = 8
+
+    _lock = PrivateAttr()
+    _db: sqlite3.Connection = PrivateAttr()
+    _dim: Optional[int] = PrivateAttr(default=None)
+    _num_rows: int = PrivateAttr(default=0)
+    _vectors: Optional[np.memmap] = PrivateAttr(default=None)
+    _deleted: np.ndarray = PrivateAttr()
+    _centroids: Optional[np.ndarray] = PrivateAttr(default=None)
+    _assignments: Optional[np.ndarray] = PrivateAttr(default=None)
+    _data_version: Optional[int] = PrivateAttr(default=None)
+    _generation: int = PrivateAttr(default=0)
+
+    def __init__(self, path: str, index_type: str = "flat", nprobe: int = 8):
+        super().__init__(path=path, index_type=index_type, nprobe=nprobe)
+        self._lock = threading.RLock()
+        self._open()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LocalVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    def _get_file(self, name: str, generation: Optional[int] = None) -> str:
+        generation = self._generation if generation is None else generation
+        if generation > 0:
+            base, extension = os.path.splitext(name)
+            name = f"{base}.{generation}{extension}"
+        return os.path.join(self.path, name)
+
+    @property
+    def _vectors_file(self) -> str:
+        return self._get_file("vectors.f32")
+
+    @property
+    def _assignments_file(self) -> str:
+        return self._get_file("ivf_assignments.i32")
+
+    @property
+    def _centroids_file(self) -> str:
+        return self._get_file("ivf_centroids.npy")
+
+    def _open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._db = sqlite3.connect(
+            os.path.join(self.path, "nodes.sqlite"), check_same_thread=False
+        )
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS nodes (
+                row INTEGER PRIMARY KEY,
+                node_id TEXT NOT NULL,
+                doc_id TEXT,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                metadata TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS nodes_doc_id ON nodes (doc_id);
+            CREATE INDEX IF NOT EXISTS nodes_node_id ON nodes (node_id);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        self._load()
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        value = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,))
+        value = value.fetchone()
+        return value[0] if value else None
+
+    def _load(self):
+        # Read the rows and the generation in one transaction and map the files
+        # before it ends, a compaction can't commit in between
+        self._db.execute("BEGIN")
+        try:
+            dim = self._get_meta("dim")
+            self._dim = int(dim) if dim else None
+            self._generation = int(self._get_meta("generation") or 0)
+            num_rows = self._db.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM nodes")
+            self._num_rows = num_rows.fetchone()[0]
+            self._deleted = np.zeros(self._num_rows, dtype=bool)
+            deleted_rows = self._db.execute("SELECT row FROM nodes WHERE deleted = 1")
+            self._deleted[[row for (row,) in deleted_rows]] = True
+            self._map_vectors()
+            self._load_ivf()
+            self._data_version = self._get_data_version()
+        finally:
+            self._db.rollback()
+
+    def _map_vectors(self):
+        if self._num_rows == 0 or self._dim is None:
+            self._vectors = None
+            return
+        self._vectors = np.memmap(
+            self._vectors_file,
+            dtype=np.float32,
+            mode="r",
+            shape=(self._num_rows, self._dim),
+        )
+
+    def _load_ivf(self):
+        self._centroids = None
+        self._assignments = None
+        if self.index_type != "ivf" or not os.path.exists(self._centroids_file):
+            return
+        self._centroids = np.load(self._centroids_file)
+        assignments = np.fromfile(self._assignments_file, dtype=np.int32)
+        if len(assignments) != self._num_rows:
+            # The assignments are out of sync, fall back to exact search until rebuilt
+            self._centroids = None
+            return
+        self._assignments = assignments
+
+    def _get_data_version(self) -> int:
+        return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def _refresh(self):
+        # Reload if another process has written to the store
+        if self._get_data_version() != self._data_version:
+            self._load()
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if len(nodes) == 0:
+            return []
+        embeddings = np.asarray([node.get_embedding() for node in nodes], np.float32)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.where(norms == 0, 1, norms)
+
+        with self._lock:
+            self._refresh()
+            if self._dim is None:
+                self._dim = embeddings.shape[1]
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('dim', ?)", (str(self._dim),)
+                )
+            first_row = self._num_rows
+            # Write the vectors before the rows so a row never points to a missing vector.
+            # The vectors written by an interrupted add are dropped first, readers
+            # never repair the file as the writer may be appending to it.
+            with open(self._vectors_file, "ab") as f:
+                f.truncate(self._num_rows * self._dim * 4)
+                f.write(embeddings.tobytes())
+            self._db.executemany(
+                "INSERT INTO nodes (row, node_id, doc_id, metadata) VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        first_row + i,
+                        node.node_id,
+                        node.ref_doc_id,
+                        json.dumps(
+                            node_to_metadata_dict(
+                                node, remove_text=False, flat_metadata=False
+                            )
+                        ),
+                    )
+                    for i, node in enumerate(nodes)
+                ],
+            )
+            self._db.commit()
+            self._data_version = self._get_data_version()
+            self._num_rows += len(nodes)
+            self._deleted = np.concatenate(
+                [self._deleted, np.zeros(len(nodes), dtype=bool)]
+            )
+            self._map_vectors()
+            if self.index_type == "ivf":
+                self._update_ivf(embeddings)
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self.delete_documents([ref_doc_id])
+
+    def delete_documents(self, doc_ids: List[str]):
+        with self._lock:
+            self._refresh()
+            placeholders = ",".join("?" * len(doc_ids))
+            rows = self._db.execute(
+                f"SELECT row FROM nodes WHERE deleted = 0 AND doc_id IN ({placeholders})",
+                doc_ids,
+            ).fetchall()
+            self._db.execute(
+                f"UPDATE nodes SET deleted = 1 WHERE doc_id IN ({placeholders})",
+                doc_ids,
+            )
+            self._db.commit()
+            self._data_version = self._get_data_version()
+            self._deleted[[row for (row,) in rows]] = True
+            if self._deleted.sum() > self._num_rows / 2:
+                self._compact()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.close()
+            shutil.rmtree(self.path, ignore_errors=True)
+            self._open()
+
+    def _compact(self):
+        """
+        Rewrite the store without the deleted rows.
+        """
+        logger.info(f"Compacting the local vector store at {self.path}")
+        keep = np.flatnonzero(~self._deleted)
+        vectors = np.array(self._vectors[keep]) if len(keep) > 0 else None
+        rows = self._db.execute(
+            "SELECT node_id, doc_id, metadata FROM nodes WHERE deleted = 0 ORDER BY row"
+        ).fetchall()
+        previous_files = [
+            self._vectors_file,
+            self._centroids_file,
+            self._assignments_file,
+        ]
+        generation = self._generation + 1
+        with open(self._get_file("vectors.f32", generation), "wb") as f:
+            if vectors is not None:
+                f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        # The new rows and the generation of their vectors are committed together
+        self._db.execute("DELETE FROM nodes")
+        self._db.executemany(
+            "INSERT INTO nodes (row, node_id, doc_id, metadata) VALUES (?, ?, ?, ?)",
+            [(i, *row) for i, row in enumerate(rows)],
+        )
+        self._db.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (str(generation),)
+        )
+        self._db.execute("DELETE FROM meta WHERE key = 'ivf_trained_rows'")
+        self._db.commit()
+        # The readers that mapped the previous files keep them until they reload
+        for previous_file in previous_files:
+            if os.path.exists(previous_file):
+                os.remove(previous_file)
+        self._load()
+        if self.index_type == "ivf" and vectors is not None:
+            self._update_ivf(vectors)
+
+    def _update_ivf(self, new_vectors: np.ndarray):
+        """
+        Assign the new vectors to their closest centroid.
+        The centroids are retrained once the store has doubled since the last training.
+        """
+        trained_rows = self._db.execute(
+            "SELECT value FROM meta WHERE key = 'ivf_trained_rows'"
+        ).fetchone()
+        trained_rows = int(trained_rows[0]) if self._centroids is not None else 0
+        if self._num_rows >= max(IVF_MIN_ROWS, 2 * trained_rows):
+            self._train_ivf()
+            return
+        if self._centroids is None:
+            return
+        assignments = np.argmax(new_vectors @ self._centroids.T, axis=1)
+        with open(self._assignments_file, "ab") as f:
+            f.write(assignments.astype(np.int32).tobytes())
+        self._assignments = np.concatenate([self._assignments, assignments])
+
+    def _train_ivf(self, iterations: int = 10):
+        num_lists = int(np.clip(np.sqrt(self._num_rows), 16, 4096))
+        rng = np.random.default_rng(0)
+        sample = np.array(
+            self._vectors[
+                np.sort(
+                    rng.choice(
+                        self._num_rows, min(self._num_rows, 50 * num_lists), False
+                    )
+                )
+            ]
+        )
+        centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+        # Spherical k-means as the vectors are normalized
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for i in range(num_lists):
+                members = sample[labels == i]
+                if len(members) > 0:
+                    centroid = members.sum(axis=0)
+                    centroids[i] = centroid / (np.linalg.norm(centroid) or 1)
+        assignments = np.concatenate(
+            [
+                np.argmax(self._vectors[i : i + SCAN_BLOCK_ROWS] @ centroids.T, axis=1)
+                for i in range(0, self._num_rows, SCAN_BLOCK_ROWS)
+            ]
+        ).astype(np.int32)
+        np.save(self._centroids_file, centroids)
+        assignments.tofile(self._assignments_file)
+        self._db.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('ivf_trained_rows', ?)",
+            (str(self._num_rows),),
+        )
+        self._db.commit()
+        self._data_version = self._get_data_version()
+        self._centroids = centroids
+        self._assignments = assignments
+        logger.info(f"Trained IVF index with {num_lists} lists")
+
+    def _get_filtered_rows(self, query: VectorStoreQuery) -> Optional[np.ndarray]:
+        """
+        Get the rows matching the filters of the query, None if there is no filter.
+        """
+        clauses, params = [], []
+        if query.filters is not None:
+            clause, filter_params = filters_to_sql(query.filters)
+            clauses.append(clause)
+            params.extend(filter_params)
+        for column, values in (("doc_id", query.doc_ids), ("node_id", query.node_ids)):
+            if values:
+                clauses.append(f"{column} IN ({','.join('?' * len(values))})")
+                params.extend(values)
+        if len(clauses) == 0:
+            return None
+        rows = self._db.execute(
+            f"SELECT row FROM nodes WHERE {' AND '.join(clauses)}", params
+        ).fetchall()
+        return np.asarray([row for (row,) in rows], dtype=np.int64)
+
+    def _get_candidate_rows(self, query_embedding: np.ndarray) -> Optional[np.ndarray]:
+        if self._assignments is None:
+            return None
+        probes = np.argsort(-(self._centroids @ query_embedding))[: self.nprobe]
+        return np.flatnonzero(np.isin(self._assignments, probes))
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        query_embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        query_embedding /= np.linalg.norm(query_embedding) or 1
+        top_k = query.similarity_top_k
+
+        with self._lock:
+            self._refresh()
+            if self._vectors is None:
+                return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+            candidates = self._get_candidate_rows(query_embedding)
+            filtered = self._get_filtered_rows(query)
+            if filtered is not None:
+                candidates = (
+                    filtered
+                    if candidates is None
+                    else np.intersect1d(candidates, filtered)
+                )
+
+            best_rows = np.empty(0, dtype=np.int64)
+            best_scores = np.empty(0, dtype=np.float32)
+            total = self._num_rows if candidates is None else len(candidates)
+            for start in range(0, total, SCAN_BLOCK_ROWS):
+                if candidates is None:
+                    rows = np.arange(start, min(start + SCAN_BLOCK_ROWS, total))
+                    block = self._vectors[start : start + SCAN_BLOCK_ROWS]
+                else:
+                    rows = candidates[start : start + SCAN_BLOCK_ROWS]
+                    block = self._vectors[rows]
+                scores = block @ query_embedding
+                scores[self._deleted[rows]] = -np.inf
+                # Keep the top k of the block merged with the top k so far
+                rows = np.concatenate([best_rows, rows])
+                scores = np.concatenate([best_scores, scores])
+                if len(scores) > top_k:
+                    top = np.argpartition(-scores, top_k)[:top_k]
+                    rows, scores = rows[top], scores[top]
+                best_rows, best_scores = rows, scores
+
+            order = np.argsort(-best_scores)
+            best_rows = best_rows[order][np.isfinite(best_scores[order])]
+            best_scores = best_scores[order][np.isfinite(best_scores[order])]
+            metadata_by_row = self._get_metadata([int(row) for row in best_rows])
+
+        nodes = [metadata_dict_to_node(metadata_by_row[row]) for row in best_rows]
+        return VectorStoreQueryResult(
+            nodes=nodes,
+            similarities=[float(score) for score in best_scores],
+            ids=[node.node_id for node in nodes],
+        )
+
+    def export_nodes(self, batch_size: int) -> Iterator[List[BaseNode]]:
+        """
+        Read the nodes that are not deleted with their normalized embeddings.
+        """
+        last_row = -1
+        while True:
+            with self._lock:
+                self._refresh()
+                rows = self._db.execute(
+                    "SELECT row, metadata FROM nodes WHERE deleted = 0 AND row > ?"
+                    " ORDER BY row LIMIT ?",
+                    (last_row, batch_size),
+                ).fetchall()
+                if len(rows) == 0:
+                    return
+                embeddings = np.array(self._vectors[[row for row, _ in rows]])
+            nodes = []
+            for (_, metadata), embedding in zip(rows, embeddings):
+                node = metadata_dict_to_node(json.loads(metadata))
+                node.embedding = embedding.tolist()
+                nodes.append(node)
+            yield nodes
+            last_row = rows[-1][0]
+
+    def _get_metadata(self, rows: List[int]) -> Dict[int, dict]:
+        if len(rows) == 0:
+            return {}
+        result = self._db.execute(
+            f"SELECT row, metadata FROM nodes WHERE row IN ({','.join('?' * len(rows))})",
+            rows,
+        )
+        return {row: json.loads(metadata) for row, metadata in result}
+
+
+_stores: Dict[str, LocalVectorStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_vector_store():
+    path = versioned_name(os.getenv("LOCAL_VECTOR_STORE_PATH", "storage/vectordb"))
+    # Share one instance per path so readers see the writes of the indexing
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = LocalVectorStore(
+                path=path,
+                index_type=os.getenv("LOCAL_VECTOR_STORE_INDEX", "flat"),
+                nprobe=int(os.getenv("LOCAL_VECTOR_STORE_NPROBE", "8")),
+            )
+        return _stores[path]
+
+
+def remove_vector_store(path: str):
+    """
+    Close the store at the given path and remove its files.
+    """
+    with _stores_lock:
+        store = _stores.pop(path, None)
+    if store is not None:
+        with store._lock:
+            store._db.close()
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def delete_documents(store: LocalVectorStore, doc_ids: List[str]):
+    store.delete_documents(doc_ids)
+
+
+def export_nodes(store: LocalVectorStore, batch_size: int) -> Iterator[List[BaseNode]]:
+    return store.export_nodes(batch_size)
@@ -1,19 +1,152 @@
 import os
+import asyncio
+import threading
+from typing import Any, Dict, Iterator, List
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import VectorStoreQuery
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
 from llama_index.vector_stores.qdrant import QdrantVectorStore
+from app.engine.filters import FILE_EXTENSION_KEY, FILE_NAME_KEY, UPLOADED_AT_KEY
+from app.engine.index_version import versioned_name
+
+# A local Qdrant folder can only be opened by one client per process
+_local_clients: Dict[str, Any] = {}
+_local_clients_lock = threading.Lock()
+
+
+class IndexedQdrantVectorStore(QdrantVectorStore):
+    """
+    Qdrant vector store with payload indexes on the metadata the chat can be filtered on,
+    so a filtered search doesn't check the payload of every point of the collection.
+    The collection is created by the first add, so the indexes are created after it.
+    """
+
+    _payload_indexed: bool = PrivateAttr(default=False)
+
+    def _create_payload_indexes(self):
+        from qdrant_client.http import models as rest
+
+        for key, schema in (
+            (FILE_NAME_KEY, rest.PayloadSchemaType.KEYWORD),
+            (FILE_EXTENSION_KEY, rest.PayloadSchemaType.KEYWORD),
+            (UPLOADED_AT_KEY, rest.PayloadSchemaType.FLOAT),
+        ):
+            # Creating an existing index is a no-op
+            self.client.create_payload_index(
+                collection_name=self.collection_name,
+                field_name=key,
+                field_schema=schema,
+            )
+        self._payload_indexed = True
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        ids = super().add(nodes, **add_kwargs)
+        if len(nodes) > 0 and not self._payload_indexed:
+            self._create_payload_indexes()
+        return ids
+
+    async def aquery(self, query: VectorStoreQuery, **kwargs: Any):
+        if self._aclient is None:
+            # A local Qdrant has no async client, query it off the event loop
+            return await asyncio.to_thread(self.query, query, **kwargs)
+        return await super().aquery(query, **kwargs)
+
+
+def _get_local_client(path: str):
+    from qdrant_client import QdrantClient
+
+    with _local_clients_lock:
+        if path not in _local_clients:
+            if path == ":memory:":
+                _local_clients[path] = QdrantClient(location=path)
+            else:
+                _local_clients[path] = QdrantClient(path=path)
+        return _local_clients[path]
 
 
 def get_vector_store():
+    from qdrant_client import AsyncQdrantClient, QdrantClient
+
     collection_name = os.getenv("QDRANT_COLLECTION")
     url = os.getenv("QDRANT_URL")
-    api_key = os.getenv("QDRANT_API_KEY")
-    if not collection_name or not url:
+    # A local Qdrant in a folder or in memory (":memory:"), for a single worker
+    path = os.getenv("QDRANT_PATH")
+    if not collection_name or not (url or path):
         raise ValueError(
-            "Please set QDRANT_COLLECTION, QDRANT_URL"
+            "Please set QDRANT_COLLECTION, QDRANT_URL (or QDRANT_PATH for a local Qdrant)"
             " to your environment variables or config them in the .env file"
         )
-    store = QdrantVectorStore(
+    collection_name = versioned_name(collection_name)
+    if path:
+        client = _get_local_client(path)
+        aclient = None
+        # The upload processes can't open the local Qdrant of this process
+        parallel = 1
+    else:
+        client_kwargs = {
+            "url": url,
+            "api_key": os.getenv("QDRANT_API_KEY"),
+            "prefer_grpc": os.getenv("QDRANT_PREFER_GRPC", "false").lower() == "true",
+        }
+        if os.getenv("QDRANT_GRPC_PORT"):
+            client_kwargs["grpc_port"] = int(os.getenv("QDRANT_GRPC_PORT"))
+        client = QdrantClient(**client_kwargs)
+        aclient = AsyncQdrantClient(**client_kwargs)
+        parallel = int(os.getenv("QDRANT_UPSERT_PARALLEL", "1"))
+    store = IndexedQdrantVectorStore(
         collection_name=collection_name,
-        url=url,
-        api_key=api_key,
+        client=client,
+        aclient=aclient,
+        # The nodes of a file are upserted in batches, by parallel processes if set
+        batch_size=int(os.getenv("QDRANT_UPSERT_BATCH_SIZE", "256")),
+        parallel=parallel,
     )
     return store
+
+
+def delete_documents(store: QdrantVectorStore, doc_ids: List[str]):
+    from qdrant_client.http import models as rest
+
+    # The collection is only created by the first add, e.g. of a new index version
+    if not store._collection_exists(store.collection_name):
+        return
+    # Delete the nodes of all documents in one call instead of one call per document
+    store.client.delete(
+        collection_name=store.collection_name,
+        points_selector=rest.Filter(
+            must=[
+                rest.FieldCondition(
+                    key="doc_id",
+                    match=rest.MatchAny(any=doc_ids),
+                )
+            ]
+        ),
+    )
+
+
+def export_nodes(store: QdrantVectorStore, batch_size: int) -> Iterator[List[BaseNode]]:
+    if not store._collection_exists(store.collection_name):
+        return
+    offset = None
+    while True:
+        points, offset = store.client.scroll(
+            collection_name=store.collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        nodes = []
+        for point in points:
+            node = metadata_dict_to_node(point.payload)
+            vector = point.vector
+            if isinstance(vector, dict):
+                # A collection with named vectors, only the dense vector is exported
+                vector = next(v for v in vector.values() if isinstance(v, list))
+            node.embedding = vector
+            nodes.append(node)
+        if len(nodes) > 0:
+            yield nodes
+        if offset is None:
+            return
@@ -0,0 +1,394 @@
+import os
+import glob
+import json
+import time
+import uuid
+import atexit
+import logging
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+logger = logging.getLogger("uvicorn")
+
+# Upper bounds of the latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TRACE_ID_HEADER = "X-Trace-Id"
+# The folder where every worker process writes its metrics when there are several
+# workers, so /metrics reports the sum of all workers. Set by main.py.
+METRICS_DIR_ENV = "METRICS_DIR"
+# The interval of the writes, the metrics of a killed worker miss at most this interval
+METRICS_WRITE_SECONDS = 5
+
+_registry: List["Metric"] = []
+
+
+class Metric:
+    """
+    A metric with optional labels, rendered in the Prometheus text format.
+    Updates only take a lock and touch a dict, so the metrics are cheap enough
+    to be always enabled.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: str | None = None) -> str:
+        labels = [
+            f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)
+        ]
+        if extra is not None:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+    def _samples(self, values: Dict[Tuple[str, ...], object]) -> List[str]:
+        raise NotImplementedError
+
+    def _merge(self, value, other):
+        raise NotImplementedError
+
+    def snapshot(self) -> List:
+        """
+        A copy of the values as a list of (labels, value), which can be written as JSON.
+        """
+        with self._lock:
+            return json.loads(json.dumps(list(self._values.items())))
+
+    def render(self, values: Dict[Tuple[str, ...], object] | None = None) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self._lock:
+            lines.extend(self._samples(self._values if values is None else values))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        if len(self.labelnames) == 0:
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _merge(self, value, other):
+        return value + other
+
+    def _samples(self, values: Dict[Tuple[str, ...], object]) -> List[str]:
+        return [
+            f"{self.name}_total{self._format_labels(key)} {value}"
+            for key, value in values.items()
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # The counts of the buckets (+Inf last) and the sum of the values
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _merge(self, value, other):
+        counts, total = value
+        other_counts, other_total = other
+        if len(counts) != len(other_counts):
+            # Written with other buckets, e.g. by a previous version of the app
+            return value
+        return [[a + b for a, b in zip(counts, other_counts)], total + other_total]
+
+    def _samples(self, values: Dict[Tuple[str, ...], object]) -> List[str]:
+        samples = []
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                samples.append(
+                    f"{self.name}_bucket{self._format_labels(key, le)} {cumulative}"
+                )
+            samples.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+            samples.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return samples
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _get_metrics_dir() -> str | None:
+    return os.getenv(METRICS_DIR_ENV) or None
+
+
+def write_process_metrics():
+    """
+    Write the metrics of this process to its file of the metrics folder.
+    """
+    metrics_dir = _get_metrics_dir()
+    if metrics_dir is None:
+        return
+    os.makedirs(metrics_dir, exist_ok=True)
+    path = os.path.join(metrics_dir, f"{os.getpid()}.json")
+    # Write to a temp file first so a reader never reads a half written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({metric.name: metric.snapshot() for metric in _registry}, f)
+    os.replace(tmp_path, path)
+
+
+def start_metrics_writer():
+    """
+    Write the metrics of this worker to the metrics folder periodically and on exit,
+    if there is a metrics folder.
+    """
+    if _get_metrics_dir() is None:
+        return
+
+    def write_periodically():
+        while True:
+            time.sleep(METRICS_WRITE_SECONDS)
+            try:
+                write_process_metrics()
+            except OSError:
+                logger.exception("Failed to write the metrics")
+
+    threading.Thread(
+        target=write_periodically, name="metrics-writer", daemon=True
+    ).start()
+    atexit.register(write_process_metrics)
+
+
+def _read_all_metrics() -> Dict[str, Dict[Tuple[str, ...], object]]:
+    """
+    Sum the metrics of all the worker processes, including the exited ones,
+    as the counters and histograms are cumulative.
+    """
+    merged: Dict[str, Dict[Tuple[str, ...], object]] = {}
+    metrics = {metric.name: metric for metric in _registry}
+    for path in glob.glob(os.path.join(_get_metrics_dir(), "*.json")):
+        try:
+            with open(path, "r") as f:
+                process_metrics = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, items in process_metrics.items():
+            metric = metrics.get(name)
+            if metric is None:
+                continue
+            values = merged.setdefault(name, {})
+            for key, value in items:
+                key = tuple(key)
+                values[key] = (
+                    metric._merge(values[key], value) if key in values else value
+                )
+    return merged
+
+
+def render_metrics() -> str:
+    if _get_metrics_dir() is None:
+        return "\n".join(metric.render() for metric in _registry) + "\n"
+    # The scrape is answered by one worker, it reports the sum of all of them
+    write_process_metrics()
+    merged = _read_all_metrics()
+    return (
+        "\n".join(metric.render(merged.get(metric.name, {})) for metric in _registry)
+        + "\n"
+    )
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "ragbox_http_request_seconds",
+    "Duration of the HTTP requests until the last byte of the response.",
+    ["method", "route", "status"],
+)
+CHAT_STAGE_SECONDS = Histogram(
+    "ragbox_chat_stage_seconds",
+    "Duration of the stages of the chat pipeline.",
+    ["stage"],
+)
+CHAT_REQUESTS_REJECTED = Counter(
+    "ragbox_chat_requests_rejected",
+    "Number of chat requests rejected with a 429 because the model backend was saturated.",
+)
+VECTOR_STORE_QUERY_SECONDS = Histogram(
+    "ragbox_vector_store_query_seconds",
+    "Duration of the vector store queries.",
+    ["provider"],
+)
+TOOL_CALL_SECONDS = Histogram(
+    "ragbox_tool_call_seconds",
+    "Duration of the tool calls of the agent.",
+    ["tool"],
+)
+INDEXING_RUN_SECONDS = Histogram(
+    "ragbox_indexing_run_seconds",
+    "Duration of the indexing runs.",
+    buckets=(1, 5, 10, 30, 60, 300, 600, 1800, 3600),
+)
+INDEXING_FILES_PARSED = Counter(
+    "ragbox_indexing_files_parsed",
+    "Number of files parsed by the indexing.",
+)
+INDEXING_NODES_EMBEDDED = Counter(
+    "ragbox_indexing_nodes_embedded",
+    "Number of nodes embedded and stored by the indexing.",
+)
+EMBED_BATCH_SECONDS = Histogram(
+    "ragbox_embed_batch_seconds",
+    "Duration of the embedding model calls for one batch of texts.",
+)
+EMBED_CACHE_TEXTS = Counter(
+    "ragbox_embed_cache_texts",
+    "Number of texts to embed by embedding cache result.",
+    ["result"],
+)
+CONTEXT_TOKENS_SAVED = Counter(
+    "ragbox_context_tokens_saved",
+    "Number of prompt tokens removed from the context and the chat history to fit the token budgets.",
+    ["part"],
+)
+
+
+class Trace:
+    """
+    The timings of the stages of one request, logged together with its trace id.
+    """
+
+    def __init__(self, trace_id: str | None = None):
+        self.id = trace_id or uuid.uuid4().hex
+        self.stages: List[Tuple[str, float]] = []
+        self.attributes: Dict[str, object] = {}
+
+    def summary(self) -> str:
+        return " ".join(
+            [f"{stage}={seconds:.3f}s" for stage, seconds in self.stages]
+            + [f"{key}={value}" for key, value in self.attributes.items()]
+        )
+
+
+_current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar(
+    "current_trace", default=None
+)
+
+
+def get_trace_id() -> str | None:
+    trace = _current_trace.get()
+    return trace.id if trace is not None else None
+
+
+def add_to_trace(stage: str, seconds: float):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.stages.append((stage, seconds))
+
+
+def set_trace_attribute(key: str, value):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes[key] = value
+
+
+def record_stage(stage: str, seconds: float):
+    CHAT_STAGE_SECONDS.observe(seconds, stage=stage)
+    add_to_trace(stage, seconds)
+
+
+@contextmanager
+def timed_stage(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware that assigns a trace id to every request (or reuses the one
+    sent in the X-Trace-Id header), returns it in the response headers and records
+    the request duration including the streaming of the response body.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        request_trace_id = dict(scope["headers"]).get(TRACE_ID_HEADER.lower().encode())
+        # Cap the length of the trace ids sent by the clients as they end up in the logs
+        trace = Trace(
+            request_trace_id.decode("latin-1")[:64] if request_trace_id else None
+        )
+        token = _current_trace.set(trace)
+        status = 500
+
+        async def send_with_trace_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [
+                    (TRACE_ID_HEADER.lower().encode(), trace.id.encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            _current_trace.reset(token)
+            seconds = time.perf_counter() - start
+            # Use the route template so the paths with parameters share one series,
+            # the static files are not API routes and are counted together
+            route = getattr(scope.get("route"), "path", None) or "other"
+            HTTP_REQUEST_SECONDS.observe(
+                seconds, method=scope["method"], route=route, status=status
+            )
+            if len(trace.stages) > 0:
+                logger.info(
+                    f"trace={trace.id} {scope['method']} {scope['path']} {status} "
+                    f"total={seconds:.3f}s {trace.summary()}"
+                )
@@ -0,0 +1,65 @@
+#!/usr/bin/env node
+
+// Write the gzip and brotli variants of the text files of a static build,
+// so the API serves them as they are instead of compressing on every request.
+// Usage: node scripts/precompress.mjs <directory>...
+
+import { promises as fs } from "fs";
+import path from "path";
+import zlib from "zlib";
+
+const EXTENSIONS = new Set([
+  ".html", ".js", ".mjs", ".css", ".json", ".map", ".svg", ".txt", ".xml", ".ico",
+]);
+// Smaller files don't gain from compression
+const MIN_SIZE = 1024;
+
+async function* walk(directory) {
+  for (const entry of await fs.readdir(directory, { withFileTypes: true })) {
+    const entryPath = path.join(directory, entry.name);
+    if (entry.isDirectory()) {
+      yield* walk(entryPath);
+    } else if (EXTENSIONS.has(path.extname(entry.name))) {
+      yield entryPath;
+    }
+  }
+}
+
+async function writeVariant(filePath, suffix, content, stat) {
+  const variantPath = filePath + suffix;
+  // Only keep the variants that are noticeably smaller
+  if (content.length > stat.size * 0.9) {
+    await fs.rm(variantPath, { force: true });
+    return;
+  }
+  await fs.writeFile(variantPath, content);
+  // The server ignores the variants older than their file
+  await fs.utimes(variantPath, stat.atime, stat.mtime);
+}
+
+async function precompress(directory) {
+  let count = 0;
+  for await (const filePath of walk(directory)) {
+    const stat = await fs.stat(filePath);
+    if (stat.size < MIN_SIZE) continue;
+    const content = await fs.readFile(filePath);
+    await writeVariant(filePath, ".gz", zlib.gzipSync(content, { level: 9 }), stat);
+    await writeVariant(
+      filePath,
+      ".br",
+      zlib.brotliCompressSync(content, {
+        params: {
+          [zlib.constants.BROTLI_PARAM_QUALITY]: zlib.constants.BROTLI_MAX_QUALITY,
+          [zlib.constants.BROTLI_PARAM_SIZE_HINT]: content.length,
+        },
+      }),
+      stat,
+    );
+    count++;
+  }
+  console.log(`Precompressed ${count} files in ${directory}`);
+}
+
+for (const directory of process.argv.slice(2)) {
+  await precompress(directory);
+}
@@ -0,0 +1,28 @@
+async def read_body(receive) -> bytes:
+    """
+    Read the whole body of an HTTP request in an ASGI middleware.
+    """
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            return body
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+
+def replay_body(body: bytes, receive):
+    """
+    Get a receive function that sends the read body to the app again.
+    """
+    body_sent = False
+
+    async def replay_receive():
+        nonlocal body_sent
+        if body_sent:
+            return await receive()
+        body_sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return replay_receive
@@ -0,0 +1,47 @@
+import json
+from pydantic import ValidationError
+from fastapi.responses import JSONResponse
+from app.engine.filters import ChatFilters, use_chat_filters
+from src.asgi import read_body, replay_body
+
+CHAT_PATH = "/api/chat"
+
+
+class ChatFiltersMiddleware:
+    """
+    ASGI middleware that reads the "filters" of the chat requests,
+    e.g. {"filters": {"file_names": ["manual.pdf"], "uploaded_after": "2024-01-01"}},
+    and scopes the retrieval of the request to the matching documents.
+    The chat router of create_llama ignores the fields it doesn't know.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].startswith(CHAT_PATH)
+        ):
+            return await self.app(scope, receive, send)
+
+        body = await read_body(receive)
+        replay_receive = replay_body(body, receive)
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            # The invalid JSON is reported by the chat router
+            data = {}
+        filters = data.get("filters") if isinstance(data, dict) else None
+        if filters is not None:
+            try:
+                filters = ChatFilters.model_validate(filters).to_metadata_filters()
+            except ValidationError as e:
+                response = JSONResponse(
+                    status_code=400,
+                    content={"error": "InvalidFiltersError", "message": str(e)},
+                )
+                return await response(scope, replay_receive, send)
+        with use_chat_filters(filters):
+            await self.app(scope, replay_receive, send)
@@ -0,0 +1,185 @@
+import os
+import math
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from typing import Dict, List
+from fastapi.responses import JSONResponse
+from app.metrics import CHAT_REQUESTS_REJECTED, record_stage
+from src.asgi import read_body, replay_body
+
+
+logger = logging.getLogger("uvicorn")
+
+CHAT_PATH = "/api/chat"
+CLIENT_ID_HEADER = b"x-client-id"
+
+
+class SchedulerSaturatedError(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class BackendScheduler:
+    """
+    Admission control of the chat requests sent to one model backend.
+    At most max_concurrency requests run at once, the others wait in a priority queue
+    for at most max_wait seconds. Short requests go first, then the requests of the
+    clients with the fewest requests in flight, then the oldest requests.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, max_wait: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.running = 0
+        # Heap of [long request, client requests in flight, sequence, future, client]
+        self._waiters: List[list] = []
+        self._clients: Dict[str, int] = {}
+        self._sequence = itertools.count()
+        # Moving average of the request durations to estimate the Retry-After
+        self._request_seconds = 5.0
+
+    def _retry_after(self) -> int:
+        rounds = (len(self._waiters) + 1) / self.max_concurrency
+        return max(1, min(60, math.ceil(rounds * self._request_seconds)))
+
+    def _add_client(self, client: str):
+        self._clients[client] = self._clients.get(client, 0) + 1
+
+    def _remove_client(self, client: str):
+        self._clients[client] -= 1
+        if self._clients[client] == 0:
+            self._clients.pop(client)
+
+    async def acquire(self, client: str, short: bool):
+        if self.running < self.max_concurrency and len(self._waiters) == 0:
+            self.running += 1
+            self._add_client(client)
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise SchedulerSaturatedError(
+                "Too many chat requests, please retry later.", self._retry_after()
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = [
+            not short,
+            self._clients.get(client, 0),
+            next(self._sequence),
+            future,
+            client,
+        ]
+        heapq.heappush(self._waiters, waiter)
+        self._add_client(client)
+        try:
+            await asyncio.wait_for(future, timeout=self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            self._remove_client(client)
+            if future.done() and not future.cancelled():
+                # Admitted while the request was cancelled, pass the slot on
+                self._admit_next()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise SchedulerSaturatedError(
+                f"The chat request waited more than {self.max_wait:.0f}s, please retry later.",
+                self._retry_after(),
+            )
+
+    def _admit_next(self):
+        self.running -= 1
+        while len(self._waiters) > 0:
+            future = heapq.heappop(self._waiters)[3]
+            if not future.done():
+                self.running += 1
+                future.set_result(None)
+                return
+
+    def release(self, client: str, seconds: float):
+        self._remove_client(client)
+        self._request_seconds = 0.9 * self._request_seconds + 0.1 * seconds
+        self._admit_next()
+
+
+class ChatScheduler:
+    """
+    One scheduler per model backend, so a slow backend doesn't hold
+    the requests sent to another one after a config change.
+    """
+
+    def __init__(self):
+        self._backends: Dict[str, BackendScheduler] = {}
+
+    @staticmethod
+    def get_backend_key() -> str:
+        provider = os.getenv("MODEL_PROVIDER", "")
+        if provider == "ollama":
+            return f"{provider}:{os.getenv('OLLAMA_BASE_URL', '')}"
+        return f"{provider}:{os.getenv('MODEL', '')}"
+
+    def get(self, backend_key: str) -> BackendScheduler:
+        if backend_key not in self._backends:
+            self._backends[backend_key] = BackendScheduler(
+                max_concurrency=int(os.getenv("CHAT_MAX_CONCURRENCY", "4")),
+                max_queue=int(os.getenv("CHAT_MAX_QUEUE", "64")),
+                max_wait=float(os.getenv("CHAT_MAX_WAIT_SECONDS", "30")),
+            )
+        return self._backends[backend_key]
+
+
+chat_scheduler = ChatScheduler()
+
+
+class ChatSchedulerMiddleware:
+    """
+    ASGI middleware that admits the chat requests through the scheduler of the
+    configured model backend. The slot is held until the streamed answer is sent,
+    a saturated backend answers 429 with a Retry-After header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.short_request_bytes = int(os.getenv("CHAT_SHORT_REQUEST_BYTES", "2048"))
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].startswith(CHAT_PATH)
+        ):
+            return await self.app(scope, receive, send)
+
+        # The size of the messages decides the priority, replay the body to the app
+        body = await read_body(receive)
+        replay_receive = replay_body(body, receive)
+
+        headers = dict(scope["headers"])
+        client = headers.get(CLIENT_ID_HEADER, b"").decode("latin-1")[:64]
+        if not client and scope.get("client"):
+            client = scope["client"][0]
+        scheduler = chat_scheduler.get(chat_scheduler.get_backend_key())
+
+        start = time.perf_counter()
+        try:
+            await scheduler.acquire(client, len(body) <= self.short_request_bytes)
+        except SchedulerSaturatedError as e:
+            CHAT_REQUESTS_REJECTED.inc()
+            logger.warning(f"Rejected a chat request: {e}")
+            response = JSONResponse(
+                status_code=429,
+                content={"error": "TooManyRequestsError", "message": str(e)},
+                headers={"Retry-After": str(e.retry_after)},
+            )
+            return await response(scope, replay_receive, send)
+        admitted = time.perf_counter()
+        record_stage("queue", admitted - start)
+        try:
+            await self.app(scope, replay_receive, send)
+        finally:
+            scheduler.release(client, time.perf_counter() - admitted)
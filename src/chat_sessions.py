@@ -0,0 +1,69 @@
+import re
+import json
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from app.engine.session import session_store, use_session_id
+from src.asgi import read_body, replay_body
+
+CHAT_PATH = "/api/chat"
+SESSION_ID_HEADER = b"x-session-id"
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class ChatSessionMiddleware:
+    """
+    ASGI middleware that reads the X-Session-Id header of the chat requests,
+    so the chat engine continues the conversation kept on the server.
+    A request for an unknown or expired session without the previous messages
+    is answered with 404, so the client can send the whole conversation again.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def _has_history(body: bytes) -> bool:
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            # The invalid JSON is reported by the chat router
+            return True
+        messages = data.get("messages") if isinstance(data, dict) else None
+        return isinstance(messages, list) and len(messages) > 1
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].startswith(CHAT_PATH)
+        ):
+            return await self.app(scope, receive, send)
+
+        session_id = dict(scope["headers"]).get(SESSION_ID_HEADER)
+        if session_id is not None:
+            session_id = session_id.decode("latin-1")
+            if SESSION_ID_PATTERN.match(session_id) is None:
+                response = JSONResponse(
+                    status_code=400,
+                    content={
+                        "error": "InvalidSessionIdError",
+                        "message": f"Invalid session id: {session_id[:64]}",
+                    },
+                )
+                return await response(scope, receive, send)
+            # Not on the event loop, the shared session store can wait for a lock
+            if await run_in_threadpool(session_store.get, session_id) is None:
+                body = await read_body(receive)
+                receive = replay_body(body, receive)
+                if not self._has_history(body):
+                    response = JSONResponse(
+                        status_code=404,
+                        content={
+                            "error": "SessionNotFoundError",
+                            "message": f"Chat session {session_id} not found,"
+                            " send the previous messages to continue it.",
+                        },
+                    )
+                    return await response(scope, receive, send)
+        with use_session_id(session_id):
+            await self.app(scope, receive, send)
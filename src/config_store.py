@@ -0,0 +1,116 @@
+import os
+import re
+import copy
+import threading
+from typing import Dict, List, Tuple
+import yaml
+from src.constants import ENV_FILE_PATH, TOOL_CONFIG_FILE
+
+
+ENV_LINE_PATTERN = re.compile(r"^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_.]*)\s*=")
+
+
+def _format_env_value(value: str) -> str:
+    # Same quoting as dotenv.set_key
+    return "'{}'".format(value.replace("'", "\\'"))
+
+
+def _atomic_write(path: str, content: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def write_env_file(values: Dict[str, str | None], path: str = ENV_FILE_PATH):
+    """
+    Set (or unset for None values) the given variables in a dot env file in one pass.
+    The other lines and comments are kept, and the file is replaced atomically.
+    """
+    lines: List[str] = []
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+
+    remaining = dict(values)
+    updated_lines = []
+    for line in lines:
+        match = ENV_LINE_PATTERN.match(line)
+        if match is None or match.group(1) not in values:
+            updated_lines.append(line)
+            continue
+        key = match.group(1)
+        # Only keep the first occurrence of a variable
+        if key in remaining:
+            value = remaining.pop(key)
+            if value is not None:
+                updated_lines.append(f"{key}={_format_env_value(value)}")
+    for key, value in remaining.items():
+        if value is not None:
+            updated_lines.append(f"{key}={_format_env_value(value)}")
+    _atomic_write(path, "\n".join(updated_lines) + "\n")
+
+
+class ConfigStore:
+    """
+    In-memory snapshots of the env config and the tools config.
+    The env config snapshot is rebuilt when one of its environment variables changed
+    and the tools config snapshot when the mtime of the tools config file changed,
+    so the config is only parsed and validated again after an update.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._env_config = None
+        self._env_key: Tuple | None = None
+        self._tools_config: Dict | None = None
+        self._tools_key: Tuple | None = None
+
+    @staticmethod
+    def _get_env_key() -> Tuple:
+        from src.models.env_config import EnvConfig
+
+        return tuple(
+            os.environ.get(field_info.json_schema_extra["env"])
+            for field_info in EnvConfig.model_fields.values()
+        )
+
+    def get_env_config(self):
+        from src.models.env_config import EnvConfig
+
+        env_key = self._get_env_key()
+        with self._lock:
+            if self._env_config is None or env_key != self._env_key:
+                self._env_config = EnvConfig()  # type: ignore
+                self._env_key = env_key
+            # Don't share the snapshot with the callers
+            return self._env_config.model_copy()
+
+    @staticmethod
+    def _get_tools_key() -> Tuple | None:
+        try:
+            stat = os.stat(TOOL_CONFIG_FILE)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def get_tools_config(self) -> Dict:
+        tools_key = self._get_tools_key()
+        if tools_key is None:
+            raise FileNotFoundError(f"Tool config file {TOOL_CONFIG_FILE} not found!")
+        with self._lock:
+            if self._tools_config is None or tools_key != self._tools_key:
+                with open(TOOL_CONFIG_FILE, "r") as f:
+                    self._tools_config = yaml.safe_load(f) or {}
+                self._tools_key = tools_key
+            return copy.deepcopy(self._tools_config)
+
+    def write_tools_config(self, config: Dict):
+        _atomic_write(TOOL_CONFIG_FILE, yaml.dump(config))
+        with self._lock:
+            self._tools_config = copy.deepcopy(config)
+            self._tools_key = self._get_tools_key()
+
+
+config_store = ConfigStore()
@@ -1,2 +1,8 @@
 ENV_FILE_PATH = "config/.env"
 TOOL_CONFIG_FILE = "config/tools.yaml"
+LOADER_CONFIG_FILE = "config/loaders.yaml"
+DATA_DIR = "data"
+CONFIG_LOCK_FILE = "config/.config.lock"
+CONFIG_GENERATION_FILE = "config/.config_generation"
+INDEXING_LOCK_FILE = "config/.indexing.lock"
+INDEX_GENERATION_FILE = "config/.index_generation"
@@ -1,59 +1,211 @@
 import os
-from src.tasks.indexing import index_all
-from src.models.file import File, FileStatus, SUPPORTED_FILE_EXTENSIONS
+import hashlib
+import zipfile
+import tempfile
+from collections import Counter
+from typing import BinaryIO, List, Tuple
+from starlette.concurrency import run_in_threadpool
+from src.constants import DATA_DIR
+from src.file_catalog import file_catalog
+from src.tasks.indexing import file_hash
+from src.tasks.jobs import indexing_queue
+from src.models.file import File, FileStatus, IndexingJob, SUPPORTED_FILE_EXTENSIONS
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE_MB", "500")) * 1024 * 1024
 
 
 class UnsupportedFileExtensionError(Exception):
     pass
 
 
+class FileTooLargeError(Exception):
+    pass
+
+
 class FileNotFoundError(Exception):
     pass
 
 
+class InvalidArchiveError(Exception):
+    pass
+
+
+class DuplicateFileNameError(Exception):
+    pass
+
+
 class FileHandler:
 
     @classmethod
-    def get_current_files(cls):
+    def get_current_files(cls, **kwargs) -> Tuple[List[File], str | None]:
         """
-        Construct the list files by all the files in the data folder.
+        Get a page of the files in the data folder from the file catalog
+        and the cursor of the next page.
         """
-        if not os.path.exists("data"):
-            return []
-        # Get all files in the data folder
-        file_names = os.listdir("data")
-        # Construct list[File]
-        return [
-            File(name=file_name, status=FileStatus.UPLOADED) for file_name in file_names
-        ]
+        return file_catalog.list_files(**kwargs)
 
     @classmethod
     async def upload_file(
         cls, file, file_name: str
-    ) -> File | UnsupportedFileExtensionError:
+    ) -> File | UnsupportedFileExtensionError | FileTooLargeError:
         """
         Upload a file to the data folder.
         """
+        res, changed = await run_in_threadpool(cls._store_file, file.file, file_name)
+        if isinstance(res, File) and changed:
+            # Index the data in the background
+            res.job_id = indexing_queue.submit().id
+            file_catalog.set_job([res.name], res.job_id)
+        return res
+
+    @classmethod
+    async def upload_files(
+        cls, files
+    ) -> Tuple[List[File], List[Exception], IndexingJob | None]:
+        """
+        Upload multiple files or zip archives of files to the data folder
+        and index all of them in a single indexing job.
+        """
+        uploaded, errors = [], []
+        any_changed = False
+        for file in files:
+            file_name = str(file.filename)
+            if file_name.split(".")[-1] == "zip":
+                results = await run_in_threadpool(cls._store_zip, file.file, file_name)
+            else:
+                results = [
+                    await run_in_threadpool(cls._store_file, file.file, file_name)
+                ]
+            for res, changed in results:
+                if isinstance(res, File):
+                    uploaded.append(res)
+                    any_changed = any_changed or changed
+                else:
+                    errors.append(res)
+
+        job = indexing_queue.submit() if any_changed else None
+        if job is not None:
+            for res in uploaded:
+                res.job_id = job.id
+            file_catalog.set_job([res.name for res in uploaded], job.id)
+        return uploaded, errors, job
+
+    @classmethod
+    def _store_zip(
+        cls, stream: BinaryIO, archive_name: str
+    ) -> List[Tuple[File | Exception, bool]]:
+        try:
+            archive = zipfile.ZipFile(stream)
+        except zipfile.BadZipFile:
+            return [
+                (
+                    InvalidArchiveError(
+                        f"File {archive_name} is not a valid zip file."
+                    ),
+                    False,
+                )
+            ]
+        results = []
+        with archive:
+            # Flatten the archive, only keep the base name to stay in the data folder
+            members = [
+                (member, os.path.basename(member.filename))
+                for member in archive.infolist()
+                if not member.is_dir()
+                and not os.path.basename(member.filename).startswith(".")
+            ]
+            name_counts = Counter(file_name for _, file_name in members)
+            for member, file_name in members:
+                if name_counts[file_name] > 1:
+                    # Don't let the files of different folders overwrite each other
+                    results.append(
+                        (
+                            DuplicateFileNameError(
+                                f"File {member.filename} of {archive_name} has the same name"
+                                f" as another file of the archive, rename one of them."
+                            ),
+                            False,
+                        )
+                    )
+                    continue
+                try:
+                    with archive.open(member) as member_stream:
+                        results.append(cls._store_file(member_stream, file_name))
+                except (zipfile.BadZipFile, NotImplementedError) as e:
+                    results.append(
+                        (
+                            InvalidArchiveError(
+                                f"File {member.filename} of {archive_name} can't be extracted: {e}"
+                            ),
+                            False,
+                        )
+                    )
+        return results
+
+    @classmethod
+    def _store_file(
+        cls, stream: BinaryIO, file_name: str
+    ) -> Tuple[File | UnsupportedFileExtensionError | FileTooLargeError, bool]:
+        """
+        Copy the stream in chunks to a temp file and move it into the data folder.
+        Returns the result and whether the content of the file has changed.
+        """
         # Check if the file extension is supported
         if file_name.split(".")[-1] not in SUPPORTED_FILE_EXTENSIONS:
-            return UnsupportedFileExtensionError(
-                f"File {file_name} with extension {file_name.split('.')[-1]} is not supported."
+            return (
+                UnsupportedFileExtensionError(
+                    f"File {file_name} with extension {file_name.split('.')[-1]} is not supported."
+                ),
+                False,
             )
+        file_name = os.path.basename(file_name)
         # Create data folder if it does not exist
-        if not os.path.exists("data"):
-            os.makedirs("data")
+        os.makedirs(DATA_DIR, exist_ok=True)
+
+        hasher = hashlib.sha256()
+        size = 0
+        # The temp file is hidden and in the data folder so the rename is atomic
+        fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, prefix=".", suffix=".upload")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MAX_UPLOAD_SIZE:
+                        return (
+                            FileTooLargeError(
+                                f"File {file_name} exceeds the maximum upload size of {MAX_UPLOAD_SIZE // (1024 * 1024)} MB."
+                            ),
+                            False,
+                        )
+                    hasher.update(chunk)
+                    f.write(chunk)
+
+            file_path = os.path.join(DATA_DIR, file_name)
+            if cls._is_same_file(file_path, size, hasher.hexdigest()):
+                # The same content is already there, skip it
+                return File(name=file_name, status=FileStatus.UPLOADED), False
+            os.replace(tmp_path, file_path)
+            file_catalog.add_file(
+                file_name, size, hasher.hexdigest(), os.stat(file_path).st_mtime_ns
+            )
+            return File(name=file_name, status=FileStatus.UPLOADED), True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-        with open(f"data/{file_name}", "wb") as f:
-            f.write(await file.read())
-        # Index the data
-        index_all()
-        return File(name=file_name, status=FileStatus.UPLOADED)
+    @staticmethod
+    def _is_same_file(file_path: str, size: int, content_hash: str) -> bool:
+        if not os.path.exists(file_path) or os.path.getsize(file_path) != size:
+            return False
+        return file_hash(file_path) == content_hash
 
     @classmethod
-    def remove_file(cls, file_name: str) -> None:
+    def remove_file(cls, file_name: str) -> IndexingJob:
         """
         Remove a file from the data folder.
         """
-        os.remove(f"data/{file_name}")
-        # Re-index the data
-        index_all()
+        os.remove(os.path.join(DATA_DIR, file_name))
+        file_catalog.remove_files([file_name])
+        # Re-index the data in the background
+        return indexing_queue.submit()
@@ -1,16 +1,34 @@
 import os
-from typing import List
+import threading
+from typing import Dict, List, Tuple
+
+# The clients of the providers by (provider, base_url), each keeps its connection pool.
+# Only the clients of the app itself (model listing and warm-up) are pooled here,
+# the llama_index LLM and embedding classes used by the chat create their own clients.
+_clients: Dict[Tuple[str, str | None], object] = {}
+_clients_lock = threading.Lock()
 
 
 class AIProvider:
     @staticmethod
-    def fetch_ollama_models(provider_url: str = None) -> List[str]:
+    def get_ollama_client(provider_url: str = None):
         """
-        Fetch all available models from the Ollama provider.
+        Get the shared Ollama client of the given (or the configured) base URL.
         """
         from ollama import Client
 
-        client = Client(host=provider_url or os.getenv("OLLAMA_BASE_URL"))
+        host = provider_url or os.getenv("OLLAMA_BASE_URL")
+        with _clients_lock:
+            if ("ollama", host) not in _clients:
+                _clients[("ollama", host)] = Client(host=host)
+            return _clients[("ollama", host)]
+
+    @classmethod
+    def fetch_ollama_models(cls, provider_url: str = None) -> List[str]:
+        """
+        Fetch all available models from the Ollama provider.
+        """
+        client = cls.get_ollama_client(provider_url)
         res = client.list()
         models = res.get("models", [])
 
@@ -8,6 +8,8 @@ from typing import Dict, Tuple, List
 from src.models.tools import DuckDuckGoTool, WikipediaTool, Tools
 from src.models.env_config import get_config
 from src.constants import TOOL_CONFIG_FILE
+from src.shared_state import config_update
+from src.config_store import config_store
 
 
 class ToolsManager:
@@ -46,15 +48,15 @@ class ToolsManager:
 
     @staticmethod
     def load_config_file() -> Dict:
-        try:
-            with open(TOOL_CONFIG_FILE, "r") as file:
-                return yaml.safe_load(file)
-        except FileNotFoundError:
-            raise FileNotFoundError(f"Tool config file {TOOL_CONFIG_FILE} not found!")
+        return config_store.get_tools_config()
 
     def _update_config_file(self):
-        with open(TOOL_CONFIG_FILE, "w") as file:
-            yaml.dump(self.config, file)
+        from app.engine import invalidate_chat_engine_cache
+
+        with config_update():
+            config_store.write_tools_config(self.config)
+        # The chat engine needs to load the updated tools
+        invalidate_chat_engine_cache()
 
 
 def tools_manager():
@@ -0,0 +1,246 @@
+import os
+import json
+import base64
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+from src.models.file import File, FileStatus
+
+# The columns the files can be sorted by
+SORT_COLUMNS = {
+    "name": "name",
+    "size": "size",
+    "mtime": "mtime_ns",
+    "status": "status",
+    "chunks": "chunks",
+}
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def _encode_cursor(value, name: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([value, name]).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple:
+    try:
+        value, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise InvalidCursorError(f"Invalid cursor: {cursor}")
+    return value, name
+
+
+def _to_datetime(timestamp: float | None) -> datetime | None:
+    return datetime.fromtimestamp(timestamp) if timestamp is not None else None
+
+
+class FileCatalog:
+    """
+    A SQLite table of the files in the data folder with their size, hash, mtime
+    and indexing state, kept in sync by the uploads, the removals and the indexing.
+    The files are listed with keyset pagination on indexed columns, so the cost of
+    a page does not depend on the number of files.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @contextmanager
+    def _connect(self):
+        """
+        Open a connection for one transaction, the worker processes share the file.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY,
+                extension TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                hash TEXT,
+                mtime_ns INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                chunks INTEGER NOT NULL DEFAULT 0,
+                embedding_model TEXT,
+                job_id TEXT,
+                error TEXT,
+                indexed_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS files_extension ON files (extension, name);
+            CREATE INDEX IF NOT EXISTS files_size ON files (size, name);
+            CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime_ns, name);
+            CREATE INDEX IF NOT EXISTS files_status ON files (status, name);
+            CREATE INDEX IF NOT EXISTS files_chunks ON files (chunks, name);
+            """
+        )
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add_file(
+        self,
+        name: str,
+        size: int,
+        content_hash: str | None,
+        mtime_ns: int,
+        status: str = FileStatus.UPLOADED,
+    ):
+        """
+        Add a new or changed file, its indexing state is reset.
+        """
+        self.add_files([(name, size, content_hash, mtime_ns)], status)
+
+    def add_files(
+        self,
+        files: Iterable[Tuple[str, int, str | None, int]],
+        status: str = FileStatus.UPLOADED,
+    ):
+        with self._connect() as db:
+            db.executemany(
+                "INSERT INTO files (name, extension, size, hash, mtime_ns, status) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET size = excluded.size, "
+                "hash = excluded.hash, mtime_ns = excluded.mtime_ns, "
+                "status = excluded.status, chunks = 0, embedding_model = NULL, "
+                "job_id = NULL, error = NULL, indexed_at = NULL",
+                [
+                    (
+                        name,
+                        name.split(".")[-1].lower(),
+                        size,
+                        content_hash,
+                        mtime_ns,
+                        status,
+                    )
+                    for name, size, content_hash, mtime_ns in files
+                ],
+            )
+
+    def remove_files(self, names: List[str]):
+        with self._connect() as db:
+            db.executemany("DELETE FROM files WHERE name = ?", [(n,) for n in names])
+
+    def get_file_stats(self) -> Dict[str, Tuple[int, int, str | None]]:
+        """
+        Get the (size, mtime_ns, hash) of every file, to only hash the modified files.
+        """
+        with self._connect() as db:
+            rows = db.execute("SELECT name, size, mtime_ns, hash FROM files")
+            return {row[0]: (row[1], row[2], row[3]) for row in rows}
+
+    def get_names(self, status: str) -> List[str]:
+        with self._connect() as db:
+            rows = db.execute("SELECT name FROM files WHERE status = ?", (status,))
+            return [row[0] for row in rows]
+
+    def set_job(self, names: List[str], job_id: str):
+        with self._connect() as db:
+            db.executemany(
+                "UPDATE files SET job_id = ? WHERE name = ?",
+                [(job_id, name) for name in names],
+            )
+
+    def set_status(self, names: List[str], status: str, error: str | None = None):
+        with self._connect() as db:
+            db.executemany(
+                "UPDATE files SET status = ?, error = ? WHERE name = ?",
+                [(status, error, name) for name in names],
+            )
+
+    def set_indexed(self, name: str, chunks: int, embedding_model: str | None):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE files SET status = ?, chunks = ?, embedding_model = ?, "
+                "error = NULL, indexed_at = ? WHERE name = ?",
+                (
+                    FileStatus.INDEXED,
+                    chunks,
+                    embedding_model,
+                    datetime.now().timestamp(),
+                    name,
+                ),
+            )
+
+    def list_files(
+        self,
+        limit: int = 100,
+        cursor: str | None = None,
+        sort: str = "name",
+        descending: bool = False,
+        status: str | None = None,
+        extension: str | None = None,
+        search: str | None = None,
+    ) -> Tuple[List[File], str | None]:
+        """
+        Get a page of files and the cursor of the next page, None on the last page.
+        """
+        column = SORT_COLUMNS[sort]
+        conditions, params = [], []
+        if status is not None:
+            conditions.append("status = ?")
+            params.append(status)
+        if extension is not None:
+            conditions.append("extension = ?")
+            params.append(extension.lstrip(".").lower())
+        if search:
+            conditions.append("name LIKE ? ESCAPE '\\'")
+            for char in ("\\", "%", "_"):
+                search = search.replace(char, f"\\{char}")
+            params.append(f"%{search}%")
+        if cursor is not None:
+            value, name = _decode_cursor(cursor)
+            comparison = "<" if descending else ">"
+            if column == "name":
+                conditions.append(f"name {comparison} ?")
+                params.append(name)
+            else:
+                conditions.append(
+                    f"({column} {comparison} ? OR ({column} = ? AND name {comparison} ?))"
+                )
+                params.extend([value, value, name])
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        direction = "DESC" if descending else "ASC"
+        if column == "name":
+            order_by = f"name {direction}"
+        else:
+            order_by = f"{column} {direction}, name {direction}"
+
+        with self._connect() as db:
+            rows = db.execute(
+                f"SELECT * FROM files {where} ORDER BY {order_by} LIMIT ?",
+                params + [limit + 1],
+            ).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = _encode_cursor(rows[-1][column], rows[-1]["name"])
+        return [self._to_file(row) for row in rows], next_cursor
+
+    @staticmethod
+    def _to_file(row: sqlite3.Row) -> File:
+        return File(
+            name=row["name"],
+            status=row["status"],
+            job_id=row["job_id"],
+            size=row["size"],
+            hash=row["hash"],
+            modified_at=_to_datetime(row["mtime_ns"] / 1e9),
+            chunks=row["chunks"],
+            embedding_model=row["embedding_model"],
+            indexed_at=_to_datetime(row["indexed_at"]),
+            error=row["error"],
+        )
+
+
+file_catalog = FileCatalog(
+    # Keep it outside of STORAGE_DIR so it survives a rebuild of the index
+    path=os.getenv("FILE_CATALOG_PATH", "storage/files.sqlite"),
+)
@@ -1,5 +1,4 @@
 import os
-import dotenv
 from typing import Optional, Annotated
 from pydantic import (
     BaseModel,
@@ -11,7 +10,6 @@ from pydantic import (
     computed_field,
 )
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from src.constants import ENV_FILE_PATH
 
 
 class EnvConfig(BaseSettings):
@@ -53,6 +51,26 @@ class EnvConfig(BaseSettings):
         description="The base URL for the Ollama API.",
         env="OLLAMA_BASE_URL",
     )
+    retrieval_mode: str | None = Field(
+        default="vector",
+        description='The retrieval mode: "vector" or "hybrid" (BM25 and vector).',
+        env="RETRIEVAL_MODE",
+    )
+    reranker: str | None = Field(
+        default=None,
+        description='The reranker of the retrieved nodes: "lexical", "cross-encoder:<model>" or empty to disable reranking.',
+        env="RERANKER",
+    )
+    rerank_candidates: int | None = Field(
+        default=30,
+        description="The number of nodes retrieved to be reranked, the best TOP_K nodes are kept.",
+        env="RERANK_CANDIDATES",
+    )
+    rerank_timeout_ms: int | None = Field(
+        default=200,
+        description="The latency budget of the reranking in milliseconds, the retrieval order is used when it is exceeded.",
+        env="RERANK_TIMEOUT_MS",
+    )
     system_prompt: str | None = Field(
         default="You are a helpful assistant who helps users with their questions.",
         description="The system prompt to use for the LLM.",
@@ -91,15 +109,17 @@ class EnvConfig(BaseSettings):
 
     def to_env_file(self):
         """
-        Write the current values to a dot env file.
+        Write the current values to the dot env file in one pass.
         """
-        dotenv_file = dotenv.find_dotenv(filename=ENV_FILE_PATH)
+        from src.config_store import write_env_file
+
+        values = {}
         for field_name, field_info in self.__fields__.items():
             value = getattr(self, field_name)
-            if value is not None:
-                dotenv.set_key(dotenv_file, field_info.json_schema_extra.get("env"), str(value))  # type: ignore
-            else:
-                dotenv.unset_key(dotenv_file, field_info.json_schema_extra.get("env"))
+            values[field_info.json_schema_extra.get("env")] = (
+                str(value) if value is not None else None
+            )
+        write_env_file(values)
 
     def to_api_response(self):
         """
@@ -112,4 +132,6 @@ class EnvConfig(BaseSettings):
 
 
 def get_config() -> EnvConfig:
-    return EnvConfig()  # type: ignore
+    from src.config_store import config_store
+
+    return config_store.get_env_config()
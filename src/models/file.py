@@ -1,4 +1,6 @@
 import os
+import uuid
+from datetime import datetime
 from pydantic import BaseModel
 from pydantic import Field
 
@@ -8,11 +10,45 @@ SUPPORTED_FILE_EXTENSIONS = ["txt", "pdf", "csv"]
 class FileStatus:
     UPLOADED = "uploaded"
     UPLOADING = "uploading"
+    # The indexing state of a file in the file catalog
+    INDEXING = "indexing"
+    INDEXED = "indexed"
+    INDEXING_FAILED = "indexing_failed"
+
+
+class IndexingStatus(FileStatus):
+    """
+    The file status extended with the stages of an indexing job.
+    """
+
+    QUEUED = "queued"
+    PARSING = "parsing"
+    EMBEDDING = "embedding"
+    DONE = "done"
+    FAILED = "failed"
 
 
 class File(BaseModel):
     name: str = Field(..., description="The name of the file.")
     status: str = Field(..., description="The status of the file.")
+    job_id: str | None = Field(
+        default=None, description="The id of the indexing job for the file."
+    )
+    size: int | None = Field(default=None, description="The size in bytes.")
+    hash: str | None = Field(default=None, description="The sha256 of the content.")
+    modified_at: datetime | None = Field(
+        default=None, description="The last modification time of the file."
+    )
+    chunks: int = Field(default=0, description="The number of indexed chunks.")
+    embedding_model: str | None = Field(
+        default=None, description="The embedding model the file was indexed with."
+    )
+    indexed_at: datetime | None = Field(
+        default=None, description="The time the file was last indexed."
+    )
+    error: str | None = Field(
+        default=None, description="The error message if the indexing failed."
+    )
 
     class Config:
         json_schema_extra = {
@@ -21,3 +57,53 @@ class File(BaseModel):
                 "status": "uploaded",
             }
         }
+
+
+class IndexingJob(BaseModel):
+    id: str = Field(
+        default_factory=lambda: uuid.uuid4().hex,
+        description="The id of the indexing job.",
+    )
+    status: str = Field(
+        default=IndexingStatus.QUEUED, description="The status of the indexing job."
+    )
+    total_files: int = Field(
+        default=0, description="The number of new or changed files to index."
+    )
+    parsed_files: int = Field(default=0, description="The number of parsed files.")
+    embedded_files: int = Field(default=0, description="The number of embedded files.")
+    embedded_nodes: int = Field(default=0, description="The number of embedded nodes.")
+    removed_files: int = Field(
+        default=0, description="The number of files removed from the index."
+    )
+    failed_files: int = Field(
+        default=0, description="The number of files that failed to be parsed."
+    )
+    rebuild: bool = Field(
+        default=False,
+        description="Whether the job rebuilds the whole index into a new version.",
+    )
+    error: str | None = Field(
+        default=None, description="The error message if the job failed."
+    )
+    created_at: datetime = Field(default_factory=datetime.now)
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (IndexingStatus.DONE, IndexingStatus.FAILED)
+
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "id": "5f0c6f1e8a9b4c2d9e7f3a1b2c4d6e8f",
+                "status": "embedding",
+                "total_files": 3,
+                "parsed_files": 3,
+                "embedded_files": 1,
+                "embedded_nodes": 42,
+                "removed_files": 0,
+                "failed_files": 0,
+            }
+        }
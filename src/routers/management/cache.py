@@ -0,0 +1,25 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+cache_router = r = APIRouter()
+
+
+@r.get("")
+def get_cache_stats():
+    """
+    Get the hit rate and latency savings of the semantic response cache.
+    """
+    from app.engine.semantic_cache import semantic_cache
+
+    return semantic_cache.get_stats()
+
+
+@r.delete("")
+def clear_cache():
+    """
+    Remove all cached answers.
+    """
+    from app.engine.semantic_cache import semantic_cache
+
+    semantic_cache.clear()
+    return JSONResponse(content={"message": "Cache cleared."})
@@ -3,8 +3,9 @@ from fastapi import APIRouter, Depends, Query
 from fastapi.responses import JSONResponse
 from src.models.env_config import EnvConfig, get_config
 from src.controllers.providers import AIProvider
-from src.tasks.indexing import reset_index
-from create_llama.backend.app.settings import init_settings
+from src.tasks.jobs import indexing_queue
+from src.shared_state import config_update
+from src.tasks.warmup import model_warmup
 
 config_router = r = APIRouter()
 
@@ -21,17 +22,28 @@ def update_config(
     new_config: EnvConfig,
     config: EnvConfig = Depends(get_config),
 ):
-    # Update config
-    new_config.to_runtime_env()
-    new_config.to_env_file()
+    from app.engine import invalidate_chat_engine_cache
+    from app.engine.index_version import remember_embed_model
+    from create_llama.backend.app.settings import init_settings
+
+    # The chat keeps querying the active index with the current embedding model
+    # until the index of the new config is built
+    remember_embed_model()
+    # Update config, the other workers reload it on their next request
+    with config_update():
+        new_config.to_runtime_env()
+        new_config.to_env_file()
     # If the new config has a different model provider
     # Or the AI config has not been configured yet
     # We need to:
     # 1. Reload the llama_index settings
-    # 2. Reset the index
+    # 2. Rebuild the index in the background, the chat uses the current index meanwhile
     init_settings()
+    invalidate_chat_engine_cache()
+    model_warmup.start()
+    job = None
     if (new_config.model_provider != config.model_provider) or not config.configured:
-        reset_index()
+        job = indexing_queue.submit(rebuild=True)
 
     # Response with the updated config
     config = get_config()
@@ -39,10 +51,27 @@ def update_config(
         {
             "message": "Config updated successfully.",
             "data": config.to_api_response(),
+            "job_id": job.id if job else None,
         }
     )
 
 
+@r.get("/ready")
+def get_readiness():
+    """
+    Report whether the configured models are loaded and ready to answer quickly,
+    and the duration of the startup of this worker.
+    An app that is not configured yet is reported as ready with "configured": false.
+    The hosted models are not warmed up by default, they are reported as ready
+    with "skipped": true.
+    """
+    from src.startup import startup_report
+
+    status = model_warmup.get_status()
+    status["startup"] = startup_report.to_dict()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+
 @r.get("/models")
 def get_available_models(
     provider: Optional[str] = Query(
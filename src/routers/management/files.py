@@ -1,17 +1,113 @@
-from fastapi import APIRouter, UploadFile
-from fastapi.responses import JSONResponse
-from src.models.file import File
-from src.controllers.files import FileHandler, UnsupportedFileExtensionError
+import asyncio
+from typing import Literal
+from fastapi import APIRouter, Query, Response, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+from src.models.file import File, IndexingJob
+from src.file_catalog import InvalidCursorError
+from src.controllers.files import (
+    FileHandler,
+    FileTooLargeError,
+    UnsupportedFileExtensionError,
+)
+from src.tasks.jobs import indexing_queue
 
 files_router = r = APIRouter()
 
 
 @r.get("")
-def fetch_files() -> list[File]:
+def fetch_files(
+    response: Response,
+    limit: int = Query(100, ge=1, le=1000, description="The number of files."),
+    cursor: str | None = Query(
+        None, description="The X-Next-Cursor header of the previous page."
+    ),
+    sort: Literal["name", "size", "mtime", "status", "chunks"] = "name",
+    order: Literal["asc", "desc"] = "asc",
+    status: str | None = Query(None, description="Only the files with this status."),
+    extension: str | None = Query(
+        None, description="Only the files with this extension."
+    ),
+    search: str | None = Query(
+        None, description="Only the files with a name containing this text."
+    ),
+) -> list[File]:
     """
-    Get the current files.
+    Get a page of the current files.
+    The cursor of the next page is returned in the X-Next-Cursor header.
     """
-    return FileHandler.get_current_files()
+    try:
+        files, next_cursor = FileHandler.get_current_files(
+            limit=limit,
+            cursor=cursor,
+            sort=sort,
+            descending=order == "desc",
+            status=status,
+            extension=extension,
+            search=search,
+        )
+    except InvalidCursorError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"error": "InvalidCursorError", "message": str(e)},
+        )
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return files
+
+
+@r.get("/jobs")
+def fetch_indexing_jobs() -> list[IndexingJob]:
+    """
+    Get the recent indexing jobs, latest first.
+    """
+    return indexing_queue.get_jobs()
+
+
+def _job_not_found(job_id: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=404,
+        content={
+            "error": "JobNotFoundError",
+            "message": f"Indexing job {job_id} not found.",
+        },
+    )
+
+
+@r.get("/jobs/{job_id}")
+def fetch_indexing_job(job_id: str):
+    """
+    Get the status and progress of an indexing job.
+    """
+    job = indexing_queue.get_job(job_id)
+    if job is None:
+        return _job_not_found(job_id)
+    return job
+
+
+@r.get("/jobs/{job_id}/events")
+async def stream_indexing_job(job_id: str, interval: float = 0.5):
+    """
+    Stream the progress of an indexing job as server-sent events until it is finished.
+    """
+    job = indexing_queue.get_job(job_id)
+    if job is None:
+        return _job_not_found(job_id)
+
+    async def event_generator():
+        last_event = None
+        job_state = job
+        while True:
+            # The job of another worker is only a snapshot, read it again
+            job_state = indexing_queue.get_job(job_id) or job_state
+            event = job_state.model_dump_json()
+            if event != last_event:
+                yield f"data: {event}\n\n"
+                last_event = event
+            if job_state.finished:
+                break
+            await asyncio.sleep(interval)
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 
 @r.post("")
@@ -29,16 +125,46 @@ async def add_file(file: UploadFile):
                 "message": str(res),
             },
         )
+    if isinstance(res, FileTooLargeError):
+        return JSONResponse(
+            status_code=413,
+            content={
+                "error": "FileTooLargeError",
+                "message": str(res),
+            },
+        )
     return res
 
 
+@r.post("/bulk")
+async def add_files(files: list[UploadFile]):
+    """
+    Upload multiple files or zip archives, all of them are indexed in a single job.
+    The files that can't be uploaded are reported as errors, with a 400 status if none
+    could be uploaded.
+    """
+    uploaded, errors, job = await FileHandler.upload_files(files)
+    return JSONResponse(
+        # Nothing could be uploaded, e.g. a corrupt zip file
+        status_code=400 if len(uploaded) == 0 and len(errors) > 0 else 200,
+        content={
+            "files": [file.model_dump() for file in uploaded],
+            "errors": [
+                {"error": type(error).__name__, "message": str(error)}
+                for error in errors
+            ],
+            "job_id": job.id if job else None,
+        },
+    )
+
+
 @r.delete("/{file_name}")
 def remove_file(file_name: str):
     """
     Remove a file.
     """
     try:
-        FileHandler.remove_file(file_name)
+        job = FileHandler.remove_file(file_name)
     except FileNotFoundError:
         return JSONResponse(
             status_code=404,
@@ -49,5 +175,8 @@ def remove_file(file_name: str):
         )
     return JSONResponse(
         status_code=200,
-        content={"message": f"File {file_name} removed successfully."},
+        content={
+            "message": f"File {file_name} removed successfully.",
+            "job_id": job.id,
+        },
     )
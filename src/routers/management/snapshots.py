@@ -0,0 +1,67 @@
+import os
+import tempfile
+from datetime import datetime
+from fastapi import APIRouter, UploadFile
+from fastapi.responses import FileResponse, JSONResponse
+from starlette.background import BackgroundTask
+
+snapshots_router = r = APIRouter()
+
+
+@r.get("")
+def export_snapshot():
+    """
+    Download a snapshot of the active index: the nodes with their embeddings,
+    the doc store and the file manifest, as a gzipped tar file.
+    """
+    from src.tasks.snapshot import export_snapshot
+
+    fd, path = tempfile.mkstemp(suffix=".tar.gz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            export_snapshot(f)
+    except Exception:
+        os.remove(path)
+        raise
+    file_name = f"index-snapshot-{datetime.now().strftime('%Y%m%d-%H%M%S')}.tar.gz"
+    return FileResponse(
+        path,
+        media_type="application/gzip",
+        filename=file_name,
+        # Remove the file once it is sent
+        background=BackgroundTask(os.remove, path),
+    )
+
+
+@r.post("")
+def import_snapshot(file: UploadFile):
+    """
+    Replace the index with an uploaded snapshot, without embedding the documents again.
+    The embedding model of the config must be the one the snapshot was created with.
+    """
+    from src.tasks.snapshot import (
+        EmbeddingMismatchError,
+        SnapshotError,
+        import_snapshot,
+    )
+
+    try:
+        header = import_snapshot(file.file)
+    except EmbeddingMismatchError as e:
+        return JSONResponse(
+            status_code=409,
+            content={"error": "EmbeddingMismatchError", "message": str(e)},
+        )
+    except SnapshotError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"error": "SnapshotError", "message": str(e)},
+        )
+    return JSONResponse(
+        content={
+            "message": "Snapshot imported.",
+            "created_at": header["created_at"],
+            "nodes": header["nodes"],
+            "files": len(header["files"]),
+        }
+    )
@@ -32,3 +32,24 @@ def update_tool(
     """
     tools_manager.update_tool(tool_name, data)
     return JSONResponse(content={"message": "Tool updated."})
+
+
+@r.get("/stats")
+def get_tool_stats():
+    """
+    Get the tool result cache stats and the latency of every tool called by the agent.
+    """
+    from app.engine.tool_cache import tool_cache
+
+    return tool_cache.get_stats()
+
+
+@r.delete("/cache")
+def clear_tool_cache():
+    """
+    Remove all cached tool results.
+    """
+    from app.engine.tool_cache import tool_cache
+
+    tool_cache.clear()
+    return JSONResponse(content={"message": "Tool cache cleared."})
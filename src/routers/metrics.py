@@ -0,0 +1,16 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+metrics_router = r = APIRouter()
+
+
+@r.get("")
+def get_metrics():
+    """
+    Get the metrics in the Prometheus text format, summed over all the workers.
+    """
+    from app.metrics import render_metrics
+
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -0,0 +1,54 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+sessions_router = r = APIRouter()
+
+
+def _session_not_found(session_id: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=404,
+        content={
+            "error": "SessionNotFoundError",
+            "message": f"Chat session {session_id} not found.",
+        },
+    )
+
+
+@r.post("")
+def create_session():
+    """
+    Create a chat session. Send its id in the X-Session-Id header of the chat
+    requests, together with the new message only, the history is kept on the server.
+    """
+    from app.engine.session import session_store
+
+    return {"session_id": session_store.create().session_id}
+
+
+@r.get("")
+def get_session_stats():
+    from app.engine.session import session_store
+
+    return session_store.get_stats()
+
+
+@r.get("/{session_id}")
+def get_session(session_id: str):
+    """
+    Get the summary and the recent messages of a chat session.
+    """
+    from app.engine.session import session_store
+
+    session = session_store.get(session_id)
+    if session is None:
+        return _session_not_found(session_id)
+    return session.to_dict()
+
+
+@r.delete("/{session_id}")
+def delete_session(session_id: str):
+    from app.engine.session import session_store
+
+    if not session_store.delete(session_id):
+        return _session_not_found(session_id)
+    return JSONResponse(content={"message": "Session deleted."})
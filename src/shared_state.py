@@ -0,0 +1,165 @@
+import os
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from src.constants import (
+    CONFIG_GENERATION_FILE,
+    CONFIG_LOCK_FILE,
+    ENV_FILE_PATH,
+    INDEX_GENERATION_FILE,
+    INDEXING_LOCK_FILE,
+)
+
+
+logger = logging.getLogger("uvicorn")
+
+
+@contextmanager
+def file_lock(path: str, shared: bool = False):
+    """
+    Hold an advisory lock on the given file, shared between all worker processes.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Generation:
+    """
+    A counter stored in a file, incremented by the worker that changes the shared state.
+    The file is only a few bytes, so the other workers read it on every check.
+    Caching it by inode would miss a change, as the inode freed by one replace
+    can be reused by the next one.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # The generation applied by this worker
+        self.seen = self.read()
+
+    def read(self) -> int:
+        try:
+            with open(self.path, "r") as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def has_changed(self) -> bool:
+        return self.read() != self.seen
+
+    def increment(self):
+        """
+        Increment the generation, the caller must hold the lock of the shared state.
+        """
+        value = self.read() + 1
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(value))
+        os.replace(tmp_path, self.path)
+        self.seen = value
+
+
+config_generation = Generation(CONFIG_GENERATION_FILE)
+index_generation = Generation(INDEX_GENERATION_FILE)
+_reload_lock = threading.Lock()
+# The config generation loaded by the main process, inherited by the workers
+CONFIG_GENERATION_ENV = "RAGBOX_CONFIG_GENERATION"
+
+
+@contextmanager
+def config_update():
+    """
+    Update the config files while no other worker updates or reads them,
+    then tell the other workers to reload the config.
+    """
+    with file_lock(CONFIG_LOCK_FILE):
+        yield
+        config_generation.increment()
+
+
+def indexing_lock():
+    """
+    Make sure only one worker modifies the index at a time.
+    """
+    return file_lock(INDEXING_LOCK_FILE)
+
+
+def load_env_file():
+    """
+    Apply the env file to the environment variables of this worker,
+    the config fields removed from the file are removed from the environment too.
+    """
+    import dotenv
+    from src.models.env_config import EnvConfig
+
+    values = dotenv.dotenv_values(ENV_FILE_PATH)
+    for field_info in EnvConfig.model_fields.values():
+        env = field_info.json_schema_extra["env"]
+        if env not in values:
+            os.environ.pop(env, None)
+    for key, value in values.items():
+        if value is not None:
+            os.environ[key] = value
+
+
+def init_shared_state():
+    """
+    Called on the startup of every worker. The workers inherit the environment of the
+    main process, so a worker started after a config update must load the config file.
+    """
+    inherited_generation = os.environ.setdefault(
+        CONFIG_GENERATION_ENV, str(config_generation.seen)
+    )
+    if int(inherited_generation) != config_generation.seen:
+        load_env_file()
+
+
+def has_shared_state_changed() -> bool:
+    return config_generation.has_changed() or index_generation.has_changed()
+
+
+def reload_shared_state():
+    """
+    Reload the config or the index if another worker changed them.
+    """
+    from app.engine import invalidate_chat_engine_cache
+    from app.engine.index_version import remember_embed_model
+    from create_llama.backend.app.settings import init_settings
+    from src.tasks.warmup import model_warmup
+
+    with _reload_lock:
+        if config_generation.has_changed():
+            with file_lock(CONFIG_LOCK_FILE, shared=True):
+                generation = config_generation.read()
+                logger.info(f"Reloading the config (generation {generation})")
+                remember_embed_model()
+                load_env_file()
+                init_settings()
+                config_generation.seen = generation
+            invalidate_chat_engine_cache()
+            model_warmup.start()
+        if index_generation.has_changed():
+            index_generation.seen = index_generation.read()
+            invalidate_chat_engine_cache()
+
+
+class SharedStateMiddleware:
+    """
+    ASGI middleware that checks the shared config and index generations before
+    every request and reloads them when another worker changed them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and has_shared_state_changed():
+            from starlette.concurrency import run_in_threadpool
+
+            await run_in_threadpool(reload_shared_state)
+        await self.app(scope, receive, send)
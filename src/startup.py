@@ -0,0 +1,40 @@
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict
+
+
+logger = logging.getLogger("uvicorn")
+
+
+class StartupReport:
+    """
+    The duration of the startup phases of the API process, from the import of this
+    module (the first import of main.py) until the app is started.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.total: float | None = None
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    def finish(self):
+        self.total = time.perf_counter() - self.start
+        phases = " ".join(
+            f"{name}={seconds:.3f}s" for name, seconds in self.phases.items()
+        )
+        logger.info(f"Started in {self.total:.3f}s {phases}")
+
+    def to_dict(self) -> dict:
+        return {"total_seconds": self.total, "phases": dict(self.phases)}
+
+
+startup_report = StartupReport()
@@ -0,0 +1,235 @@
+import os
+import re
+import anyio
+from mimetypes import guess_type
+from email.utils import parsedate
+from typing import List, Tuple
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Receive, Scope, Send
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+# The content encodings of the precompressed files, in order of preference
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+# The Next.js build assets have a hash in their path, they never change
+IMMUTABLE_PATH_PATTERN = re.compile(r"(^|/)_next/static/")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# The other files are cached but revalidated with their ETag on every use
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+class RangeNotSatisfiableError(Exception):
+    pass
+
+
+def parse_range(range_header: str, size: int) -> Tuple[int, int] | None:
+    """
+    Get the (start, end) bytes of a single range request, end included.
+    Returns None for the ranges that are not supported, e.g. multiple ranges,
+    so the whole file is sent.
+    """
+    match = RANGE_PATTERN.match(range_header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if start == "":
+        if end == "":
+            return None
+        # The last bytes of the file
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiableError()
+    return start, end
+
+
+def get_accepted_encodings(accept_encoding: str) -> List[str]:
+    encodings = []
+    for item in accept_encoding.split(","):
+        encoding, _, params = item.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        encodings.append(encoding.strip().lower())
+    return encodings
+
+
+class FileRangeResponse(FileResponse):
+    """
+    Send the bytes from start to end (included) of a file as 206 Partial Content,
+    e.g. for a PDF viewer loading the pages of a large document on demand.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        start: int,
+        end: int,
+        stat_result: os.stat_result,
+        **kwargs,
+    ):
+        super().__init__(path, status_code=206, stat_result=stat_result, **kwargs)
+        self.start = start
+        self.end = end
+        self.headers["content-length"] = str(end - start + 1)
+        self.headers["content-range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as file:
+                await file.seek(self.start)
+                remaining = self.end - self.start + 1
+                more_body = True
+                while more_body:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    remaining -= len(chunk)
+                    # Stop at the end of the file if it was truncated meanwhile
+                    more_body = remaining > 0 and len(chunk) > 0
+                    await send(
+                        {
+                            "type": "http.response.body",
+                            "body": chunk,
+                            "more_body": more_body,
+                        }
+                    )
+        if self.background is not None:
+            await self.background()
+
+
+class CachedStaticFiles(StaticFiles):
+    """
+    Static files with HTTP caching:
+    - Range requests are answered with the requested bytes (206).
+    - Conditional requests are answered with 304 if the ETag or Last-Modified match,
+      and If-Range only sends the range of an unchanged file.
+    - The hashed build assets are cached as immutable, the other files are revalidated.
+    - With precompressed=True, the .br or .gz file next to a file is sent
+      if the client accepts its encoding, so nothing is compressed per request.
+    """
+
+    def __init__(self, *args, precompressed: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.precompressed = precompressed
+
+    def is_not_modified(
+        self, response_headers: Headers, request_headers: Headers
+    ) -> bool:
+        # If-Modified-Since is only used by the clients that don't send an ETag
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            etag = response_headers.get("etag")
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+        if_modified_since = parsedate(request_headers.get("if-modified-since", ""))
+        last_modified = parsedate(response_headers.get("last-modified", ""))
+        return (
+            if_modified_since is not None
+            and last_modified is not None
+            and if_modified_since >= last_modified
+        )
+
+    @staticmethod
+    def _is_range_fresh(response_headers: Headers, request_headers: Headers) -> bool:
+        """
+        Whether the range can be sent, If-Range must match the current file exactly.
+        """
+        if_range = request_headers.get("if-range")
+        if if_range is None:
+            return True
+        if if_range.startswith(('"', "W/")):
+            # A weak ETag never matches, it can't be used to combine ranges
+            return if_range == response_headers.get("etag")
+        return if_range == response_headers.get("last-modified")
+
+    def _get_encoded_file(
+        self, full_path: str, stat_result: os.stat_result, request_headers: Headers
+    ) -> Tuple[str, os.stat_result, str] | None:
+        accepted = get_accepted_encodings(request_headers.get("accept-encoding", ""))
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            try:
+                encoded_stat = os.stat(f"{full_path}{suffix}")
+            except OSError:
+                continue
+            # Ignore a variant older than the file, it was not rebuilt with it
+            if encoded_stat.st_mtime >= stat_result.st_mtime:
+                return f"{full_path}{suffix}", encoded_stat, encoding
+        return None
+
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        cache_control = (
+            IMMUTABLE_CACHE_CONTROL
+            if IMMUTABLE_PATH_PATTERN.search(scope["path"])
+            else REVALIDATE_CACHE_CONTROL
+        )
+        headers = {"cache-control": cache_control, "accept-ranges": "bytes"}
+        if self.precompressed:
+            headers["vary"] = "Accept-Encoding"
+
+        range_header = request_headers.get("range")
+        encoded_file = None
+        # The ranges are sent from the uncompressed file
+        if self.precompressed and range_header is None and status_code == 200:
+            encoded_file = self._get_encoded_file(
+                full_path, stat_result, request_headers
+            )
+        if encoded_file is not None:
+            encoded_path, encoded_stat, encoding = encoded_file
+            headers["content-encoding"] = encoding
+            response = FileResponse(
+                encoded_path,
+                status_code=status_code,
+                headers=headers,
+                # The type of the original file, not of the compressed file
+                media_type=guess_type(full_path)[0] or "text/plain",
+                stat_result=encoded_stat,
+            )
+        else:
+            response = FileResponse(
+                full_path,
+                status_code=status_code,
+                headers=headers,
+                stat_result=stat_result,
+            )
+        if status_code != 200:
+            return response
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+
+        if range_header is not None and self._is_range_fresh(
+            response.headers, request_headers
+        ):
+            try:
+                byte_range = parse_range(range_header, stat_result.st_size)
+            except RangeNotSatisfiableError:
+                return Response(
+                    status_code=416,
+                    headers={"content-range": f"bytes */{stat_result.st_size}"},
+                )
+            if byte_range is not None:
+                return FileRangeResponse(
+                    full_path,
+                    *byte_range,
+                    stat_result=stat_result,
+                    headers=headers,
+                )
+        return response
@@ -0,0 +1,236 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Sequence
+import numpy as np
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.schema import BaseNode, MetadataMode, TransformComponent
+from app.metrics import EMBED_BATCH_SECONDS, EMBED_CACHE_TEXTS
+
+
+logger = logging.getLogger("uvicorn")
+
+KEY_SIZE = hashlib.sha256().digest_size
+
+
+# The options of the embedding models that change their embeddings
+EMBEDDING_MODEL_OPTIONS = ("dimensions", "base_url")
+
+
+def get_embedding_model_id(embed_model) -> str:
+    """
+    The model class and name with the options changing the embeddings, e.g. the
+    dimensions of an OpenAI model or the server of an Ollama model.
+    """
+    model_id = f"{type(embed_model).__name__}:{embed_model.model_name}"
+    for option in EMBEDDING_MODEL_OPTIONS:
+        value = getattr(embed_model, option, None)
+        if value is not None:
+            model_id += f":{option}={value}"
+    return model_id
+
+
+class EmbeddingCache:
+    """
+    An append-only on-disk cache of embeddings for one embedding model.
+    The embeddings are stored as a memory-mapped float32 matrix with a sidecar file
+    of the sha256 digests of the embedded texts, one row per digest.
+    """
+
+    def __init__(self, cache_dir: str, model_id: str):
+        model_key = hashlib.sha1(model_id.encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, model_key)
+        self.model_id = model_id
+        self.dim: int | None = None
+        self._rows: Dict[bytes, int] = {}
+        self._num_rows = 0
+        self._vectors: np.memmap | None = None
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self._load()
+
+    @property
+    def _meta_file(self) -> str:
+        return os.path.join(self.path, "meta.json")
+
+    @property
+    def _keys_file(self) -> str:
+        return os.path.join(self.path, "keys.bin")
+
+    @property
+    def _vectors_file(self) -> str:
+        return os.path.join(self.path, "vectors.f32")
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    @staticmethod
+    def text_key(text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def _load(self):
+        if not os.path.exists(self._meta_file):
+            return
+        with open(self._meta_file, "r") as f:
+            self.dim = json.load(f)["dim"]
+        with open(self._keys_file, "rb") as f:
+            keys = f.read()
+        # An interrupted append can leave a partial row, only keep the complete ones
+        rows = min(
+            len(keys) // KEY_SIZE,
+            os.path.getsize(self._vectors_file) // (4 * self.dim),
+        )
+        self._rows = {keys[i * KEY_SIZE : (i + 1) * KEY_SIZE]: i for i in range(rows)}
+        self._num_rows = rows
+        self._truncate(rows)
+        self._map_vectors()
+
+    def _truncate(self, rows: int):
+        with open(self._keys_file, "r+b") as f:
+            f.truncate(rows * KEY_SIZE)
+        with open(self._vectors_file, "r+b") as f:
+            f.truncate(rows * 4 * self.dim)
+
+    def _map_vectors(self):
+        self._vectors = (
+            np.memmap(
+                self._vectors_file,
+                dtype=np.float32,
+                mode="r",
+                shape=(self._num_rows, self.dim),
+            )
+            if self._num_rows > 0
+            else None
+        )
+
+    def get(self, keys: Sequence[bytes]) -> List[List[float] | None]:
+        with self._lock:
+            vectors = self._vectors
+            rows = [self._rows.get(key) for key in keys]
+        return [None if row is None else vectors[row].tolist() for row in rows]
+
+    def put(self, keys: Sequence[bytes], embeddings: Sequence[List[float]]):
+        if len(keys) == 0:
+            return
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            # A row of another width would shift the rows of all the later keys
+            if self.dim is not None and matrix.shape[1] != self.dim:
+                raise ValueError(
+                    f"The embeddings have {matrix.shape[1]} dimensions, the cache of"
+                    f" {self.model_id} has {self.dim} dimensions."
+                )
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                with open(self._meta_file, "w") as f:
+                    json.dump({"model_id": self.model_id, "dim": self.dim}, f)
+            # Write the vectors before the keys so a key never points to a missing vector
+            with open(self._vectors_file, "ab") as f:
+                f.write(matrix.tobytes())
+            with open(self._keys_file, "ab") as f:
+                for key in keys:
+                    f.write(key)
+            for key in keys:
+                self._rows[key] = self._num_rows
+                self._num_rows += 1
+            self._map_vectors()
+
+
+class BatchedEmbedding(TransformComponent):
+    """
+    Embed nodes in batches of a configurable size, dispatched concurrently to a bounded
+    thread pool. Embeddings of already seen texts are served from the embedding cache.
+    """
+
+    batch_size: int = Field(default=32, description="The number of texts per batch.")
+    num_workers: int = Field(
+        default=4, description="The number of batches embedded concurrently."
+    )
+    _embed_model = PrivateAttr()
+    _cache: EmbeddingCache | None = PrivateAttr()
+
+    def __init__(self, embed_model, cache: EmbeddingCache | None = None, **kwargs):
+        super().__init__(**kwargs)
+        self._embed_model = embed_model
+        self._cache = cache
+
+    def __call__(self, nodes: List[BaseNode], **kwargs) -> List[BaseNode]:
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        keys = [EmbeddingCache.text_key(text) for text in texts]
+        embeddings = (
+            self._cache.get(keys) if self._cache is not None else [None] * len(texts)
+        )
+
+        # Only embed each missing text once
+        missing: Dict[bytes, str] = {}
+        for key, text, embedding in zip(keys, texts, embeddings):
+            if embedding is None:
+                missing[key] = text
+        EMBED_CACHE_TEXTS.inc(len(texts) - len(missing), result="hit")
+        EMBED_CACHE_TEXTS.inc(len(missing), result="miss")
+        if len(missing) > 0:
+            logger.info(
+                f"Embedding {len(missing)} texts, {len(texts) - len(missing)} served from cache"
+            )
+            missing_keys = list(missing.keys())
+            new_embeddings = dict(
+                zip(missing_keys, self._embed(list(missing.values())))
+            )
+            if self._cache is not None:
+                self._cache.put(missing_keys, list(new_embeddings.values()))
+            embeddings = [
+                new_embeddings[key] if embedding is None else embedding
+                for key, embedding in zip(keys, embeddings)
+            ]
+
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        return nodes
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        batches = [
+            texts[i : i + self.batch_size]
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            results = executor.map(self._embed_batch, batches)
+            return [embedding for batch in results for embedding in batch]
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        with EMBED_BATCH_SECONDS.time():
+            return self._embed_model.get_text_embedding_batch(texts)
+
+
+_caches: Dict[str, EmbeddingCache] = {}
+
+
+def get_embedding_cache_dir() -> str:
+    # Keep it outside of STORAGE_DIR so it survives a reset of the index
+    return os.getenv("EMBEDDING_CACHE_DIR", "storage/embedding_cache")
+
+
+def get_embedding_cache(embed_model) -> EmbeddingCache | None:
+    if os.getenv("EMBEDDING_CACHE", "true").lower() != "true":
+        return None
+    cache_dir = get_embedding_cache_dir()
+    model_id = get_embedding_model_id(embed_model)
+    cache_key = f"{cache_dir}:{model_id}"
+    if cache_key not in _caches:
+        _caches[cache_key] = EmbeddingCache(cache_dir=cache_dir, model_id=model_id)
+    return _caches[cache_key]
+
+
+def get_embedding_stage(embed_model) -> BatchedEmbedding:
+    """
+    Build the embedding stage of the ingestion pipeline from the environment variables.
+    """
+    cache = get_embedding_cache(embed_model)
+    return BatchedEmbedding(
+        embed_model=embed_model,
+        cache=cache,
+        batch_size=int(os.getenv("EMBED_BATCH_SIZE", "32")),
+        num_workers=int(os.getenv("EMBED_CONCURRENCY", "4")),
+    )
@@ -1,58 +1,528 @@
 import os
+import json
 import shutil
+import hashlib
 import logging
-from create_llama.backend.app.engine.generate import generate_datasource
+import threading
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List
+from src.constants import DATA_DIR
+from src.models.file import SUPPORTED_FILE_EXTENSIONS, IndexingJob, IndexingStatus
+from src.shared_state import index_generation, indexing_lock
 
 
 logger = logging.getLogger("uvicorn")
 
+MANIFEST_FILE_NAME = "file_manifest.json"
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 1)))
 
-def index_all():
-    # Just call the generate_datasource from create_llama for now
-    generate_datasource()
+# Only one indexing run can modify the vector store and the doc store at a time,
+# the file lock serializes the runs of the worker processes
+_indexing_lock = threading.Lock()
 
 
-def reset_index():
+def get_storage_dir() -> str:
     """
-    Reset the index by removing the vector store data and STORAGE_DIR then re-indexing the data.
+    The storage dir of the index version being built or served.
     """
+    from app.engine.index_version import versioned_name
 
-    def reset_index_chroma():
-        from chromadb import PersistentClient
+    # A dedicated dir as the storage dir of a version is removed with the version
+    return versioned_name(os.getenv("STORAGE_DIR", "storage/context"))
 
-        # Todo: Consider using other method to clear the vector store data
-        chroma_path = os.getenv("CHROMA_PATH")
-        collection_name = os.getenv("CHROMA_COLLECTION", "default")
-        chroma_client = PersistentClient(path=chroma_path)
-        if chroma_client.get_or_create_collection(collection_name):
-            logger.info(f"Removing collection {collection_name}")
-            chroma_client.delete_collection(collection_name)
 
-    def reset_index_qdrant():
-        from app.engine.vectordbs.qdrant import get_vector_store
+def get_manifest_path() -> str:
+    return os.path.join(get_storage_dir(), MANIFEST_FILE_NAME)
 
-        store = get_vector_store()
-        store.client.delete_collection(
-            store.collection_name,
+
+def load_manifest() -> Dict[str, Dict]:
+    """
+    Load the manifest of the indexed files: {file_name: {"hash": str, "doc_ids": list}}
+    """
+    manifest_path = get_manifest_path()
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: Dict[str, Dict]):
+    manifest_path = get_manifest_path()
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    # Write to a temp file first so a crash never leaves a half written manifest
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def file_hash(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Compute the sha256 of a file without loading it into memory at once.
+    """
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_data_file_hashes() -> Dict[str, str]:
+    """
+    Get the hashes of the files in the data folder and sync the file catalog with it.
+    Only the files with a different size or mtime than in the catalog are hashed.
+    """
+    from src.file_catalog import file_catalog
+
+    if not os.path.exists(DATA_DIR):
+        return {}
+    known_files = file_catalog.get_file_stats()
+    hashes = {}
+    new_files = []
+    for file_name in os.listdir(DATA_DIR):
+        if file_name.split(".")[-1] not in SUPPORTED_FILE_EXTENSIONS:
+            continue
+        stat = os.stat(os.path.join(DATA_DIR, file_name))
+        known_file = known_files.get(file_name)
+        if known_file is not None and known_file[:2] == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            hashes[file_name] = known_file[2]
+            continue
+        hashes[file_name] = file_hash(os.path.join(DATA_DIR, file_name))
+        new_files.append((file_name, stat.st_size, hashes[file_name], stat.st_mtime_ns))
+    # Also add the files copied into the data folder without the API
+    file_catalog.add_files(new_files)
+    file_catalog.remove_files([name for name in known_files if name not in hashes])
+    return hashes
+
+
+def load_file_documents(file_names: List[str]):
+    """
+    Load the documents of the given files from the data folder.
+    Uses the same reader options as the file loader of create_llama.
+    """
+    import yaml
+    from llama_index.core.readers import SimpleDirectoryReader
+    from src.constants import LOADER_CONFIG_FILE
+
+    with open(LOADER_CONFIG_FILE, "r") as f:
+        file_loader_config = (yaml.safe_load(f) or {}).get("file") or {}
+
+    reader = SimpleDirectoryReader(
+        input_files=[os.path.join(DATA_DIR, file_name) for file_name in file_names],
+        filename_as_id=True,
+    )
+    if file_loader_config.get("use_llama_parse"):
+        from app.engine.loaders.file import llama_parse_parser
+
+        reader.file_extractor = {".pdf": llama_parse_parser()}
+    return reader.load_data()
+
+
+def parse_file(file_name: str, chunk_size: int, chunk_overlap: int):
+    """
+    Load and split a single file into nodes, runs in a worker process.
+    """
+    from llama_index.core.node_parser import SentenceSplitter
+    from app.engine.filters import add_filter_metadata
+
+    documents = load_file_documents([file_name])
+    add_filter_metadata(documents, os.path.join(DATA_DIR, file_name))
+    splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    nodes = splitter(documents)
+    return file_name, documents, nodes
+
+
+_parse_executor: ProcessPoolExecutor | None = None
+
+
+def _get_parse_executor() -> ProcessPoolExecutor:
+    global _parse_executor
+    if _parse_executor is None:
+        # Use spawn as forking the threaded API process is not safe
+        _parse_executor = ProcessPoolExecutor(
+            max_workers=PARSE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
         )
-        store._create_collection(
-            collection_name=store.collection_name,
-            vector_size=int(os.getenv("EMBEDDING_DIM", 1536)),
+    return _parse_executor
+
+
+def _reset_parse_executor():
+    """
+    Replace the pool after a worker process died, e.g. killed by a crashing parser,
+    a broken pool fails every submitted file.
+    """
+    global _parse_executor
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=False, cancel_futures=True)
+        _parse_executor = None
+
+
+def parse_files(file_names: List[str]):
+    """
+    Parse the files in a process pool, one file per worker.
+    The results are yielded as soon as they are ready, so the caller can embed a file
+    while the next ones are being parsed. At most twice the number of workers files
+    are in flight to bound the memory used by parsed but not yet embedded files.
+    Yields (file_name, documents, nodes, error), the error of a file that failed to
+    be parsed doesn't stop the other files. A broken pool fails the whole run.
+    """
+    from llama_index.core.settings import Settings
+
+    executor = _get_parse_executor()
+    pending_files = list(reversed(file_names))
+    in_flight = {}
+    try:
+        while pending_files or in_flight:
+            while pending_files and len(in_flight) < 2 * PARSE_WORKERS:
+                file_name = pending_files.pop()
+                future = executor.submit(
+                    parse_file, file_name, Settings.chunk_size, Settings.chunk_overlap
+                )
+                in_flight[future] = file_name
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_name = in_flight.pop(future)
+                try:
+                    _, documents, nodes = future.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    logger.exception(f"Failed to parse {file_name}")
+                    yield file_name, None, None, e
+                    continue
+                yield file_name, documents, nodes, None
+    except BrokenProcessPool:
+        # Only this run fails, the next one starts a new pool
+        _reset_parse_executor()
+        raise
+
+
+def get_doc_store():
+    from llama_index.core.storage.docstore import SimpleDocumentStore
+
+    storage_dir = get_storage_dir()
+    if os.path.exists(storage_dir):
+        return SimpleDocumentStore.from_persist_dir(storage_dir)
+    return SimpleDocumentStore()
+
+
+def persist_storage(docstore, vector_store):
+    from llama_index.core.storage import StorageContext
+
+    storage_context = StorageContext.from_defaults(
+        docstore=docstore, vector_store=vector_store
+    )
+    storage_context.persist(get_storage_dir())
+
+
+def embed_and_store(docstore, vector_store, documents, nodes):
+    """
+    Embed the nodes and add them to the vector store, store their documents in the doc store.
+    """
+    from llama_index.core.settings import Settings
+    from src.tasks.embeddings import get_embedding_stage
+
+    nodes = get_embedding_stage(Settings.embed_model)(nodes)
+    if len(nodes) > 0:
+        vector_store.add(nodes)
+    docstore.add_documents(documents)
+    for document in documents:
+        docstore.set_document_hash(document.doc_id, document.hash)
+    return nodes
+
+
+def index_all(job: IndexingJob | None = None):
+    """
+    Incrementally index the data folder.
+    Only new or changed files are parsed and embedded, and the nodes of removed files are deleted,
+    so the cost of a run depends on the size of the change instead of the size of the corpus.
+    The progress of the run is reported to the given job.
+    """
+    from app.metrics import INDEXING_RUN_SECONDS
+
+    with _indexing_lock, indexing_lock(), INDEXING_RUN_SECONDS.time():
+        if _index_changed_files(job or IndexingJob()):
+            _publish_index()
+
+
+def _publish_index():
+    from app.engine import invalidate_chat_engine_cache
+
+    # Tell the other workers to reload the index
+    index_generation.increment()
+    invalidate_chat_engine_cache()
+
+
+def _index_changed_files(job: IndexingJob) -> bool:
+    """
+    Index the changes of the data folder, returns whether the index changed.
+    """
+    from app.engine.bm25 import get_bm25_index
+    from app.engine.vectordb import get_vector_store, delete_documents
+    from app.metrics import INDEXING_FILES_PARSED, INDEXING_NODES_EMBEDDED
+    from llama_index.core.settings import Settings
+    from src.file_catalog import file_catalog
+
+    manifest = load_manifest()
+    current_hashes = get_data_file_hashes()
+    # The BM25 index is only needed for the hybrid retrieval
+    bm25_index = get_bm25_index()
+    if os.getenv("RETRIEVAL_MODE", "vector") != "hybrid":
+        # Removed as it would get stale, it is built again if hybrid is enabled
+        if bm25_index.exists():
+            logger.info("Removing the BM25 index as the retrieval mode is not hybrid")
+            bm25_index.remove()
+        bm25_index = None
+
+    removed_files = [name for name in manifest if name not in current_hashes]
+    changed_files = [
+        name
+        for name, content_hash in current_hashes.items()
+        if manifest.get(name, {}).get("hash") != content_hash
+    ]
+    if len(manifest) > 0 and bm25_index is not None and not bm25_index.exists():
+        # Indexed before the BM25 index existed, the embedding cache makes this cheap
+        logger.info("Re-indexing all files to build the BM25 index")
+        changed_files = list(current_hashes.keys())
+    job.total_files = len(changed_files)
+    job.removed_files = len(removed_files)
+    # The files indexed before the file catalog existed
+    file_catalog.set_status(
+        [
+            name
+            for name in file_catalog.get_names(IndexingStatus.UPLOADED)
+            if name in manifest and name not in changed_files
+        ],
+        IndexingStatus.INDEXED,
+    )
+    if len(removed_files) == 0 and len(changed_files) == 0:
+        logger.info("Index is up to date")
+        return False
+
+    logger.info(
+        f"Indexing {len(changed_files)} new or changed files, removing {len(removed_files)} files"
+    )
+    docstore = get_doc_store()
+    vector_store = get_vector_store()
+
+    # Remove the stale documents of removed and changed files
+    stale_doc_ids = [
+        doc_id
+        for name in removed_files + changed_files
+        for doc_id in manifest.get(name, {}).get("doc_ids", [])
+    ]
+    delete_documents(vector_store, stale_doc_ids)
+    if bm25_index is not None:
+        bm25_index.delete_documents(stale_doc_ids)
+    for doc_id in stale_doc_ids:
+        docstore.delete_document(doc_id, raise_error=False)
+    for name in removed_files:
+        manifest.pop(name)
+
+    # Embed each file as soon as it is parsed while the next files are parsed
+    job.status = IndexingStatus.PARSING
+    file_catalog.set_status(changed_files, IndexingStatus.INDEXING)
+    pending_files = set(changed_files)
+    try:
+        for name, documents, nodes, error in parse_files(changed_files):
+            if error is not None:
+                # Retried by the next run as it is not in the manifest
+                manifest.pop(name, None)
+                file_catalog.set_status(
+                    [name], IndexingStatus.INDEXING_FAILED, str(error)
+                )
+                pending_files.discard(name)
+                job.failed_files += 1
+                continue
+            job.parsed_files += 1
+            INDEXING_FILES_PARSED.inc()
+            job.status = IndexingStatus.EMBEDDING
+            doc_ids = [document.doc_id for document in documents]
+            # Clean up the documents left by an interrupted run
+            delete_documents(vector_store, doc_ids)
+            embed_and_store(docstore, vector_store, documents, nodes)
+            if bm25_index is not None:
+                bm25_index.delete_documents(doc_ids)
+                bm25_index.add(nodes)
+            manifest[name] = {"hash": current_hashes[name], "doc_ids": doc_ids}
+            file_catalog.set_indexed(name, len(nodes), Settings.embed_model.model_name)
+            pending_files.discard(name)
+            job.embedded_files += 1
+            job.embedded_nodes += len(nodes)
+            INDEXING_NODES_EMBEDDED.inc(len(nodes))
+    except Exception as e:
+        file_catalog.set_status(
+            list(pending_files), IndexingStatus.INDEXING_FAILED, str(e)
         )
+        raise
+
+    persist_storage(docstore, vector_store)
+    save_manifest(manifest)
+    logger.info("Finished indexing")
+    return True
+
+
+def _drop_index_version(version: int):
+    """
+    Remove the vector store collection and the storage dir of an index version.
+    """
+    from app.engine.index_version import building_version, versioned_name
 
     vector_store_provider = os.getenv("VECTOR_STORE_PROVIDER", "chroma")
-    if vector_store_provider == "chroma":
-        reset_index_chroma()
-    elif vector_store_provider == "qdrant":
-        reset_index_qdrant()
-    else:
-        raise ValueError(f"Unsupported vector provider: {vector_store_provider}")
-
-    # Remove STORAGE_DIR
-    storage_context_dir = os.getenv("STORAGE_DIR")
-    logger.info(f"Removing {storage_context_dir}")
-    if os.path.exists(storage_context_dir):
-        shutil.rmtree(storage_context_dir)
-
-    # Run the indexing
-    index_all()
+    logger.info(f"Removing index version {version}")
+    with building_version(version):
+        if vector_store_provider == "chroma":
+            import chromadb
+
+            chroma_path = os.getenv("CHROMA_PATH")
+            if chroma_path:
+                chroma_client = chromadb.PersistentClient(path=chroma_path)
+            else:
+                chroma_client = chromadb.HttpClient(
+                    host=os.getenv("CHROMA_HOST"), port=int(os.getenv("CHROMA_PORT"))
+                )
+            collection_name = versioned_name(os.getenv("CHROMA_COLLECTION", "default"))
+            try:
+                chroma_client.delete_collection(collection_name)
+            except ValueError:
+                # The collection does not exist
+                pass
+        elif vector_store_provider == "qdrant":
+            from app.engine.vectordbs.qdrant import get_vector_store
+
+            store = get_vector_store()
+            store.client.delete_collection(store.collection_name)
+        elif vector_store_provider == "local":
+            from app.engine.vectordbs.local import remove_vector_store
+
+            remove_vector_store(
+                versioned_name(os.getenv("LOCAL_VECTOR_STORE_PATH", "storage/vectordb"))
+            )
+        else:
+            raise ValueError(f"Unsupported vector provider: {vector_store_provider}")
+        storage_dir = get_storage_dir()
+        shared_paths = _get_shared_store_paths(storage_dir)
+        if len(shared_paths) > 0:
+            logger.warning(
+                f"Not removing the storage dir {storage_dir} of index version {version}"
+                f" as it contains {', '.join(shared_paths)}."
+                " Set STORAGE_DIR to a dedicated directory."
+            )
+        else:
+            shutil.rmtree(storage_dir, ignore_errors=True)
+
+
+def _get_shared_store_paths(storage_dir: str) -> List[str]:
+    """
+    The paths of the stores kept across the index versions that are in the storage dir.
+    """
+    from app.engine.index_version import get_active_index_file
+    from app.engine.session import session_store
+    from src.file_catalog import file_catalog
+    from src.tasks.embeddings import get_embedding_cache_dir
+    from src.tasks.jobs import indexing_queue
+
+    paths = [
+        get_active_index_file(),
+        file_catalog.path,
+        get_embedding_cache_dir(),
+        indexing_queue.jobs_dir,
+        session_store.path,
+        os.getenv("CHROMA_PATH"),
+        os.getenv("LOCAL_VECTOR_STORE_PATH", "storage/vectordb"),
+        os.getenv("METRICS_DIR"),
+    ]
+    storage_dir = os.path.abspath(storage_dir)
+    return [
+        path
+        for path in paths
+        if path
+        and os.path.commonpath([storage_dir, os.path.abspath(path)]) == storage_dir
+    ]
+
+
+def _validate_index_version(job: IndexingJob):
+    """
+    Query the new index once, so a broken index is never activated.
+    """
+    from llama_index.core.indices import VectorStoreIndex
+    from app.engine.vectordb import get_vector_store
+
+    if job.embedded_nodes == 0:
+        return
+    index = VectorStoreIndex.from_vector_store(get_vector_store())
+    nodes = index.as_retriever(similarity_top_k=1).retrieve("index validation")
+    if len(nodes) == 0:
+        raise RuntimeError("The new index returned no results")
+
+
+def collect_retired_index_versions():
+    """
+    Remove the index versions replaced by a rebuild.
+    """
+    from app.engine.index_version import read_active_index, write_active_index
+
+    with _indexing_lock, indexing_lock():
+        active_index = read_active_index()
+        for version in list(active_index["retired"]):
+            try:
+                _drop_index_version(version)
+            except Exception:
+                logger.exception(f"Failed to remove index version {version}")
+                continue
+            active_index["retired"].remove(version)
+            write_active_index(active_index)
+
+
+def rebuild_index(job: IndexingJob | None = None):
+    """
+    Rebuild the index from scratch, e.g. with a new embedding model, without downtime.
+    The data is indexed into a new version of the collection and storage dir while
+    the chat keeps using the active version. The new version is validated and then
+    activated by atomically replacing the pointer to the active version.
+    The replaced version is removed after INDEX_GC_DELAY_SECONDS,
+    once the requests using it are finished.
+    """
+    from app.engine.index_version import (
+        activate_version,
+        building_version,
+        read_active_index,
+    )
+    from app.metrics import INDEXING_RUN_SECONDS
+
+    job = job or IndexingJob()
+    # Remove the versions left by the previous rebuild first
+    collect_retired_index_versions()
+    with _indexing_lock, indexing_lock(), INDEXING_RUN_SECONDS.time():
+        active_index = read_active_index()
+        version = active_index["version"] + 1
+        logger.info(f"Rebuilding the index into version {version}")
+        with building_version(version):
+            # Remove the partial index of an interrupted rebuild
+            _drop_index_version(version)
+            try:
+                _index_changed_files(job)
+                _validate_index_version(job)
+            except Exception:
+                _drop_index_version(version)
+                raise
+        activate_version(
+            version, retired=active_index["retired"] + [active_index["version"]]
+        )
+        _publish_index()
+    schedule_index_gc()
+
+
+def schedule_index_gc():
+    """
+    Remove the retired index versions after INDEX_GC_DELAY_SECONDS.
+    """
+    gc_delay = float(os.getenv("INDEX_GC_DELAY_SECONDS", "60"))
+    timer = threading.Timer(gc_delay, collect_retired_index_versions)
+    timer.daemon = True
+    timer.start()
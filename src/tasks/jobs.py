@@ -0,0 +1,182 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import List
+from src.models.file import IndexingJob, IndexingStatus
+from src.tasks.indexing import index_all, rebuild_index
+
+
+logger = logging.getLogger("uvicorn")
+
+
+class IndexingQueue:
+    """
+    Run indexing jobs in a background worker so requests never wait for an indexing run.
+    A burst of submissions is coalesced into a single job because every run indexes
+    all changes of the data folder that happened before it started.
+    Runs are serialized as they all write to the same vector store.
+    The jobs are also saved to jobs_dir, so every worker process can report
+    the status of the jobs run by the other workers. The progress of a running job
+    is saved at most every progress_interval seconds.
+    """
+
+    def __init__(
+        self,
+        debounce_seconds: float = 1.0,
+        max_history: int = 100,
+        jobs_dir: str | None = None,
+        progress_interval: float = 1.0,
+    ):
+        self.debounce_seconds = debounce_seconds
+        self.max_history = max_history
+        self.jobs_dir = jobs_dir
+        self.progress_interval = progress_interval
+        self._jobs: OrderedDict[str, IndexingJob] = OrderedDict()
+        self._pending: IndexingJob | None = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker: threading.Thread | None = None
+
+    def submit(self, rebuild: bool = False) -> IndexingJob:
+        """
+        Queue an indexing run, or return the queued job if it has not started yet.
+        A rebuild indexes all files, so it also covers the changes of a queued run.
+        """
+        with self._lock:
+            if self._pending is None:
+                self._pending = IndexingJob()
+                self._jobs[self._pending.id] = self._pending
+                while len(self._jobs) > self.max_history:
+                    self._jobs.popitem(last=False)
+            job = self._pending
+            job.rebuild = job.rebuild or rebuild
+            self._save_job(job)
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="indexing-worker", daemon=True
+                )
+                self._worker.start()
+        self._wakeup.set()
+        return job
+
+    def get_job(self, job_id: str) -> IndexingJob | None:
+        job = self._jobs.get(job_id)
+        if job is None and re.fullmatch(r"[0-9a-f]{32}", job_id):
+            job = self._load_job(os.path.join(self.jobs_dir or "", f"{job_id}.json"))
+        return job
+
+    def get_jobs(self) -> List[IndexingJob]:
+        jobs = {job.id: job for job in self._load_saved_jobs()}
+        jobs.update(self._jobs)
+        return sorted(jobs.values(), key=lambda job: job.created_at, reverse=True)[
+            : self.max_history
+        ]
+
+    def _save_job(self, job: IndexingJob):
+        if self.jobs_dir is None:
+            return
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        path = os.path.join(self.jobs_dir, f"{job.id}.json")
+        with open(f"{path}.tmp", "w") as f:
+            f.write(job.model_dump_json())
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def _load_job(path: str) -> IndexingJob | None:
+        try:
+            with open(path, "r") as f:
+                return IndexingJob.model_validate_json(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _load_saved_jobs(self) -> List[IndexingJob]:
+        if self.jobs_dir is None or not os.path.exists(self.jobs_dir):
+            return []
+        jobs = []
+        for file_name in os.listdir(self.jobs_dir):
+            if file_name.endswith(".json"):
+                job = self._load_job(os.path.join(self.jobs_dir, file_name))
+                if job is not None:
+                    jobs.append(job)
+        return jobs
+
+    def _prune_saved_jobs(self):
+        if self.jobs_dir is None or not os.path.exists(self.jobs_dir):
+            return
+        paths = [
+            os.path.join(self.jobs_dir, file_name)
+            for file_name in os.listdir(self.jobs_dir)
+            if file_name.endswith(".json")
+        ]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[self.max_history :]:
+            os.remove(path)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            # Wait a bit so a burst of uploads ends up in the same job
+            time.sleep(self.debounce_seconds)
+            with self._lock:
+                job = self._pending
+                self._pending = None
+                self._wakeup.clear()
+            if job is not None:
+                self._run_job(job)
+
+    def _save_progress(self, job: IndexingJob, stop: threading.Event):
+        """
+        Save the progress counters of the running job when they changed.
+        """
+        last_state = job.model_dump_json()
+        while not stop.wait(self.progress_interval):
+            state = job.model_dump_json()
+            if state != last_state:
+                self._save_job(job)
+                last_state = state
+
+    def _run_job(self, job: IndexingJob):
+        job.started_at = datetime.now()
+        self._save_job(job)
+        stop_progress = threading.Event()
+        progress_saver = None
+        if self.jobs_dir is not None:
+            progress_saver = threading.Thread(
+                target=self._save_progress,
+                args=(job, stop_progress),
+                name="indexing-progress",
+                daemon=True,
+            )
+            progress_saver.start()
+        error = None
+        try:
+            if job.rebuild:
+                rebuild_index(job)
+            else:
+                index_all(job)
+        except Exception as e:
+            logger.exception(f"Indexing job {job.id} failed")
+            error = e
+        # Stop the progress updates before the final state is set and saved
+        stop_progress.set()
+        if progress_saver is not None:
+            progress_saver.join()
+        if error is None:
+            job.status = IndexingStatus.DONE
+        else:
+            job.status = IndexingStatus.FAILED
+            job.error = str(error)
+        job.finished_at = datetime.now()
+        self._save_job(job)
+        self._prune_saved_jobs()
+
+
+indexing_queue = IndexingQueue(
+    debounce_seconds=float(os.getenv("INDEXING_DEBOUNCE_SECONDS", "1")),
+    # Keep it outside of STORAGE_DIR so the jobs survive a rebuild of the index
+    jobs_dir=os.getenv("INDEXING_JOBS_DIR", "storage/jobs"),
+)
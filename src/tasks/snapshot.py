@@ -0,0 +1,327 @@
+"""
+Export the active index to a snapshot file and import it into another deployment,
+e.g. to provision a replica without parsing and embedding the documents again.
+
+Usage:
+    python -m src.tasks.snapshot export <path>
+    python -m src.tasks.snapshot import <path>
+"""
+
+import io
+import os
+import gzip
+import json
+import zlib
+import sqlite3
+import logging
+import tarfile
+import tempfile
+from collections import Counter
+from datetime import datetime, timezone
+from typing import BinaryIO, Dict, Tuple
+import numpy as np
+from src.models.file import IndexingStatus
+from src.shared_state import indexing_lock
+from src.tasks.indexing import (
+    _drop_index_version,
+    _indexing_lock,
+    _publish_index,
+    collect_retired_index_versions,
+    get_data_file_hashes,
+    get_storage_dir,
+    load_manifest,
+    schedule_index_gc,
+)
+
+logger = logging.getLogger("uvicorn")
+
+SNAPSHOT_FORMAT = 1
+HEADER_NAME = "snapshot.json"
+FOOTER_NAME = "end.json"
+NODES_DIR = "nodes"
+STORAGE_DIR = "storage"
+# The number of nodes per batch of the snapshot, bounds the memory of the export and import
+SNAPSHOT_BATCH_SIZE = int(os.getenv("SNAPSHOT_BATCH_SIZE", "1000"))
+# The storage files that are only a part of another file or being written
+SKIPPED_STORAGE_SUFFIXES = ("-wal", "-shm", "-journal", ".tmp")
+# The errors of reading a file that is not a complete snapshot
+INVALID_FILE_ERRORS = (
+    tarfile.TarError,
+    EOFError,
+    gzip.BadGzipFile,
+    zlib.error,
+    json.JSONDecodeError,
+)
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class EmbeddingMismatchError(SnapshotError):
+    pass
+
+
+def get_embedding_info() -> Dict:
+    """
+    The embedding model of the current config, the embeddings of a snapshot
+    can only be queried with the model they were created with.
+    """
+    from src.models.env_config import get_config
+
+    config = get_config()
+    return {
+        "provider": config.model_provider,
+        "model": config.embedding_model,
+        "dim": config.embedding_dim,
+    }
+
+
+def _add_bytes(tar: tarfile.TarFile, name: str, data: bytes):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(datetime.now().timestamp())
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _add_storage_file(tar: tarfile.TarFile, path: str):
+    name = f"{STORAGE_DIR}/{os.path.basename(path)}"
+    if not path.endswith(".sqlite"):
+        tar.add(path, arcname=name)
+        return
+    # Copy the database with its write-ahead log, the file alone can be incomplete
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        copy_path = os.path.join(tmp_dir, "copy.sqlite")
+        source, target = sqlite3.connect(path), sqlite3.connect(copy_path)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+        tar.add(copy_path, arcname=name)
+
+
+def _open_tar(file: str | BinaryIO, mode: str, **kwargs) -> tarfile.TarFile:
+    if isinstance(file, str):
+        return tarfile.open(name=file, mode=mode, **kwargs)
+    return tarfile.open(fileobj=file, mode=mode, **kwargs)
+
+
+def export_snapshot(file: str | BinaryIO) -> Dict:
+    """
+    Write the active index to a gzipped tar file: a header with the embedding model
+    and the file manifest, the nodes of the vector store in batches of JSON lines with
+    their embeddings as float32 arrays, and the files of the storage dir (doc store,
+    BM25 index and manifest). The indexing is paused so the snapshot is consistent.
+    Returns the header with the number of exported nodes.
+    """
+    from app.engine.vectordb import export_nodes, get_vector_store
+    from llama_index.core.vector_stores.utils import node_to_metadata_dict
+
+    with _indexing_lock, indexing_lock():
+        header = {
+            "format": SNAPSHOT_FORMAT,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "embedding": get_embedding_info(),
+            "vector_store_provider": os.getenv("VECTOR_STORE_PROVIDER", "chroma"),
+            "files": load_manifest(),
+        }
+        num_nodes = 0
+        dim = None
+        with _open_tar(file, "w:gz", compresslevel=6) as tar:
+            # The header comes first so an import can be refused before reading the nodes
+            _add_bytes(tar, HEADER_NAME, json.dumps(header).encode())
+            batches = export_nodes(get_vector_store(), SNAPSHOT_BATCH_SIZE)
+            for i, nodes in enumerate(batches):
+                lines = [
+                    json.dumps(
+                        node_to_metadata_dict(
+                            node, remove_text=False, flat_metadata=False
+                        )
+                    )
+                    for node in nodes
+                ]
+                _add_bytes(tar, f"{NODES_DIR}/{i:06d}.jsonl", "\n".join(lines).encode())
+                embeddings = np.asarray(
+                    [node.embedding for node in nodes], dtype=np.float32
+                )
+                buffer = io.BytesIO()
+                np.save(buffer, embeddings)
+                _add_bytes(tar, f"{NODES_DIR}/{i:06d}.npy", buffer.getvalue())
+                num_nodes += len(nodes)
+                dim = embeddings.shape[1]
+
+            storage_dir = get_storage_dir()
+            if os.path.exists(storage_dir):
+                for file_name in sorted(os.listdir(storage_dir)):
+                    path = os.path.join(storage_dir, file_name)
+                    if os.path.isfile(path) and not file_name.endswith(
+                        SKIPPED_STORAGE_SUFFIXES
+                    ):
+                        _add_storage_file(tar, path)
+            # Written last, a snapshot without it is truncated
+            _add_bytes(tar, FOOTER_NAME, json.dumps({"nodes": num_nodes}).encode())
+
+    header.update(nodes=num_nodes, dim=dim)
+    logger.info(f"Exported a snapshot of {num_nodes} nodes")
+    return header
+
+
+def _read_header(tar: tarfile.TarFile) -> Dict:
+    member = tar.next()
+    if member is None or member.name != HEADER_NAME:
+        raise SnapshotError("The file is not an index snapshot.")
+    header = json.loads(tar.extractfile(member).read())
+    if header.get("format") != SNAPSHOT_FORMAT:
+        raise SnapshotError(f"Unsupported snapshot format: {header.get('format')}")
+    embedding = get_embedding_info()
+    if header["embedding"] != embedding:
+        raise EmbeddingMismatchError(
+            f"The snapshot was created with the embedding model {header['embedding']}, "
+            f"the current embedding model is {embedding}."
+        )
+    return header
+
+
+def _load_snapshot(
+    tar: tarfile.TarFile, vector_store, storage_dir: str
+) -> Tuple[int, Counter]:
+    """
+    Add the nodes of the snapshot to the vector store with their stored embeddings
+    and extract the storage files.
+    Returns the number of added nodes and the number of nodes of each file.
+    """
+    from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+    num_nodes = 0
+    file_chunks = Counter()
+    footer = None
+    nodes = None
+    os.makedirs(storage_dir, exist_ok=True)
+    for member in tar:
+        if not member.isfile() or member.name == HEADER_NAME:
+            continue
+        data = tar.extractfile(member).read()
+        if member.name.startswith(f"{NODES_DIR}/") and member.name.endswith(".jsonl"):
+            nodes = [
+                metadata_dict_to_node(json.loads(line))
+                for line in data.decode().splitlines()
+            ]
+        elif member.name.startswith(f"{NODES_DIR}/") and member.name.endswith(".npy"):
+            embeddings = np.load(io.BytesIO(data), allow_pickle=False)
+            if nodes is None or len(nodes) != len(embeddings):
+                raise SnapshotError(f"The nodes of {member.name} are missing.")
+            for node, embedding in zip(nodes, embeddings):
+                node.embedding = embedding.tolist()
+            vector_store.add(nodes)
+            num_nodes += len(nodes)
+            file_chunks.update(node.metadata.get("file_name") for node in nodes)
+            nodes = None
+        elif member.name.startswith(f"{STORAGE_DIR}/"):
+            # Never write outside the storage dir
+            file_name = os.path.basename(member.name)
+            if file_name in ("", ".", ".."):
+                continue
+            with open(os.path.join(storage_dir, file_name), "wb") as f:
+                f.write(data)
+        elif member.name == FOOTER_NAME:
+            footer = json.loads(data)
+    if footer is None:
+        raise SnapshotError("The snapshot is truncated.")
+    if footer["nodes"] != num_nodes:
+        raise SnapshotError(
+            f"The snapshot has {footer['nodes']} nodes but {num_nodes} were loaded."
+        )
+    return num_nodes, file_chunks
+
+
+def _sync_file_catalog(header: Dict, file_chunks: Counter):
+    """
+    Mark the files of the data folder that are indexed by the snapshot as indexed
+    in the file catalog, the other files are indexed by the next indexing run.
+    """
+    from src.file_catalog import file_catalog
+
+    manifest = header["files"]
+    not_indexed = []
+    for name, content_hash in get_data_file_hashes().items():
+        if manifest.get(name, {}).get("hash") == content_hash:
+            file_catalog.set_indexed(
+                name, file_chunks[name], header["embedding"]["model"]
+            )
+        else:
+            not_indexed.append(name)
+    file_catalog.set_status(not_indexed, IndexingStatus.UPLOADED)
+
+
+def import_snapshot(file: str | BinaryIO) -> Dict:
+    """
+    Replace the index with a snapshot. The stored embeddings are added to the vector
+    store as they are, nothing is embedded, so the embedding model of the current
+    config must be the one of the snapshot. Like a rebuild, the snapshot is loaded
+    into a new index version that is only activated once it is complete.
+    The documents are not part of the snapshot, the data folder must have the same files,
+    otherwise the next indexing run removes the missing files from the index.
+    Returns the header of the snapshot with the number of imported nodes.
+    """
+    from app.engine.index_version import (
+        activate_version,
+        building_version,
+        read_active_index,
+    )
+    from app.engine.vectordb import get_vector_store
+
+    # Remove the versions left by the previous rebuild first
+    collect_retired_index_versions()
+    try:
+        with _open_tar(file, "r:gz") as tar:
+            header = _read_header(tar)
+            with _indexing_lock, indexing_lock():
+                active_index = read_active_index()
+                version = active_index["version"] + 1
+                logger.info(f"Importing the snapshot into index version {version}")
+                with building_version(version):
+                    # Remove the partial index of an interrupted import
+                    _drop_index_version(version)
+                    try:
+                        num_nodes, file_chunks = _load_snapshot(
+                            tar, get_vector_store(), get_storage_dir()
+                        )
+                    except Exception:
+                        _drop_index_version(version)
+                        raise
+                activate_version(
+                    version, retired=active_index["retired"] + [active_index["version"]]
+                )
+                _publish_index()
+                _sync_file_catalog(header, file_chunks)
+    except INVALID_FILE_ERRORS as e:
+        raise SnapshotError(f"The snapshot file is invalid: {e}") from e
+    schedule_index_gc()
+
+    header["nodes"] = num_nodes
+    logger.info(f"Imported a snapshot of {num_nodes} nodes")
+    return header
+
+
+def main():
+    import argparse
+    from src.shared_state import load_env_file
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="The snapshot file, e.g. index.tar.gz")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_env_file()
+    if args.command == "export":
+        header = export_snapshot(args.path)
+    else:
+        header = import_snapshot(args.path)
+    header.pop("files", None)
+    print(json.dumps(header, indent=2))
+
+
+if __name__ == "__main__":
+    main()
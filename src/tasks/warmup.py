@@ -0,0 +1,153 @@
+import os
+import time
+import logging
+import threading
+from typing import Dict
+from src.controllers.providers import AIProvider
+from src.models.env_config import get_config
+
+
+logger = logging.getLogger("uvicorn")
+
+# The delay before retrying a failed warm-up, doubled after every failure
+RETRY_INITIAL_SECONDS = 5
+RETRY_MAX_SECONDS = 300
+# The providers serving the models from a local server, which loads them on the first request
+LOCAL_PROVIDERS = ("ollama",)
+
+
+class ModelStatus:
+    PENDING = "pending"
+    WARMING = "warming"
+    READY = "ready"
+    FAILED = "failed"
+    NOT_CONFIGURED = "not_configured"
+
+
+def _is_warmup_needed(provider: str) -> bool:
+    return (
+        provider in LOCAL_PROVIDERS
+        or os.getenv("WARMUP_HOSTED_MODELS", "false").lower() == "true"
+    )
+
+
+class ModelWarmup:
+    """
+    Send a tiny embedding and generation request to the configured models in a
+    background thread, so the models are loaded before the first chat request.
+    A failed warm-up is retried with a growing delay, e.g. until the Ollama server is up.
+    A warm-up started by a newer config replaces the status of the older one.
+    The hosted models have nothing to load and their requests are billed, so they are
+    only warmed up if WARMUP_HOSTED_MODELS is set.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._status: Dict[str, Dict] = {}
+        self._configured = False
+
+    def start(self):
+        config = get_config()
+        skipped = False
+        if not config.configured:
+            # Nothing to load until the app is configured in the admin UI
+            status = ModelStatus.NOT_CONFIGURED
+        elif not _is_warmup_needed(config.model_provider):
+            status = ModelStatus.READY
+            skipped = True
+        else:
+            status = ModelStatus.PENDING
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            self._configured = config.configured
+            self._status = {
+                name: {"model": model, "status": status, "skipped": skipped}
+                for name, model in (
+                    ("llm", config.model),
+                    ("embedding", config.embedding_model),
+                )
+            }
+        if not config.configured or skipped:
+            return
+        threading.Thread(
+            target=self._run,
+            args=(generation, config.model_provider),
+            name="model-warmup",
+            daemon=True,
+        ).start()
+
+    def _set_status(self, generation: int, name: str, **status) -> bool:
+        """
+        Returns False if a newer warm-up replaced this one.
+        """
+        with self._lock:
+            if generation != self._generation:
+                return False
+            self._status[name].update(status)
+            return True
+
+    def _warm_up(self, generation: int, name: str, warm_up_fn) -> bool:
+        """
+        Warm up a model until it succeeds, returns False if a newer warm-up replaced this one.
+        """
+        retry_seconds = RETRY_INITIAL_SECONDS
+        while self._set_status(generation, name, status=ModelStatus.WARMING):
+            start = time.perf_counter()
+            try:
+                warm_up_fn()
+            except Exception as e:
+                logger.warning(
+                    f"Failed to warm up the {name} model, retrying in {retry_seconds}s: {e}"
+                )
+                self._set_status(
+                    generation, name, status=ModelStatus.FAILED, error=str(e)
+                )
+                time.sleep(retry_seconds)
+                retry_seconds = min(2 * retry_seconds, RETRY_MAX_SECONDS)
+                continue
+            seconds = time.perf_counter() - start
+            logger.info(f"Warmed up the {name} model in {seconds:.2f}s")
+            return self._set_status(
+                generation, name, status=ModelStatus.READY, error=None, seconds=seconds
+            )
+        return False
+
+    @staticmethod
+    def _warm_up_llm(provider: str):
+        from llama_index.core.settings import Settings
+
+        if provider == "ollama":
+            # An empty prompt only loads the model into memory
+            AIProvider.get_ollama_client().generate(model=os.getenv("MODEL"), prompt="")
+        else:
+            Settings.llm.complete("Hi")
+
+    @staticmethod
+    def _warm_up_embedding():
+        from llama_index.core.settings import Settings
+
+        Settings.embed_model.get_text_embedding("warm up")
+
+    def _run(self, generation: int, provider: str):
+        if self._warm_up(generation, "embedding", self._warm_up_embedding):
+            self._warm_up(generation, "llm", lambda: self._warm_up_llm(provider))
+
+    def get_status(self) -> Dict:
+        """
+        An app that is not configured yet is ready, so the admin UI can be reached
+        to configure it.
+        """
+        with self._lock:
+            models = {name: dict(status) for name, status in self._status.items()}
+            configured = self._configured
+        return {
+            "ready": not configured
+            or all(status["status"] == ModelStatus.READY for status in models.values()),
+            "configured": configured,
+            "models": models,
+        }
+
+
+model_warmup = ModelWarmup()